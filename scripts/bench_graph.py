@@ -0,0 +1,105 @@
+# Benchmark for break_cycles on synthetic sheet face graphs like raycast_sort's:
+# vertices in a hidden order with weighted edges to the next few, and some
+# lighter edges backwards, as noisy rays make. Compares break_cycles, which
+# solves each strongly connected component on its own, exactly when small, with
+# the greedy feedback arc set on the whole graph and with the list based
+# implementation that came before, checking that the results are acyclic, and
+# prints the timings and the total weight cut by each. Runs outside of blender:
+#
+#   python scripts/bench_graph.py --sizes 1000 5000 20000 50000 --workers 8
+#
+# The reference implementation is quadratic, --reference-max caps the sizes it
+# runs on.
+
+import argparse, random, time
+import vesuvius.graph as graph
+
+
+def synthetic_graph(n, rng, degree=4, back_fraction=0.1):
+  vertices = [f"sf{i}" for i in rng.sample(range(n), n)]
+  edges = {}
+  for i in range(n):
+    for _ in range(degree):
+      j = i + rng.randint(1, 8)
+      if j < n:
+        edges[(vertices[i], vertices[j])] = edges.get((vertices[i], vertices[j]), 0) + rng.uniform(1, 10)
+    if rng.random() < back_fraction:
+      j = i - rng.randint(1, 8)
+      if j >= 0:
+        edges[(vertices[i], vertices[j])] = edges.get((vertices[i], vertices[j]), 0) + rng.uniform(0, 3)
+  return graph.Graph(vertices, [(v, w, m) for (v, w), m in edges.items()])
+
+
+# break_cycles before the indexed graph.
+def break_cycles_reference(g):
+  vertices = g.vertices.copy()
+  edges = []
+  edges_cut = []
+  while len(g.vertices) > 0:
+    v = g.sink()
+    while v:
+      edges += g.edges_into(v)
+      g.remove(v)
+      v = g.sink()
+    v = g.isolated()
+    while v:
+      g.remove(v)
+      v = g.isolated()
+    v = g.source()
+    while v:
+      edges += g.edges_from(v)
+      g.remove(v)
+      v = g.source()
+    if len(g.vertices) == 0:
+      break
+    v_max = g.vertices[0]
+    d_max = g.weight_from(v_max) - g.weight_into(v_max)
+    for v in g.vertices:
+      d_v = g.weight_from(v) - g.weight_into(v)
+      if d_v > d_max:
+        d_max = d_v
+        v_max = v
+    edges += g.edges_from(v_max)
+    edges_cut += g.edges_into(v_max)
+    g.remove(v_max)
+  return graph.Graph(vertices, edges), edges_cut
+
+
+# The greedy feedback arc set on the whole graph, without splitting it into
+# strongly connected components.
+def break_cycles_greedy(g):
+  ig = graph.IndexedGraph.from_graph(g)
+  cut = graph.greedy_feedback_arcs(ig)
+  edges = []
+  edges_cut = []
+  for e, (v, w, m) in enumerate(zip(ig.sources.tolist(), ig.targets.tolist(), ig.weights.tolist())):
+    (edges_cut if cut[e] else edges).append((g.vertices[v], g.vertices[w], m))
+  return graph.Graph(g.vertices.copy(), edges), edges_cut
+
+
+def run(name, f, g):
+  t0 = time.time()
+  ga, edges_cut = f(g)
+  t = time.time() - t0
+  assert len(graph.topo_sorted(ga)) == len(ga.vertices), f"{name}: result has cycles"
+  print(f"  {name}: {t:.3f} s., cut {len(edges_cut)} edges of weight {sum(m for _, _, m in edges_cut):.1f}")
+  return t
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark break_cycles on synthetic sheet face graphs.")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+  parser.add_argument("--reference-max", type=int, default=5000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--workers", type=int, default=None, help="processes for break_cycles, all cores by default")
+  args = parser.parse_args()
+  for n in args.sizes:
+    g = synthetic_graph(n, random.Random(args.seed))
+    print(f"{n} vertices, {sum(len(g._from[v]) for v in g.vertices)} edges:")
+    run("scc + exact", lambda g: graph.break_cycles(g, args.workers), g)
+    run("greedy", break_cycles_greedy, g)
+    if n <= args.reference_max:
+      run("reference", break_cycles_reference, g.copy())
+
+
+if __name__ == "__main__":
+  main()
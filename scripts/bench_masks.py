@@ -0,0 +1,98 @@
+# Benchmark for the segment masks of build_segment_patches.py, on synthetic
+# segments: a spiral sheet through a few layers of cells, like a scroll wrap,
+# and patches scattered around it, some on the sheet and some off it. Compares
+# vesuvius.masks with the per-vertex loops it replaced (checking they agree)
+# and prints the timings. Runs outside of blender:
+#
+#   python scripts/bench_masks.py --vertices 2000000 --patches 2000
+#
+# The loops take minutes for millions of vertices; --loop-vertices caps the
+# segment size they run on.
+
+import argparse, time
+import numpy as np
+import vesuvius.masks
+
+CELL_SIZE = 5
+NSUBDIVS = 20
+L = CELL_SIZE / NSUBDIVS
+
+
+def spiral_sheet(n, rng, center=(40, 40), turns=6, z_range=(60, 75)):
+  t = rng.uniform(0, 1, n)
+  r = 2 + 30*t
+  a = 2*np.pi*turns*t
+  z = rng.uniform(*z_range, n)
+  return np.stack([center[0] + r*np.cos(a), center[1] + r*np.sin(a), z], axis=1)
+
+def synthetic_patches(segment, n, rng, vertices_per_patch=500):
+  patches = []
+  for i in range(n):
+    p = segment[rng.integers(len(segment))]
+    if i % 2:
+      p = p + rng.normal(0, 1.5, 3) # Mostly off the sheet.
+    patches.append(p + rng.normal(0, 0.1, (vertices_per_patch, 3)))
+  return patches
+
+
+# The loops from before vesuvius.masks, over numpy rows instead of mathutils
+# vectors. Like SegmentMask.touches, touches_loop looks each vertex up in the
+# mask of the cell it falls in, rather than in the mask of the patch's cell.
+
+def cell_index(p):
+  return (int(p[0] // CELL_SIZE), int(p[1] // CELL_SIZE), int(p[2] // CELL_SIZE))
+
+def mask_index(j, p):
+  return tuple(int((p[i] - j[i]*CELL_SIZE)//L) for i in range(3))
+
+def make_segment_masks_loop(points):
+  segment_masks = {}
+  for p in points:
+    jp = cell_index(p)
+    if jp not in segment_masks:
+      segment_masks[jp] = np.zeros((NSUBDIVS, NSUBDIVS, NSUBDIVS), dtype=bool)
+    segment_masks[jp][mask_index(jp, p)] = True
+  return segment_masks
+
+def touches_loop(segment_masks, points):
+  for p in points:
+    j = cell_index(p)
+    mask = segment_masks.get(j)
+    if mask is not None and mask[mask_index(j, p)]:
+      return True
+  return False
+
+
+def timed(f, *args):
+  t0 = time.time()
+  result = f(*args)
+  return result, time.time() - t0
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark building segment masks and testing patches against them.")
+  parser.add_argument("--vertices", type=int, default=2_000_000)
+  parser.add_argument("--patches", type=int, default=2000)
+  parser.add_argument("--loop-vertices", type=int, default=200_000)
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  segment = spiral_sheet(args.vertices, rng)
+  patches = synthetic_patches(segment, args.patches, rng)
+
+  mask, t_build = timed(vesuvius.masks.SegmentMask, segment)
+  hits, t_touch = timed(lambda: [mask.touches(p) for p in patches])
+  print(f"vectorized: {args.vertices} vertices, {len(mask)} cells: masks {t_build:.2f} s., {args.patches} patches {t_touch:.2f} s. ({sum(hits)} touch)")
+
+  n = min(args.vertices, args.loop_vertices)
+  small_mask = vesuvius.masks.SegmentMask(segment[:n])
+  masks, t_build_loop = timed(make_segment_masks_loop, segment[:n])
+  loop_hits, t_touch_loop = timed(lambda: [touches_loop(masks, p) for p in patches])
+  assert small_mask.cell_set() == set(masks), "cells differ"
+  assert all((small_mask[j] == m).all() for j, m in masks.items()), "masks differ"
+  assert [small_mask.touches(p) for p in patches] == loop_hits, "patch tests differ"
+  print(f"loops: {n} vertices, {len(masks)} cells: masks {t_build_loop:.2f} s., {args.patches} patches {t_touch_loop:.2f} s. ({sum(loop_hits)} touch)")
+  print(f"masks speedup: {(t_build_loop/n)/(t_build/args.vertices):.0f}x per vertex")
+
+
+if __name__ == "__main__":
+  main()
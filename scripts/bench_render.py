@@ -0,0 +1,210 @@
+# Render benchmark for the vesuvius_scan OSL material.
+#
+# Usage:
+#   blender -b --python scripts/bench_render.py -- --data-dir /path/to/data \
+#     --scan scroll_1a_791_54 --cell 7,7,14 --out bench_$(git rev-parse --short HEAD).json
+#   blender -b --python scripts/bench_render.py -- ... --compare bench_old.json
+#
+# Builds one scene per configuration (scan quads with the small volume, cell
+# quads with hi-res windows of different sizes, different nmerge_samples), renders
+# it from a fixed camera on CPU Cycles and records the wall time, samples/s and
+# peak memory of each render in a JSON report. The grid cells around --cell and
+# the scan's _small.tif must be in the data directory, and cell_r1_lod needs
+# their pyramids ("Build grid cell pyramids" with the cursor in --cell). The
+# _vdb configurations render the same cells as OpenVDB volumes sliced through
+# the same planes as the cell quads, for comparison with the OSL ones; they
+# export the cells on first use, which needs blender's openvdb module.
+#
+# The first render of each configuration is reported as the cold time and the
+# best of the rest as the warm time. Textures loaded by earlier configurations
+# stay in OIIO's cache, so for cold numbers run one configuration per process
+# (--configs), with --drop-caches to empty the OS page cache too (Linux, root).
+# To compare the tiled conversions (python -m vesuvius.convert) with the
+# original files, run once as is and once with --no-tiled.
+
+import argparse, json, os, re, resource, subprocess, sys, time
+import addon_utils
+import bpy
+from mathutils import Vector
+
+addon_utils.enable("vesuvius", default_set=True)
+import vesuvius.vesuvius as vv
+
+
+CONFIGS = [
+  {"name": "scan_small", "quads": "scan", "window": None, "nmerge_samples": 3},
+  {"name": "cell_r0", "quads": "cell", "window": 0, "nmerge_samples": 3},
+  {"name": "cell_r1", "quads": "cell", "window": 1, "nmerge_samples": 3},
+  {"name": "cell_r1_nmerge1", "quads": "cell", "window": 1, "nmerge_samples": 1},
+  {"name": "cell_r1_nmerge6", "quads": "cell", "window": 1, "nmerge_samples": 6},
+  {"name": "cell_r1_lod", "quads": "cell", "window": 1, "nmerge_samples": 3, "lod_levels": 2},
+  {"name": "cell_r0_vdb", "quads": "vdb", "window": 0, "nmerge_samples": 3},
+  {"name": "cell_r1_vdb", "quads": "vdb", "window": 1, "nmerge_samples": 3},
+]
+
+
+def reset_scene():
+  for collection in (bpy.data.objects, bpy.data.meshes, bpy.data.volumes, bpy.data.cameras, bpy.data.materials, bpy.data.texts):
+    for item in list(collection):
+      collection.remove(item)
+  vv.set_current_scan(None)
+
+
+def look_at(target, eye):
+  fwd = (target - eye).normalized()
+  z = Vector((0, 0, 1))
+  up = (z - fwd * z.dot(fwd)).normalized()
+  vv.create_camera(eye, fwd, up, name="BenchCamera")
+  bpy.context.scene.camera = bpy.data.objects["BenchCamera"]
+
+
+def build_scene(scan, cell, config, args):
+  reset_scene()
+  scene = bpy.context.scene
+  vv.set_current_scan(scan)
+  vv.setup_scene(scene, preview_samples=args.samples)
+  scene.cycles.device = "CPU"
+  scene.cycles.samples = args.samples
+  scene.cycles.use_denoising = False
+  scene.render.resolution_x = args.resolution
+  scene.render.resolution_y = args.resolution
+  scene.render.resolution_percentage = 100
+  material = vv.setup_material(scan)
+  script = material.node_tree.nodes["Script"]
+  script.inputs["nmerge_samples"].default_value = config["nmerge_samples"]
+  script.inputs["lod_levels"].default_value = config.get("lod_levels", 0)
+  center = Vector((5*cell[0] + 2.5, 5*cell[1] + 2.5, 5*cell[2] + 2.5))
+  if config["quads"] == "scan":
+    vv.create_scan_quads(scan, material)
+    dims = Vector((scan.width, scan.height, scan.slices)) / 100
+    look_at(dims / 2, dims / 2 + Vector((1, -1, 0.75)) * max(dims))
+  elif config["quads"] == "vdb":
+    r = config["window"]
+    # Slice through the corner of the cell, where its quads are.
+    volume_material = vv.setup_volume_material(scan, Vector([5*j for j in cell]))
+    for c in vv.focus_window_cells(scan, cell, center, radius=r):
+      vv.import_cell_volume(scan, c, volume_material)
+    look_at(center, center + Vector((1, -1, 0.75)) * 5 * (2*r + 2))
+  else:
+    r = config["window"] or 0
+    for jz in range(cell[2] - r, cell[2] + r + 1):
+      for jy in range(cell[1] - r, cell[1] + r + 1):
+        for jx in range(cell[0] - r, cell[0] + r + 1):
+          if scan.grid_cell_in_bounds(jx, jy, jz):
+            vv.create_cell_quads((jx, jy, jz), material)
+    look_at(center, center + Vector((1, -1, 0.75)) * 5 * (2*r + 2))
+  if config["window"] is None:
+    script.inputs["disable_hires"].default_value = 1
+  else:
+    r = config["window"]
+    vv.set_focus_cells(scan, vv.focus_window_cells(scan, cell, center, radius=r))
+  # Compile the shader variant for the configuration's parameters.
+  vv.reload_shader(scan)
+  if args.no_tiled:
+    vv.update_shader_text(script.script, vv.generate_shader(scan, **vv.shader_variant(material), prefer_tiled=False))
+
+
+_peak_mem_mb = 0
+def render_stats(stats):
+  global _peak_mem_mb
+  m = re.search(r"Peak[: ]+([0-9.]+)([MG])", stats)
+  if m:
+    peak = float(m.group(1)) * (1024 if m.group(2) == "G" else 1)
+    _peak_mem_mb = max(_peak_mem_mb, peak)
+
+
+def render(args):
+  global _peak_mem_mb
+  _peak_mem_mb = 0
+  t0 = time.perf_counter()
+  bpy.ops.render.render(write_still=False)
+  t = time.perf_counter() - t0
+  return {
+    "time_s": t,
+    "samples_per_s": args.resolution**2 * args.samples / t,
+    "peak_mem_mb": _peak_mem_mb,
+  }
+
+
+def drop_caches():
+  os.sync()
+  with open("/proc/sys/vm/drop_caches", "w") as f:
+    f.write("3\n")
+
+
+def git_commit():
+  repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+  except OSError:
+    return None
+
+
+def compare(report, old_report):
+  old_results = {r["name"]: r for r in old_report["results"]}
+  print(f"{'config':24} {'':>5} {'old (s)':>10} {'new (s)':>10} {'speedup':>8}")
+  for r in report["results"]:
+    old = old_results.get(r["name"])
+    if old:
+      for key in ("cold", "warm"):
+        t_old, t_new = old[f"{key}_time_s"], r[f"{key}_time_s"]
+        print(f"{r['name']:24} {key:>5} {t_old:10.3f} {t_new:10.3f} {t_old/t_new:8.2f}")
+
+
+def main(args):
+  bpy.context.preferences.addons["vesuvius"].preferences.data_dir = args.data_dir
+  scan = vv.SCANS[args.scan]
+  cell = tuple(int(x) for x in args.cell.split(","))
+  configs = [c for c in CONFIGS if not args.configs or c["name"] in args.configs]
+  bpy.app.handlers.render_stats.append(render_stats)
+
+  results = []
+  for config in configs:
+    print(f"Benchmarking {config['name']}...")
+    build_scene(scan, cell, config, args)
+    if args.drop_caches:
+      drop_caches()
+    runs = [render(args) for _ in range(max(args.repeat, 2))]
+    best = min(runs[1:], key=lambda run: run["time_s"])
+    results.append({
+      **config, **best, "runs": runs,
+      "cold_time_s": runs[0]["time_s"], "warm_time_s": best["time_s"],
+      "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    print(f"  cold {runs[0]['time_s']:.3f} s. | warm {best['time_s']:.3f} s. | {best['samples_per_s']:.0f} samples/s | peak {best['peak_mem_mb']:.0f} MB")
+
+  report = {
+    "commit": git_commit(),
+    "blender": bpy.app.version_string,
+    "scan": args.scan,
+    "cell": cell,
+    "resolution": args.resolution,
+    "samples": args.samples,
+    "tiled": not args.no_tiled,
+    "results": results,
+  }
+  if args.out:
+    with open(args.out, "w") as f:
+      json.dump(report, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+  if "--" not in sys.argv:
+    print(f"Usage: blender -b --python {sys.argv[0]} -- <args>")
+    exit(1)
+  parser = argparse.ArgumentParser(prog="bench_render.py")
+  parser.add_argument("--data-dir", required=True)
+  parser.add_argument("--scan", default="scroll_1a_791_54")
+  parser.add_argument("--cell", default="7,7,14", help="jx,jy,jz of the grid cell to center on, 0-indexed")
+  parser.add_argument("--configs", nargs="*", help="names of the configurations to run, all by default")
+  parser.add_argument("--resolution", type=int, default=512)
+  parser.add_argument("--samples", type=int, default=4)
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--no-tiled", action="store_true", help="render from the original files even if there are tiled conversions")
+  parser.add_argument("--drop-caches", action="store_true", help="drop the OS page cache before the first render of each configuration")
+  parser.add_argument("--out")
+  parser.add_argument("--compare")
+  main(parser.parse_args(sys.argv[sys.argv.index("--")+1:]))
@@ -1,7 +1,6 @@
 # Usage:
-# for z in $(seq -w 13 20); do
-#   JZ=$z blender-3.6 -b segmentation_template.blend --python scripts/build_layer_holes.py
-# done
+# python -m vesuvius.batch scripts/build_layer_holes.py --layers 13-20 \
+#   --blender blender-3.6 --blend segmentation_template.blend
 
 import os
 import sys
@@ -1,19 +1,105 @@
 # Usage:
-# for z in $(seq -w 13 20); do
-#   tmux new -d -s "z${z}" "blender -b patches/patches_z${z}.blend --python vesuvius-blender/scripts/build_layer_patches.py"
-# done
+# python -m vesuvius.batch vesuvius-blender/scripts/build_layer_patches.py --layers 13-20 \
+#   --blend 'patches/patches_z{z:02d}.blend'
+#
+# Splits the holes of each cell of the layer into sheets. By default each
+# cell's sheets are written to their own file in patches_zNN.journal/ next to
+# the layer file as soon as the cell is done, and recorded in its manifest.json,
+# so a killed run picks up from the cell it was on when run again. The layer
+# file is assembled from the journal and saved once at the end. With JOURNAL=0
+# the whole layer file is saved after every cell instead, like it used to.
 
-for z in $(seq -w 1 26); do
-  tmux new -d -s "z${z}" ""
-done
-
-import gc, time
+import gc, json, os, shutil, time
+from pathlib import Path
 import bpy
 import vesuvius.segmentation
 import vesuvius.utils
 
 
-def main():
+def journal_dir():
+  return Path(bpy.data.filepath).with_suffix(".journal")
+
+def read_manifest(d):
+  filepath = d / "manifest.json"
+  return json.loads(filepath.read_text()) if filepath.is_file() else {}
+
+def write_manifest(d, manifest):
+  tmp_filepath = d / "manifest.json.tmp"
+  tmp_filepath.write_text(json.dumps(manifest, indent=2))
+  os.replace(tmp_filepath, d / "manifest.json")
+
+def journal_cell(d, col):
+  filepath = d / f"{col.name}.blend"
+  tmp_filepath = d / f"{col.name}.tmp.blend"
+  bpy.data.libraries.write(str(tmp_filepath), set(col.objects), fake_user=True)
+  os.replace(tmp_filepath, filepath)
+
+# Replaces the objects of the cell collections done in the journal with the
+# journaled ones.
+def merge_journal(d, manifest, cell_collections):
+  for col in cell_collections:
+    if col.name not in manifest:
+      continue
+    vesuvius.utils.remove_objects(col.objects)
+    filepath = d / f"{col.name}.blend"
+    if not filepath.is_file():
+      continue
+    with bpy.data.libraries.load(str(filepath), link=False) as (data_from, data_to):
+      data_to.objects = data_from.objects
+    for obj in data_to.objects:
+      if obj is not None:
+        obj.use_fake_user = False
+        col.objects.link(obj)
+
+def index_layer():
+  t_index_start = time.time()
+  n_patches = vesuvius.utils.index_open_layer_file()
+  print(f"Indexed {n_patches} patches. ({time.time() - t_index_start:.2f} s.)")
+  t_occupancy_start = time.time()
+  vesuvius.utils.write_open_layer_occupancy()
+  print(f"Wrote patch occupancy. ({time.time() - t_occupancy_start:.2f} s.)")
+
+
+def main_journaled():
+  cell_collections = vesuvius.utils.get_cell_collections()
+  d = journal_dir()
+  d.mkdir(exist_ok=True)
+  manifest = read_manifest(d)
+  if manifest:
+    print(f"Resuming, {len(manifest)} cell collections already done.")
+
+  n_collections = len(cell_collections)
+  for (i, col) in enumerate(cell_collections):
+    if col.name in manifest:
+      # Free the unsplit holes, the merge replaces them.
+      vesuvius.utils.remove_objects(col.objects)
+      continue
+    print(f"Processing cell collection {col.name} ({i}/{n_collections})...")
+    t_split_start = time.time()
+    n_split = vesuvius.segmentation.split_holes(bpy.context, col.objects)
+    t_journal_start = time.time()
+    n_objects = len(col.objects)
+    if n_objects > 0:
+      journal_cell(d, col)
+    t_split = t_journal_start - t_split_start
+    t_journal = time.time() - t_journal_start
+    manifest[col.name] = {"n_split": n_split, "n_objects": n_objects, "t_split": round(t_split, 2), "t_journal": round(t_journal, 2)}
+    write_manifest(d, manifest)
+    # Journaled, so they can go until the merge.
+    vesuvius.utils.remove_objects(col.objects)
+    print(f"t_split = {t_split:.2f} s. | t_journal = {t_journal:.2f} s. | t = {t_split + t_journal:.2f} s.")
+
+  print("Merging the journal...")
+  t_merge_start = time.time()
+  merge_journal(d, manifest, cell_collections)
+  bpy.ops.wm.save_mainfile()
+  print(f"t_merge = {time.time() - t_merge_start:.2f} s.")
+  index_layer()
+  shutil.rmtree(d)
+  print("Done.")
+
+
+def main_resave():
   cell_collections = vesuvius.utils.get_cell_collections()
 
   t0 = time.time()
@@ -36,12 +122,16 @@ def main():
       t_cleanup = time.time() - t_cleanup_start
       print(f"t_cleanup = {t_cleanup:.2f} s.")
     print(f"Done processing cell collection {col.name}")
+  index_layer()
   print("Done.")
 
 
 if __name__ == "__main__":
   bpy.context.preferences.edit.use_global_undo = False
   try:
-    main()
+    if os.environ.get("JOURNAL", "1") == "0":
+      main_resave()
+    else:
+      main_journaled()
   finally:
     bpy.context.preferences.edit.use_global_undo = True
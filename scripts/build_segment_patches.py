@@ -2,6 +2,8 @@ import os, sys
 from pathlib import Path
 import bpy
 import numpy as np
+import vesuvius.masks
+import vesuvius.utils
 
 
 data_dir = Path("/mnt/phil/vesuvius/data")
@@ -11,10 +13,6 @@ segments_dir = volpkg_dir / "paths"
 patches_dir = blender_scroll_dir / "patches"
 blender_segments_dir = blender_scroll_dir / "segments"
 
-CELL_SIZE = 5
-NSUBDIVS = 20
-L = CELL_SIZE / NSUBDIVS
-
 def main(input_file, output_file):
 	assert output_file.endswith(".blend"), "output must be a path to a .blend file to create or overwrite"
 
@@ -36,7 +34,7 @@ def main(input_file, output_file):
 
 	segment_object_name = input_file.split("/")[-1][:-4]
 	segment = bpy.data.objects[segment_object_name]
-	segment_masks = make_segment_masks(segment)
+	segment_mask = vesuvius.masks.SegmentMask(vesuvius.utils.mesh_world_vertices(segment))
 
 	for jz in range(26):
 		layer_patches_path = f"{patches_dir}/patches_z{jz:02d}.blend"
@@ -44,25 +42,25 @@ def main(input_file, output_file):
 			continue
 
 		print(f"Loading layer {jz:02d}")
+		# Only the patches whose occupancy intersects the segment's if the layer
+		# has an occupancy sidecar, else all the patches in the segment's cells.
+		occupancy = vesuvius.masks.load_layer_occupancy(layer_patches_path)
+		candidates = set(occupancy.candidates(segment_mask)) if occupancy else None
 		with bpy.data.libraries.load(layer_patches_path, link=False) as (data_from, data_to):
 			for objname in data_from.objects:
+				if candidates is not None:
+					if objname in candidates:
+						data_to.objects.append(objname)
+					continue
 				j = object_cell(objname)
-				if j and j in segment_masks:
+				if j and j in segment_mask:
 					data_to.objects.append(objname)
 
 		for obj in data_to.objects:
 			if obj is not None:
-				j = object_cell(obj.name)
-				mask = segment_masks[j]
-				touches_segment_mask = False
-				for v in obj.data.vertices:
-					p = obj.matrix_world @ v.co
-					ix, iy, iz = mask_index(j, p)
-					if mask[ix, iy, iz]:
-						bpy.context.collection.objects.link(obj)
-						touches_segment_mask = True
-						break
-				if not touches_segment_mask:
+				if segment_mask.touches(vesuvius.utils.mesh_world_vertices(obj)):
+					bpy.context.collection.objects.link(obj)
+				else:
 					bpy.data.meshes.remove(obj.data)
 
 	bpy.ops.wm.save_as_mainfile(filepath=output_file)
@@ -73,30 +71,6 @@ def object_cell(objname):
 	_, _, jy, jx, jz, *_ = objname.split("_")
 	return (int(jx)-1, int(jy)-1, int(jz)-1)
 
-def cell_index(p):
-	return (
-		int(p.x // CELL_SIZE),
-		int(p.y // CELL_SIZE),
-		int(p.z // CELL_SIZE))
-
-def mask_index(j, p):
-	return (
-		int((p.x - j[0] * CELL_SIZE)//L),
-		int((p.y - j[1] * CELL_SIZE)//L),
-		int((p.z - j[2] * CELL_SIZE)//L))
-
-def make_segment_masks(segment):
-	segment_masks = {}
-	for v in segment.data.vertices:
-		p = segment.matrix_world @ v.co
-		jp = cell_index(p)
-		if jp not in segment_masks:
-			segment_masks[jp] = np.zeros((NSUBDIVS, NSUBDIVS, NSUBDIVS), dtype=np.bool8)
-		mask = segment_masks[jp]
-		ix, iy, iz = mask_index(jp, p)
-		mask[ix, iy, iz] = True
-	return segment_masks
-
 
 if __name__ == "__main__":
 	if "--" not in sys.argv:
@@ -0,0 +1,26 @@
+# Writes the patches of a layer file to the patch index next to it (see
+# vesuvius/patchindex.py), and its occupancy sidecar (see vesuvius/masks.py).
+# build_layer_patches.py does this when it's done with a layer; this is for
+# layer files built before it did.
+#
+# Usage:
+# python -m vesuvius.batch vesuvius-blender/scripts/index_layer_patches.py --layers 1-26 \
+#   --blend 'patches/patches_z{z:02d}.blend'
+
+import time
+import bpy
+import vesuvius.utils
+
+
+def main():
+  t0 = time.time()
+  n_patches = vesuvius.utils.index_open_layer_file()
+  t = time.time() - t0
+  print(f"Indexed {n_patches} patches. ({t:.2f} s.)")
+  t0 = time.time()
+  vesuvius.utils.write_open_layer_occupancy()
+  print(f"Wrote patch occupancy. ({time.time() - t0:.2f} s.)")
+
+
+if __name__ == "__main__":
+  main()
@@ -1,34 +1,39 @@
-import gc, time, json, os
-import bpy
-import vesuvius.utils
+# Writes the histograms of the patches' vertex counts of a layer, from the patch
+# index (see vesuvius/patchindex.py), without opening the layer file.
+#
+# Usage:
+# JZ=13 python vesuvius-blender/scripts/patches_histogram.py patches/patches.sqlite
+# python -m vesuvius.batch vesuvius-blender/scripts/patches_histogram.py --layers 1-26 \
+#   --no-blender -- patches/patches.sqlite
 
-def main():
-  collections = vesuvius.utils.get_cell_collections()
-  vert_count_histogram = [0 for _ in range(500)]
-  vert_count_histograms_per_cell = {}
+import sys, time, json, os
+import vesuvius.patchindex
+
+N_BINS = 500
+
+def histogram_list(histogram):
+  counts = [0 for _ in range(N_BINS)]
+  for b, count in histogram.items():
+    counts[min(b, N_BINS - 1)] += count
+  return counts
+
+def main(index_file):
+  jz = int(os.environ.get("JZ", "0"))
   t0 = time.time()
-  n_collections = len(collections)
-  for (i, col) in enumerate(collections):
-    cell_vert_count_histogram = [0 for _ in range(500)]
-    vert_count_histograms_per_cell[col.name] = cell_vert_count_histogram
-    for obj in col.objects:
-      vert_count_histogram[len(obj.data.vertices) // 100] += 1
-      cell_vert_count_histogram[len(obj.data.vertices) // 100] += 1
+  db = vesuvius.patchindex.open_patch_index(index_file)
+  histogram = vesuvius.patchindex.vertex_count_histogram(db, 100, layer=jz)
+  histograms_per_cell = vesuvius.patchindex.vertex_count_histograms_per_cell(db, 100, layer=jz)
   result = {
-    "vert_count_histogram": vert_count_histogram,
-    "vert_count_histograms_per_cell": vert_count_histograms_per_cell,
+    "vert_count_histogram": histogram_list(histogram),
+    "vert_count_histograms_per_cell": {
+      f"cell_yxz_{cy+1:03}_{cx+1:03}_{cz+1:03}": histogram_list(h)
+      for (cx, cy, cz), h in histograms_per_cell.items() if cx is not None
+    },
   }
-
-  jz = int(os.environ.get("JZ", "0"))
   with open(f"vert_count_histograms_{jz:02d}.json", "w+") as f:
     json.dump(result, f)
   t = time.time() - t0
   print(f"Done. ({t} s.)")
 
 if __name__ == "__main__":
-  bpy.context.preferences.edit.use_global_undo = False
-  try:
-    main()
-  finally:
-    bpy.context.preferences.edit.use_global_undo = True
-
+  main(sys.argv[1])
@@ -5,7 +5,17 @@ bl_info = {
 }
 
 
-if "vesuvius" not in locals():
+try:
+	import bpy
+except ImportError:
+	# Imported outside of blender, to run one of the modules that don't need it,
+	# like python -m vesuvius.convert.
+	bpy = None
+
+
+if bpy is None:
+	pass
+elif "vesuvius" not in locals():
 	from . import vesuvius
 	from . import segmentation
 	from . import select_intersect_active
@@ -13,13 +23,39 @@ if "vesuvius" not in locals():
 	from . import radial_views
 	from . import graph
 	from . import shaders
+	from . import tiff
 	from . import data
+	from . import cache
+	from . import sampler
+	from . import bake
+	from . import pyramids
+	from . import convert
+	from . import vdb
+	from . import stl
+	from . import pool
+	from . import meshcache
+	from . import patchindex
+	from . import masks
+	from . import batch
 	from . import utils
 else:
 	print("Reloading vesuvius...")
 	import importlib
+	importlib.reload(stl)
+	importlib.reload(pool)
+	importlib.reload(meshcache)
+	importlib.reload(patchindex)
+	importlib.reload(masks)
+	importlib.reload(batch)
 	importlib.reload(utils)
+	importlib.reload(tiff)
+	importlib.reload(sampler)
+	importlib.reload(pyramids)
+	importlib.reload(convert)
+	importlib.reload(vdb)
 	importlib.reload(data)
+	importlib.reload(cache)
+	importlib.reload(bake)
 	importlib.reload(shaders)
 	importlib.reload(graph)
 	importlib.reload(radial_views)
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .tiff import *
+
+
+# Baking scan intensities into a segment's UV layout, on the CPU, without
+# Cycles. Each texel gets the world position and normal of the surface point
+# its UV maps to, and is sampled with the VolumeSampler at the same offsets
+# along the normal as the vesuvius_scan shader (nmerge_samples of them), with
+# the same r, g, b averages as generate_nmerge_samples. The texture is an uncompressed 16 bit RGB TIFF created empty on disk
+# and filled tile by tile through a memory map by a pool of threads, so only
+# the tiles being worked on are in memory.
+
+BAKE_TILE_SIZE = 256
+
+
+# Triangle data of a mesh object in world space: positions and normals (T x 3
+# x 3) and UVs (T x 3 x 2).
+def mesh_triangles(obj):
+	mesh = obj.data
+	mesh.calc_loop_triangles()
+	n_tris = len(mesh.loop_triangles)
+	tri_verts = np.empty(n_tris*3, dtype=np.int32)
+	tri_loops = np.empty(n_tris*3, dtype=np.int32)
+	mesh.loop_triangles.foreach_get("vertices", tri_verts)
+	mesh.loop_triangles.foreach_get("loops", tri_loops)
+	co = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+	normals = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+	mesh.vertices.foreach_get("co", co)
+	mesh.vertices.foreach_get("normal", normals)
+	uv = np.empty(len(mesh.loops)*2, dtype=np.float32)
+	mesh.uv_layers.active.data.foreach_get("uv", uv)
+
+	m = np.array(obj.matrix_world, dtype=np.float64)
+	co = co.reshape(-1, 3) @ m[:3, :3].T + m[:3, 3]
+	normals = normals.reshape(-1, 3) @ np.linalg.inv(m[:3, :3])
+	normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+	co, normals = co.astype(np.float32), normals.astype(np.float32)
+	tri_verts = tri_verts.reshape(-1, 3)
+	return co[tri_verts], normals[tri_verts], uv.reshape(-1, 2)[tri_loops.reshape(-1, 3)]
+
+
+# Texels covered by triangles (pixel space UVs, T x 3 x 2) within the tile
+# [x0, x1) x [y0, y1). Returns the triangle index, pixel x and y, and the
+# barycentric coordinates (N x 3) of each covered texel center.
+def rasterize(tri_uv, x0, y0, x1, y1):
+	lo = np.floor(tri_uv.min(axis=1) - 0.5).astype(np.int64) + 1
+	hi = np.floor(tri_uv.max(axis=1) - 0.5).astype(np.int64) + 1
+	ix0, iy0 = np.maximum(lo[:, 0], x0), np.maximum(lo[:, 1], y0)
+	ix1, iy1 = np.minimum(hi[:, 0], x1), np.minimum(hi[:, 1], y1)
+	w, h = np.maximum(ix1 - ix0, 0), np.maximum(iy1 - iy0, 0)
+	n = w*h
+	tri = np.repeat(np.arange(len(tri_uv)), n)
+	k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+	px = ix0[tri] + k % w[tri]
+	py = iy0[tri] + k // w[tri]
+
+	a, b, c = tri_uv[tri, 0], tri_uv[tri, 1], tri_uv[tri, 2]
+	qx, qy = px + 0.5, py + 0.5
+	det = (b[:, 1] - c[:, 1])*(a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0])*(a[:, 1] - c[:, 1])
+	det = np.where(np.abs(det) < 1e-12, 1e-12, det)
+	l0 = ((b[:, 1] - c[:, 1])*(qx - c[:, 0]) + (c[:, 0] - b[:, 0])*(qy - c[:, 1])) / det
+	l1 = ((c[:, 1] - a[:, 1])*(qx - c[:, 0]) + (a[:, 0] - c[:, 0])*(qy - c[:, 1])) / det
+	l2 = 1 - l0 - l1
+	eps = -1e-6
+	inside = (l0 >= eps) & (l1 >= eps) & (l2 >= eps)
+	bary = np.stack([l0, l1, l2], axis=1)[inside]
+	return tri[inside], px[inside], py[inside], bary
+
+
+# The triangles overlapping each tile, as {(tile_x, tile_y): triangle indices}.
+def bin_triangles(tri_uv, tile_size, tiles_across, tiles_down):
+	lo = np.clip(np.floor(tri_uv.min(axis=1) / tile_size).astype(np.int64), 0, [tiles_across - 1, tiles_down - 1])
+	hi = np.clip(np.floor(tri_uv.max(axis=1) / tile_size).astype(np.int64), 0, [tiles_across - 1, tiles_down - 1])
+	w = hi[:, 0] - lo[:, 0] + 1
+	n = w*(hi[:, 1] - lo[:, 1] + 1)
+	tri = np.repeat(np.arange(len(tri_uv)), n)
+	k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+	tile = (lo[tri, 1] + k // w[tri])*tiles_across + lo[tri, 0] + k % w[tri]
+	order = np.argsort(tile, kind="stable")
+	tri, tile = tri[order], tile[order]
+	starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]])
+	ends = np.r_[starts[1:], len(tile)]
+	return {(tile[s] % tiles_across, tile[s] // tiles_across): tri[s:e] for s, e in zip(starts, ends)}
+
+
+# offset and nmerge_step are in blender units, like in the shader after dividing
+# the _um parameters by the scan resolution.
+def bake_tile(sampler, out, tris, tri_co, tri_n, tri_uv, x0, y0, x1, y1, offset, nmerge_step, nmerge_samples=3):
+	tri, px, py, bary = rasterize(tri_uv[tris], x0, y0, x1, y1)
+	if len(tri) == 0:
+		return
+	tri = tris[tri]
+	p = np.einsum("ni,nij->nj", bary, tri_co[tri])
+	n = np.einsum("ni,nij->nj", bary, tri_n[tri])
+	n /= np.maximum(np.linalg.norm(n, axis=1, keepdims=True), 1e-12)
+	nmerge_samples = max(1, int(nmerge_samples))
+	value = 0
+	channels = []
+	for i in range(nmerge_samples):
+		value = value + sampler.measure(p - (offset + i*nmerge_step)*n)
+		if nmerge_samples <= 3:
+			channels.append(value/(i + 1))
+	channels += [value/nmerge_samples]*(3 - len(channels))
+	rgb = np.clip(np.stack(channels, axis=1), 0, 1)
+	# UV v goes up, image rows go down.
+	out[out.shape[0] - 1 - py, px] = (rgb * 65535).astype(np.uint16)
+
+
+def bake_segment(obj, sampler, filepath, size, offset, nmerge_step, nmerge_samples=3, tile_size=BAKE_TILE_SIZE, workers=None):
+	tri_co, tri_n, tri_uv = mesh_triangles(obj)
+	tri_uv = tri_uv * size
+	page, = create_tiff(filepath, [TiffPageLayout(size, size, "u2", 3)])
+	out = page_array(filepath, page)
+	tiles_across = tiles_down = -(-size // tile_size)
+	bins = bin_triangles(tri_uv, tile_size, tiles_across, tiles_down)
+
+	def bake(item):
+		(tx, ty), tris = item
+		x0, y0 = tx*tile_size, ty*tile_size
+		bake_tile(sampler, out, tris, tri_co, tri_n, tri_uv, x0, y0, min(x0 + tile_size, size), min(y0 + tile_size, size), offset, nmerge_step, nmerge_samples)
+
+	with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+		for i, _ in enumerate(executor.map(bake, bins.items())):
+			if i % 64 == 0:
+				print(f"Baked {i}/{len(bins)} tiles of {obj.name}...")
+	out.flush()
+	del out
+	print(f"Baked {obj.name} to {filepath}")
+	return filepath
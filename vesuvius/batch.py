@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+
+# Runs one of the per-layer scripts (scripts/build_layer_holes.py and friends)
+# over many layers, a headless blender per layer, with JZ set to the layer in
+# its environment like the scripts expect:
+#
+#   python -m vesuvius.batch scripts/build_layer_patches.py --layers 1-26 -j 4 \
+#     --blend 'patches/patches_z{z:02d}.blend'
+#
+# Jobs run at most -j at a time, by default as many as fit in the cores and in
+# the RAM at --mem-gb each. Each job's output goes to its own log file under
+# --logs, failed jobs are retried, and a JSON summary with the outcome and time
+# of each job is written at the end. Scripts that don't need blender, like
+# patches_histogram.py, run with --no-blender. Arguments after -- are passed on
+# to the script.
+#
+# Blender exits with 0 when a --python script raises unless told otherwise, so
+# jobs run with --python-exit-code, and a job whose log has a Python traceback
+# counts as failed too.
+
+BATCH_MEM_GB = 8
+
+
+def parse_layers(spec):
+	layers = []
+	for part in spec.split(","):
+		a, _, b = part.partition("-")
+		layers += range(int(a), int(b or a) + 1)
+	return sorted(set(layers))
+
+
+def total_memory():
+	try:
+		return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+	except (ValueError, OSError, AttributeError):
+		return None
+
+
+# How many jobs run at once: jobs if given, else as many as there are cores
+# and as fit in memory at mem_gb each.
+def batch_concurrency(jobs=None, mem_gb=BATCH_MEM_GB):
+	if jobs:
+		return jobs
+	n = os.cpu_count() or 1
+	memory = total_memory()
+	if memory and mem_gb > 0:
+		n = min(n, int(memory // (mem_gb * 1e9)))
+	return max(n, 1)
+
+
+def job_command(script, z, blender="blender", blend=None, script_args=(), use_blender=True):
+	if not use_blender:
+		return [sys.executable, script, *script_args]
+	command = [blender, "-b"]
+	if blend:
+		command.append(blend.format(z=z))
+	command += ["--python-exit-code", "1", "--python", script]
+	if script_args:
+		command += ["--", *script_args]
+	return command
+
+
+def log_has_traceback(log_filepath, offset=0):
+	with open(log_filepath, "rb") as f:
+		f.seek(offset)
+		return b"Traceback (most recent call last)" in f.read()
+
+
+class Batch:
+	def __init__(self, script, layers, logs_dir, retries=1, **command_options):
+		self.script = script
+		self.layers = layers
+		self.logs_dir = Path(logs_dir)
+		self.retries = retries
+		self.command_options = command_options
+		self.lock = threading.Lock()
+		self.processes = set()
+		self.stopped = False
+
+	def log_filepath(self, z):
+		return self.logs_dir / f"{Path(self.script).stem}_z{z:02d}.log"
+
+	# Runs the job of layer z, retrying it when it fails. Returns its summary.
+	def run_job(self, z):
+		command = job_command(self.script, z, **self.command_options)
+		env = dict(os.environ, JZ=str(z))
+		log_filepath = self.log_filepath(z)
+		attempts = []
+		with open(log_filepath, "w") as log:
+			for attempt in range(1 + self.retries):
+				log.write(f"### Attempt {attempt + 1}: {' '.join(command)}\n")
+				log.flush()
+				log_offset = log.tell()
+				t0 = time.time()
+				with self.lock:
+					if self.stopped:
+						break
+					process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+					self.processes.add(process)
+				returncode = process.wait()
+				with self.lock:
+					self.processes.discard(process)
+				if returncode == 0 and log_has_traceback(log_filepath, log_offset):
+					returncode = 1
+				attempts.append({"returncode": returncode, "seconds": round(time.time() - t0, 2)})
+				if returncode == 0:
+					break
+		return {
+			"layer": z,
+			"ok": bool(attempts) and attempts[-1]["returncode"] == 0,
+			"attempts": attempts,
+			"seconds": round(sum(a["seconds"] for a in attempts), 2),
+			"log": str(log_filepath),
+		}
+
+	def stop(self):
+		with self.lock:
+			self.stopped = True
+			for process in self.processes:
+				process.terminate()
+
+	def run(self, concurrency):
+		self.logs_dir.mkdir(parents=True, exist_ok=True)
+		t0 = time.time()
+		results = []
+		executor = ThreadPoolExecutor(max_workers=concurrency)
+		try:
+			futures = {executor.submit(self.run_job, z): z for z in self.layers}
+			for i, future in enumerate(as_completed(futures)):
+				result = future.result()
+				results.append(result)
+				status = "ok" if result["ok"] else f"FAILED, see {result['log']}"
+				print(f"[{i+1}/{len(futures)}] z{result['layer']:02d} {status} ({result['seconds']:.1f} s., {len(result['attempts'])} attempts, {time.time() - t0:.1f} s. total)")
+		except KeyboardInterrupt:
+			print("Interrupted, stopping the running jobs...")
+			self.stop()
+			raise
+		finally:
+			executor.shutdown(wait=True, cancel_futures=True)
+		return {
+			"script": self.script,
+			"layers": self.layers,
+			"concurrency": concurrency,
+			"seconds": round(time.time() - t0, 2),
+			"n_ok": sum(r["ok"] for r in results),
+			"n_failed": sum(not r["ok"] for r in results),
+			"jobs": sorted(results, key=lambda r: r["layer"]),
+		}
+
+
+def main():
+	argv = sys.argv[1:]
+	script_args = []
+	if "--" in argv:
+		i = argv.index("--")
+		argv, script_args = argv[:i], argv[i+1:]
+	parser = argparse.ArgumentParser(prog="python -m vesuvius.batch", description="Run a per-layer script over many layers, a headless blender per layer.")
+	parser.add_argument("script")
+	parser.add_argument("--layers", required=True, help="layers to run, like 1-26 or 3,5,10-12; each job gets its layer as JZ")
+	parser.add_argument("-j", "--jobs", type=int, default=None, help="jobs to run at once, by default as many as the cores and the RAM allow")
+	parser.add_argument("--mem-gb", type=float, default=BATCH_MEM_GB, help="memory a job needs, to cap the default number of jobs")
+	parser.add_argument("--blend", default=None, help="blend file to open, with {z} for the layer, like 'patches/patches_z{z:02d}.blend'")
+	parser.add_argument("--blender", default="blender", help="blender executable")
+	parser.add_argument("--no-blender", action="store_true", help="run the script with this python instead of blender")
+	parser.add_argument("--retries", type=int, default=1, help="times to retry a failed job")
+	parser.add_argument("--logs", default="batch_logs", help="directory for the jobs' logs and the summary")
+	parser.add_argument("--summary", default=None, help="summary JSON file, <logs>/<script>_summary.json by default")
+	args = parser.parse_args(argv)
+	layers = parse_layers(args.layers)
+	concurrency = batch_concurrency(args.jobs, args.mem_gb)
+	batch = Batch(args.script, layers, args.logs, retries=args.retries,
+		blender=args.blender, blend=args.blend, script_args=script_args, use_blender=not args.no_blender)
+	print(f"Running {args.script} on {len(layers)} layers, {concurrency} at a time...")
+	summary = batch.run(concurrency)
+	summary_filepath = Path(args.summary or Path(args.logs) / f"{Path(args.script).stem}_summary.json")
+	with open(summary_filepath, "w") as f:
+		json.dump(summary, f, indent=2)
+	print(f"Done: {summary['n_ok']} ok, {summary['n_failed']} failed ({summary['seconds']:.1f} s.). Summary in {summary_filepath}.")
+	sys.exit(1 if summary["n_failed"] else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,91 @@
+import json
+import os
+import time
+
+
+# Grid cells are kept on disk under a byte budget. The access time of each cell
+# is recorded in an index file next to the cells whenever the addon uses it
+# (download, focus), and when the cells take more space than the budget the
+# least recently used ones are deleted, along with their downsampled levels,
+# tiled copies and OpenVDB exports.
+# Cells the index doesn't know about, like ones downloaded by hand, count as
+# used when they were last modified.
+
+CACHE_INDEX_FILENAME = ".vesuvius_cell_cache.json"
+
+
+class CellCache:
+	def __init__(self, scan):
+		self.scan = scan
+		self.dir = scan.volpkg_dir / "volume_grids" / scan.vol_id
+		self.index_filepath = self.dir / CACHE_INDEX_FILENAME
+		self.access_times = self.load()
+
+	def load(self):
+		try:
+			with open(self.index_filepath) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return {}
+
+	def save(self):
+		if not self.dir.is_dir():
+			return
+		tmp_filepath = self.index_filepath.with_name(self.index_filepath.name + ".tmp")
+		with open(tmp_filepath, "w") as f:
+			json.dump(self.access_times, f)
+		os.replace(tmp_filepath, self.index_filepath)
+
+	def touch(self, filenames):
+		t = time.time()
+		for filename in filenames:
+			self.access_times[filename] = t
+		self.save()
+
+	# (filename, size, access_time) for each cell on disk.
+	def cells(self):
+		if not self.dir.is_dir():
+			return []
+		cells = []
+		with os.scandir(self.dir) as it:
+			for entry in it:
+				if not (entry.is_file() and entry.name.startswith("cell_yxz_") and entry.name.endswith(".tif")):
+					continue
+				stat = entry.stat()
+				cells.append((entry.name, stat.st_size, self.access_times.get(entry.name, stat.st_mtime)))
+		return cells
+
+	def size(self):
+		return sum(size for _, size, _ in self.cells())
+
+	def evict(self, budget, pinned=()):
+		cells = sorted(self.cells(), key=lambda cell: cell[2])
+		total = sum(size for _, size, _ in cells)
+		evicted = []
+		for filename, size, _ in cells:
+			if total <= budget:
+				break
+			if filename in pinned:
+				continue
+			os.remove(self.dir / filename)
+			stem = filename.removesuffix(".tif")
+			for copy_dir in self.dir.parent.glob(f"{self.scan.vol_id}_*"):
+				for copy_filepath in copy_dir.glob(f"{stem}[._]*"):
+					os.remove(copy_filepath)
+			self.access_times.pop(filename, None)
+			total -= size
+			evicted.append(filename)
+		for filename in list(self.access_times):
+			if not (self.dir / filename).is_file():
+				del self.access_times[filename]
+		self.save()
+		return evicted
+
+
+_cell_caches = {}
+def get_cell_cache(scan):
+	cache = _cell_caches.get(scan.vol_id)
+	if cache is None or cache.dir != scan.volpkg_dir / "volume_grids" / scan.vol_id:
+		cache = CellCache(scan)
+		_cell_caches[scan.vol_id] = cache
+	return cache
@@ -0,0 +1,148 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .tiff import *
+from .sampler import TiffVolume
+from .pyramids import downsample_page
+
+
+# Converts the grid cells and the small volume of a scan to tiled TIFFs, for the
+# shader. The originals are stacks of single strip pages, so whenever OIIO's
+# texture cache misses it reads a whole 500x500 slice for a few texels. Tiled
+# pages are read in tiles, and each page is followed by its reduced resolution
+# versions, which OIIO reads as the page's mip levels, so zoomed out views
+# filter from small levels. The converted files go to volume_grids/<vol_id>_tiled
+# and volumes_small/<vol_id>_small_tiled.tif, and generate_shader uses them
+# when they are there. Runs outside of blender:
+#
+#   python -m vesuvius.convert /path/to/PHercParis4.volpkg 20230205180739 -j 8
+#
+# Work is split in jobs of a few pages each, so the cells and the pages of the
+# big small volume are converted in parallel across processes alike.
+
+CONVERT_TILE_SIZE = 64
+CONVERT_PAGES_PER_JOB = 32
+TILED_SUFFIX = "_tiled"
+
+
+def tiled_grid_dir(volpkg_dir, vol_id):
+	return Path(volpkg_dir) / "volume_grids" / f"{vol_id}{TILED_SUFFIX}"
+
+def tiled_small_volume_filepath(volpkg_dir, vol_id):
+	return Path(volpkg_dir) / "volumes_small" / f"{vol_id}_small{TILED_SUFFIX}.tif"
+
+
+# Whether filepath is a conversion of src_filepath that is up to date.
+def converted(src_filepath, filepath):
+	return filepath.is_file() and filepath.stat().st_mtime >= src_filepath.stat().st_mtime
+
+
+# The page layouts of the converted file: each full resolution page followed by
+# its mip levels, halving down to a single tile.
+def tiled_layouts(shape, dtype, tile_size, mips=True):
+	depth, height, width = shape
+	levels = [(width, height)]
+	while mips and max(levels[-1]) > tile_size:
+		w, h = levels[-1]
+		levels.append(((w + 1)//2, (h + 1)//2))
+	layouts = []
+	for z in range(depth):
+		for i, (w, h) in enumerate(levels):
+			subfile_type = SUBFILE_REDUCED_IMAGE if i > 0 else 0
+			layouts.append(TiffPageLayout(w, h, dtype, tile=(tile_size, tile_size), subfile_type=subfile_type))
+	return layouts, len(levels)
+
+
+def write_tiled_page(filepath, layout, page):
+	out = page_array(filepath, layout)
+	rows, cols, th, tw, _ = out.shape
+	padded = np.zeros((rows*th, cols*tw), dtype=out.dtype)
+	padded[:page.shape[0], :page.shape[1]] = page
+	out[:, :, :, :, 0] = padded.reshape(rows, th, cols, tw).transpose(0, 2, 1, 3)
+	out.flush()
+
+
+# Converts pages [z0, z1) of src_filepath into the already created dst_filepath.
+# layouts are those of the pages' levels.
+def convert_pages(src_filepath, dst_filepath, layouts, n_levels, z0, z1):
+	volume = TiffVolume(src_filepath)
+	info = np.iinfo(volume.dtype) if volume.dtype.kind in "ui" else None
+	for z in range(z0, z1):
+		page = volume.page(z)
+		write_tiled_page(dst_filepath, layouts[(z - z0)*n_levels], page)
+		page = page.astype(np.float32)
+		for i in range(1, n_levels):
+			page = downsample_page(page)
+			mip = np.clip(np.rint(page), info.min, info.max) if info else page
+			write_tiled_page(dst_filepath, layouts[(z - z0)*n_levels + i], mip)
+	return z1 - z0
+
+
+# Lays out the converted files and yields the jobs that fill them in.
+def plan_conversion(files, tile_size, mips, pages_per_job):
+	for src_filepath, dst_filepath in files:
+		volume = TiffVolume(src_filepath)
+		dtype = volume.dtype.newbyteorder("<").str[1:]
+		layouts, n_levels = tiled_layouts(volume.shape, dtype, tile_size, mips)
+		dst_filepath.parent.mkdir(parents=True, exist_ok=True)
+		tmp_filepath = dst_filepath.with_name(dst_filepath.name + ".tmp")
+		create_tiff(tmp_filepath, layouts)
+		depth = volume.shape[0]
+		jobs = []
+		for z0 in range(0, depth, pages_per_job):
+			z1 = min(z0 + pages_per_job, depth)
+			jobs.append((src_filepath, tmp_filepath, layouts[z0*n_levels:z1*n_levels], n_levels, z0, z1))
+		yield src_filepath, dst_filepath, tmp_filepath, jobs
+
+
+def convert_files(files, tile_size=CONVERT_TILE_SIZE, mips=True, workers=None, pages_per_job=CONVERT_PAGES_PER_JOB):
+	t0 = time.time()
+	with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+		plans = [(dst_filepath, tmp_filepath, [executor.submit(convert_pages, *job) for job in jobs])
+			for _, dst_filepath, tmp_filepath, jobs in plan_conversion(files, tile_size, mips, pages_per_job)]
+		for i, (dst_filepath, tmp_filepath, futures) in enumerate(plans):
+			n_pages = sum(future.result() for future in futures)
+			os.replace(tmp_filepath, dst_filepath)
+			print(f"[{i+1}/{len(plans)}] {dst_filepath.name}: {n_pages} pages ({time.time() - t0:.1f} s.)")
+
+
+# The (source, destination) pairs of a scan's files that need converting.
+def scan_conversions(volpkg_dir, vol_id, cells=True, small=True, force=False):
+	volpkg_dir = Path(volpkg_dir)
+	files = []
+	if small:
+		src_filepath = volpkg_dir / "volumes_small" / f"{vol_id}_small.tif"
+		# Partially downloaded small volumes (see download_tiff_pages) wait.
+		pages_index = src_filepath.with_name(src_filepath.name + ".pages.json")
+		if src_filepath.is_file() and not pages_index.is_file():
+			files.append((src_filepath, tiled_small_volume_filepath(volpkg_dir, vol_id)))
+	if cells:
+		grid_dir = volpkg_dir / "volume_grids" / vol_id
+		for src_filepath in sorted(grid_dir.glob("cell_yxz_*.tif")):
+			files.append((src_filepath, tiled_grid_dir(volpkg_dir, vol_id) / src_filepath.name))
+	return [(src, dst) for src, dst in files if force or not converted(src, dst)]
+
+
+def main():
+	parser = argparse.ArgumentParser(prog="python -m vesuvius.convert", description="Convert a scan's grid cells and small volume to tiled, mip-mapped TIFFs.")
+	parser.add_argument("volpkg_dir")
+	parser.add_argument("vol_id")
+	parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, all cores by default")
+	parser.add_argument("--tile-size", type=int, default=CONVERT_TILE_SIZE)
+	parser.add_argument("--no-mips", action="store_true", help="don't write mip levels")
+	parser.add_argument("--no-cells", action="store_true", help="don't convert the grid cells")
+	parser.add_argument("--no-small", action="store_true", help="don't convert the small volume")
+	parser.add_argument("--force", action="store_true", help="convert files that are already converted")
+	args = parser.parse_args()
+	files = scan_conversions(args.volpkg_dir, args.vol_id, cells=not args.no_cells, small=not args.no_small, force=args.force)
+	print(f"Converting {len(files)} files...")
+	convert_files(files, tile_size=args.tile_size, mips=not args.no_mips, workers=args.jobs)
+
+
+if __name__ == "__main__":
+	main()
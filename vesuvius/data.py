@@ -1,17 +1,42 @@
 from pathlib import Path
 
 import bpy
+import json
+import math
 import os
 import requests
 import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+from .tiff import *
+from .convert import tiled_grid_dir, tiled_small_volume_filepath
+from .vdb import vdb_dir, vdb_filename
+
 
 DATA_URL = "http://dl.ash2txt.org"
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_POLL_INTERVAL = 0.5
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_RETRY_DELAY = 1
+DOWNLOAD_RETRY_STATUSES = (429, 500, 502, 503, 504)
+DATA_AUTH = HTTPBasicAuth('registeredusers', 'only')
+DATA_MAX_CONNECTIONS = 4
+TIFF_BLOCK_SIZE = 1 << 16
+TIFF_PAGES_BATCH = 16
+DATA_THROUGHPUT_WINDOW = 5
+
 
+def get_preferences():
+	return bpy.context.preferences.addons["vesuvius"].preferences
 
 def get_data_dir():
-	d = bpy.context.preferences.addons["vesuvius"].preferences.data_dir
+	d = get_preferences().data_dir
 	return Path(d) if d else None
 
 
@@ -47,6 +72,23 @@ class HerculaneumScan:
 	def small_volume_url(self):
 		return self.url(self.small_volume_path)
 
+	# Tiled conversions of the small volume and the grid cells, see convert.py.
+	@property
+	def small_volume_tiled_filepath(self):
+		return tiled_small_volume_filepath(self.volpkg_dir, self.vol_id)
+
+	@property
+	def grid_tiled_dir(self):
+		return tiled_grid_dir(self.volpkg_dir, self.vol_id)
+
+	@property
+	def grid_shape(self):
+		return (math.ceil(self.width / 500), math.ceil(self.height / 500), math.ceil(self.slices / 500))
+
+	def grid_cell_in_bounds(self, jx, jy, jz):
+		nx, ny, nz = self.grid_shape
+		return 0 <= jx < nx and 0 <= jy < ny and 0 <= jz < nz
+
 	def grid_cell_name(self, jx, jy, jz):
 		return f"cell_yxz_{jy+1:03}_{jx+1:03}_{jz+1:03}"
 
@@ -62,12 +104,38 @@ class HerculaneumScan:
 	def grid_cell_url(self, jx, jy, jz):
 		return self.url(self.grid_cell_path(jx, jy, jz))
 
+	# Downsampled copies of the grid cells, built locally (see pyramids.py).
+	# Level 1 is half resolution (250^3 voxels), level 2 quarter (125^3).
+	def grid_lod_dir(self, level):
+		return self.filepath(f"volume_grids/{self.vol_id}_lod{level}")
+
+	def grid_cell_lod_filepath(self, jx, jy, jz, level):
+		if level == 0:
+			return self.grid_cell_filepath(jx, jy, jz)
+		return self.grid_lod_dir(level) / self.grid_cell_filename(jx, jy, jz)
+
+	# OpenVDB exports of the grid cells (see vdb.py).
+	def grid_cell_vdb_filepath(self, jx, jy, jz, level=0):
+		return vdb_dir(self.volpkg_dir, self.vol_id) / vdb_filename(self.grid_cell_filename(jx, jy, jz), level)
+
 	def grid_cell_holes_dir(self, jx, jy, jz):
 		return self.filepath(f"segmentation/{self.grid_cell_name(jx,jy,jz)}/holes")
 
 	def grid_cell_patches_dir(self, jx, jy, jz):
 		return self.filepath(f"segmentation/{self.grid_cell_name(jx,jy,jz)}/patches")
 
+	def grid_cell_chunks_dir(self, jx, jy, jz):
+		return self.filepath(f"segmentation/{self.grid_cell_name(jx,jy,jz)}/chunks")
+
+	# The cells with a segmentation/<cell>/<kind> directory on disk, kind being
+	# holes, patches or chunks.
+	def segmentation_cells(self, kind):
+		cells = []
+		for d in sorted(self.filepath("segmentation").glob(f"cell_yxz_*/{kind}")):
+			jy, jx, jz = (int(x) - 1 for x in d.parent.name.removeprefix("cell_yxz_").split("_"))
+			cells.append((jx, jy, jz))
+		return cells
+
 	def segments_dir(self):
 		return self.filepath("paths")
 
@@ -104,36 +172,481 @@ def world_to_grid(v):
 	return (int(v.x // 5), int(v.y // 5), int(v.z // 5))
 
 
-def download_file(scan, path):
+# The cells of the hi-res window of the given radius around cell, closest to p
+# first. When the focus moved in z since the last window (dz = +1 or -1), the
+# layer just outside the window in that direction is appended too, so it is on
+# its way by the time the user steps into it.
+def focus_window_cells(scan, cell, p, radius=1, dz=0):
+	jx, jy, jz = cell
+	r = range(-radius, radius+1)
+	def by_distance(cells):
+		return sorted(cells, key=lambda c: sum((5*c[i] + 2.5 - p[i])**2 for i in range(3)))
+	cells = by_distance((jx+ix, jy+iy, jz+iz) for iz in r for iy in r for ix in r)
+	if dz:
+		jz_ahead = jz + dz*(radius+1)
+		cells += by_distance((jx+ix, jy+iy, jz_ahead) for iy in r for ix in r)
+	return [c for c in cells if scan.grid_cell_in_bounds(*c)]
+
+
+# All fetches go through one requests.Session, so connections to the data
+# server are pooled and kept alive between files instead of paying for a new
+# TCP/TLS handshake and slow start on each one. The pool is blocking: at most
+# max_connections requests per host are in flight, the rest wait for a free
+# connection. The session doesn't retry anything itself: failed connections,
+# 5xx responses and broken transfers are all retried, with exponential backoff,
+# by download_with_retries, resuming where they left off.
+class DataSession:
+	def __init__(self, max_connections=DATA_MAX_CONNECTIONS):
+		self.session = requests.Session()
+		self.session.auth = DATA_AUTH
+		self.lock = threading.Lock()
+		self.active_connections = 0
+		self.bytes_total = 0
+		self.samples = deque()
+		self.configure(max_connections)
+
+	# Replaces the connection pool with one of max_connections. The connections
+	# of the old one are closed as their requests finish.
+	def configure(self, max_connections):
+		if max_connections == getattr(self, "max_connections", None):
+			return
+		self.max_connections = max_connections
+		adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+		old_adapters = {self.session.adapters.get(prefix) for prefix in ("http://", "https://")}
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		for old_adapter in old_adapters - {None}:
+			old_adapter.close()
+
+	@contextmanager
+	def get(self, url, **kwargs):
+		kwargs.setdefault("timeout", DOWNLOAD_TIMEOUT)
+		with self.lock:
+			self.active_connections += 1
+		try:
+			with self.session.get(url, stream=True, **kwargs) as response:
+				yield response
+		finally:
+			with self.lock:
+				self.active_connections -= 1
+
+	def iter_content(self, response, chunk_size=DOWNLOAD_CHUNK_SIZE):
+		for data in response.iter_content(chunk_size=chunk_size):
+			t = time.monotonic()
+			with self.lock:
+				self.bytes_total += len(data)
+				self.samples.append((t, len(data)))
+			yield data
+
+	# Bytes per second over the last DATA_THROUGHPUT_WINDOW seconds.
+	def throughput(self):
+		t = time.monotonic()
+		with self.lock:
+			while self.samples and self.samples[0][0] < t - DATA_THROUGHPUT_WINDOW:
+				self.samples.popleft()
+			return sum(n for _, n in self.samples) / DATA_THROUGHPUT_WINDOW
+
+	def stats(self):
+		return {
+			"bytes_per_s": self.throughput(),
+			"bytes_total": self.bytes_total,
+			"active_connections": self.active_connections,
+			"max_connections": self.max_connections,
+		}
+
+
+session = DataSession()
+
+
+class IncompleteDownload(Exception):
+	pass
+
+class ServerUnavailable(Exception):
+	pass
+
+DOWNLOAD_RETRY_ERRORS = (
+	requests.ConnectionError,
+	requests.Timeout,
+	requests.exceptions.ChunkedEncodingError,
+	IncompleteDownload,
+	ServerUnavailable,
+)
+
+# raise_for_status, but responses worth retrying raise ServerUnavailable.
+def check_response(response):
+	if response.status_code in DOWNLOAD_RETRY_STATUSES:
+		raise ServerUnavailable(f"{response.status_code} {response.reason}")
+	response.raise_for_status()
+
+# Calls f(*args), retrying it with exponential backoff when it fails with one of
+# DOWNLOAD_RETRY_ERRORS. This is the only place requests are retried.
+def download_with_retries(message, f, *args):
+	for attempt in range(DOWNLOAD_ATTEMPTS):
+		try:
+			return f(*args)
+		except DOWNLOAD_RETRY_ERRORS as e:
+			if attempt == DOWNLOAD_ATTEMPTS - 1:
+				raise
+			print(f"{message} after error: {e}")
+			time.sleep(DOWNLOAD_RETRY_DELAY * 2**attempt)
+
+
+# Files are downloaded into a sibling .part file, which is only renamed into
+# place once its size matches the one the server reported. If the transfer is
+# interrupted, the next attempt (or the next session) resumes from the end of
+# the .part file with a Range request.
+def download_file(scan, path, progress=None):
 	filepath = scan.filepath(path)
+	if pages_index_filepath(filepath).is_file():
+		return download_tiff_pages(scan, path, progress)
 	if filepath.is_file():
 		return
 	url = scan.url(path)
 	if not filepath.parent.is_dir():
-		os.makedirs(filepath.parent)
-	response = requests.get(url, auth=HTTPBasicAuth('registeredusers', 'only'), stream=True)
-	if not response.ok:
-		return
-	# size = int(response.headers.get("Content-Length", 1e9))
-	# size_downloaded = 0
-	with open(filepath, "wb") as file:
-		for data in response.iter_content(chunk_size=None):
-			file.write(data)
-			# size_downloaded += len(data)
-			# context.window_manager.progress_update(min(size_downloaded/size, 1)
+		os.makedirs(filepath.parent, exist_ok=True)
+	part_filepath = filepath.with_name(filepath.name + ".part")
+	download_with_retries(f"Resuming download of {path}", download_part, url, part_filepath, progress)
+	os.replace(part_filepath, filepath)
 	print(f"Finished downloading {path}")
 
 
-# Fire and forget. A progress bar somewhere would be best. At least show status:
-# Use a ThreadPoolExecutor and check status from the main thread by registering
-# a function f with bpy.app.timers.register(f), and have f check status by
-# calling concurrent.futures.wait(dlfuts, timeout=0, return_when=FIRST_COMPLETED).
-# Also, a way to dedupe concurrent calls is needed. Checking that the file
-# exists is not enough.
-def download_file_start(scan, path, context):
+def download_part(url, part_filepath, progress=None):
+	offset = part_filepath.stat().st_size if part_filepath.is_file() else 0
+	headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+	with session.get(url, headers=headers) as response:
+		if response.status_code == 416:
+			# The .part file can't be extended: either it is already complete, or
+			# it's stale and we need to start over.
+			size = content_range_size(response.headers.get("Content-Range"))
+			if size is not None and size == offset:
+				return
+			os.remove(part_filepath)
+			raise IncompleteDownload(f"{part_filepath.name} doesn't match the remote file")
+		check_response(response)
+		if response.status_code == 206:
+			size = content_range_size(response.headers.get("Content-Range"))
+		else:
+			# The server ignored the Range header and is sending the whole file.
+			offset = 0
+			size = None
+		content_length = response.headers.get("Content-Length")
+		if size is None and content_length is not None:
+			size = offset + int(content_length)
+		if progress:
+			progress.size = size or 0
+			progress.size_downloaded = offset
+		with open(part_filepath, "ab" if offset > 0 else "wb") as file:
+			for data in session.iter_content(response):
+				file.write(data)
+				if progress:
+					progress.size_downloaded += len(data)
+	size_downloaded = part_filepath.stat().st_size
+	if size is not None and size_downloaded != size:
+		raise IncompleteDownload(f"got {size_downloaded} of {size} bytes")
+
+
+# Parses the total size out of "bytes 0-99/1234" or "bytes */1234".
+def content_range_size(content_range):
+	if not content_range or "/" not in content_range:
+		return None
+	size = content_range.rsplit("/", 1)[1].strip()
+	return int(size) if size.isdigit() else None
+
+
+# Partial TIFF downloads. The TIFF header and IFD chain are fetched first, and a
+# sparse file of the full size is created with just those bytes in place, so
+# it's already a valid TIFF for the shader, with zeros for the missing slices.
+# The byte ranges of each page (slice) are kept in a .pages.json index next to
+# it, along with which ones have been fetched. Pages are then fetched with Range
+# requests, the ones requested first, optionally followed by the rest. While the
+# index exists the file is incomplete; it's deleted once all pages are in.
+
+def pages_index_filepath(filepath):
+	return filepath.with_name(filepath.name + ".pages.json")
+
+def file_complete(filepath):
+	return filepath.is_file() and not pages_index_filepath(filepath).is_file()
+
+
+def fetch_range(url, start, end, file=None):
+	headers = {"Range": f"bytes={start}-{end}"}
+	with session.get(url, headers=headers) as response:
+		check_response(response)
+		if response.status_code != 206:
+			raise TiffError("the server doesn't support Range requests")
+		size = content_range_size(response.headers.get("Content-Range"))
+		if file is None:
+			return b"".join(session.iter_content(response)), size
+		file.seek(start)
+		for data in session.iter_content(response):
+			file.write(data)
+		if file.tell() != end + 1:
+			raise IncompleteDownload(f"got {file.tell() - start} of {end + 1 - start} bytes")
+		return None, size
+
+
+# A read(offset, size) function for read_tiff over Range requests, fetching and
+# keeping whole blocks, so the small reads of IFD parsing take few requests.
+class RemoteBlocks:
+	def __init__(self, url, block_size=TIFF_BLOCK_SIZE):
+		self.url = url
+		self.block_size = block_size
+		self.blocks = {}
+		self.size = None
+
+	def read(self, offset, size):
+		bs = self.block_size
+		first, last = offset // bs, (offset + size - 1) // bs
+		missing = [i for i in range(first, last + 1) if i not in self.blocks]
+		if missing:
+			start = missing[0]*bs
+			data, self.size = fetch_range(self.url, start, (missing[-1] + 1)*bs - 1)
+			for i in range(missing[0], missing[-1] + 1):
+				self.blocks[i] = data[(i - missing[0])*bs:(i - missing[0] + 1)*bs]
+		data = b"".join(self.blocks[i] for i in range(first, last + 1))
+		return data[offset - first*bs:offset - first*bs + size]
+
+
+def create_pages_index(url, filepath):
+	remote = RemoteBlocks(url)
+	tif = read_tiff(remote.read)
+	sparse_filepath = filepath.with_name(filepath.name + ".sparse")
+	with open(sparse_filepath, "wb") as f:
+		f.truncate(remote.size)
+		for i, block in remote.blocks.items():
+			f.seek(i*remote.block_size)
+			f.write(block)
+	index = {
+		"size": remote.size,
+		"pages": [page.data_ranges for page in tif.pages],
+		"fetched": [False for _ in tif.pages],
+	}
+	save_pages_index(filepath, index)
+	os.replace(sparse_filepath, filepath)
+	return index
+
+def save_pages_index(filepath, index):
+	index_filepath = pages_index_filepath(filepath)
+	tmp_filepath = index_filepath.with_name(index_filepath.name + ".tmp")
+	with open(tmp_filepath, "w") as f:
+		json.dump(index, f)
+	os.replace(tmp_filepath, index_filepath)
+
+
+# Merges the byte ranges of pages into as few (start, end) requests as possible,
+# allowing small gaps between them.
+def coalesce_ranges(ranges, max_gap=TIFF_BLOCK_SIZE):
+	merged = []
+	for offset, size in sorted(ranges):
+		if size == 0:
+			continue
+		if merged and offset <= merged[-1][1] + 1 + max_gap:
+			merged[-1][1] = max(merged[-1][1], offset + size - 1)
+		else:
+			merged.append([offset, offset + size - 1])
+	return merged
+
+
+# The slice (page) of the small volume at world z, as sample_scan picks it.
+def small_volume_page(scan, n_pages, z):
+	page = int((n_pages - 1) * z / (scan.slices / 100))
+	return min(max(page, 0), n_pages - 1)
+
+
+# Fetches the (start, end) byte ranges of url into the same bytes of filepath.
+def fetch_ranges(url, filepath, ranges):
+	with open(filepath, "r+b") as f:
+		for start, end in ranges:
+			fetch_range(url, start, end, file=f)
+
+
+# progress.z_range is the (z0, z1) world range of slices wanted first, and
+# progress.fill whether to continue with the rest, closest to it first. Both may
+# be updated by the DownloadManager while this runs.
+def download_tiff_pages(scan, path, progress=None):
+	progress = progress or Download(scan, path)
 	filepath = scan.filepath(path)
-	if filepath.is_file():
+	if file_complete(filepath):
 		return
-	print(f"Downloading {path}...")
-	thread = threading.Thread(target=download_file, args=(scan, path))
-	thread.start()
+	url = scan.url(path)
+	if not filepath.parent.is_dir():
+		os.makedirs(filepath.parent, exist_ok=True)
+	index_filepath = pages_index_filepath(filepath)
+	if index_filepath.is_file() and filepath.is_file():
+		with open(index_filepath) as f:
+			index = json.load(f)
+	else:
+		index = download_with_retries(f"Retrying the header of {path}", create_pages_index, url, filepath)
+	pages, fetched = index["pages"], index["fetched"]
+	n_pages = len(pages)
+	progress.size = sum(size for page in pages for _, size in page)
+	progress.size_downloaded = sum(size for page, done in zip(pages, fetched) if done for _, size in page)
+
+	while True:
+		z0, z1 = progress.z_range or (0, 0)
+		p0, p1 = small_volume_page(scan, n_pages, z0), small_volume_page(scan, n_pages, z1)
+		wanted = [i for i in range(p0, p1 + 1) if not fetched[i]]
+		if not wanted and progress.fill:
+			wanted = sorted((i for i in range(n_pages) if not fetched[i]), key=lambda i: abs(i - (p0 + p1)/2))
+		if not wanted:
+			break
+		batch = wanted[:TIFF_PAGES_BATCH]
+		ranges = coalesce_ranges([r for i in batch for r in pages[i]])
+		download_with_retries(f"Retrying pages of {path}", fetch_ranges, url, filepath, ranges)
+		for i in batch:
+			fetched[i] = True
+			progress.size_downloaded += sum(size for _, size in pages[i])
+		save_pages_index(filepath, index)
+
+	if all(fetched):
+		os.remove(index_filepath)
+		print(f"Finished downloading {path}")
+	else:
+		print(f"Downloaded {sum(fetched)}/{n_pages} pages of {path}")
+
+
+# Downloads run on a bounded thread pool. The registry maps each local filepath
+# to its in-flight Download, so concurrent requests for the same file share one
+# future. Threads only touch their Download's counters; everything that talks to
+# blender happens in poll_downloads, which runs on the main thread as a timer.
+
+class Download:
+	def __init__(self, scan, path, prefetch=False):
+		self.scan = scan
+		self.path = path
+		self.prefetch = prefetch
+		self.z_range = None
+		self.fill = True
+		self.size = 0
+		self.size_downloaded = 0
+		self.future = None
+
+	@property
+	def progress(self):
+		if not self.size:
+			return 0
+		return min(self.size_downloaded / self.size, 1)
+
+
+class DownloadManager:
+	def __init__(self, max_workers=DATA_MAX_CONNECTIONS):
+		self.max_workers = max_workers
+		self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vesuvius_download")
+		self.lock = threading.Lock()
+		self.downloads = {}
+		self.finished_callbacks = []
+
+	def submit(self, scan, path, prefetch=False):
+		filepath = scan.filepath(path)
+		with self.lock:
+			dl = self.downloads.get(filepath)
+			if dl and not dl.future.done():
+				dl.prefetch = dl.prefetch and prefetch
+				dl.fill = True
+				return dl.future
+			if file_complete(filepath):
+				return None
+			print(f"{'Prefetching' if prefetch else 'Downloading'} {path}...")
+			dl = Download(scan, path, prefetch=prefetch)
+			dl.future = self.executor.submit(download_file, scan, path, dl)
+			self.downloads[filepath] = dl
+		if not bpy.app.timers.is_registered(poll_downloads):
+			bpy.app.timers.register(poll_downloads, first_interval=DOWNLOAD_POLL_INTERVAL)
+		return dl.future
+
+	# Downloads the slices of a volume TIFF within z_range (world z) first, and
+	# the rest after that if fill. If the file is already being downloaded, its
+	# download is redirected to z_range instead.
+	def submit_pages(self, scan, path, z_range, fill=False):
+		filepath = scan.filepath(path)
+		with self.lock:
+			dl = self.downloads.get(filepath)
+			if dl and not dl.future.done():
+				dl.z_range = z_range
+				dl.fill = dl.fill or fill
+				return dl.future
+			if file_complete(filepath):
+				return None
+			print(f"Downloading {path} slices at z {z_range[0]:.2f}-{z_range[1]:.2f}...")
+			dl = Download(scan, path)
+			dl.z_range = z_range
+			dl.fill = fill
+			dl.future = self.executor.submit(download_tiff_pages, scan, path, dl)
+			self.downloads[filepath] = dl
+		if not bpy.app.timers.is_registered(poll_downloads):
+			bpy.app.timers.register(poll_downloads, first_interval=DOWNLOAD_POLL_INTERVAL)
+		return dl.future
+
+	# Replaces the queued prefetches with paths, in order. Prefetches that
+	# haven't started and are no longer wanted are cancelled, so they don't hold
+	# up the ones that are.
+	def prefetch(self, scan, paths):
+		filepaths = {scan.filepath(path) for path in paths}
+		with self.lock:
+			for filepath, dl in self.downloads.items():
+				if dl.prefetch and filepath not in filepaths:
+					dl.future.cancel()
+		return [self.submit(scan, path, prefetch=True) for path in paths]
+
+	def pending(self):
+		with self.lock:
+			return [dl for dl in self.downloads.values() if not dl.future.cancelled()]
+
+	def poll(self):
+		with self.lock:
+			done = [dl for dl in self.downloads.values() if dl.future.done()]
+			for dl in done:
+				filepath = dl.scan.filepath(dl.path)
+				if self.downloads.get(filepath) is dl:
+					del self.downloads[filepath]
+		for dl in done:
+			if dl.future.cancelled():
+				continue
+			error = dl.future.exception()
+			if error:
+				print(f"Failed downloading {dl.path}: {error}")
+			for callback in self.finished_callbacks:
+				callback(dl, error)
+		return done
+
+	def status(self):
+		pending = self.pending()
+		if not pending:
+			return None
+		size = sum(dl.size for dl in pending)
+		size_downloaded = sum(dl.size_downloaded for dl in pending)
+		progress = min(size_downloaded / size, 1) if size else 0
+		return len(pending), progress, session.stats()
+
+	# Runs the next downloads on max_workers threads. Downloads already
+	# submitted finish on the old ones.
+	def configure(self, max_workers):
+		with self.lock:
+			if max_workers == self.max_workers:
+				return
+			old_executor = self.executor
+			self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vesuvius_download")
+			self.max_workers = max_workers
+		old_executor.shutdown(wait=False)
+
+	def shutdown(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+downloads = DownloadManager()
+
+# Downloads run one per connection to the data server, so there are as many
+# download threads as connections.
+def configure_downloads(max_connections):
+	session.configure(max_connections)
+	downloads.configure(max_connections)
+
+def poll_downloads():
+	downloads.poll()
+	for window in bpy.context.window_manager.windows:
+		for area in window.screen.areas:
+			if area.type == "STATUSBAR":
+				area.tag_redraw()
+	if downloads.pending():
+		return DOWNLOAD_POLL_INTERVAL
+	return None
@@ -1,6 +1,11 @@
+import heapq
 import subprocess
 import math
-from collections import defaultdict
+from collections import defaultdict, deque
+
+import numpy as np
+
+from .pool import process_pool, worker_count
 
 
 class Graph:
@@ -10,13 +15,14 @@ class Graph:
     self._into = defaultdict(list)
     self.verts_meta = verts_meta or {}
     self.edges_meta = edges_meta or {}
+    vertex_set = set(vertices)
     for (v, w, m) in edges:
-      assert v in vertices and w in vertices, "bad edge"
+      assert v in vertex_set and w in vertex_set, "bad edge"
       self._from[v].append((w, m))
       self._into[w].append((v, m))
 
   def copy(self):
-    return Graph(self.vertices.copy(), [(v, w, m) for (w, m) in self._from[v] for v in self.vertices])
+    return Graph(self.vertices.copy(), [(v, w, m) for v in self.vertices for (w, m) in self._from[v]], self.verts_meta, self.edges_meta)
 
   def _remove(self, l, v):
     for i in range(len(l)-1, -1, -1):
@@ -84,53 +90,292 @@ class Graph:
     # return subprocess.run(["dot", "-Tpng", f"{path}.dot", "-o", f"{path}.png"], cwd="/tmp")
     return subprocess.run(["dot", "-Tsvg", f"{path}.dot", "-o", f"{path}.svg"], cwd="/tmp")
 
-# https://www.youtube.com/watch?v=Z0RGCWxvCxA
-def break_cycles(g: Graph):
-  vertices = g.vertices.copy()
-  verts_meta = g.verts_meta
-  edges_meta = g.edges_meta
-  edges = []
-  edges_cut = []
-  while len(g.vertices) > 0:
-    v = g.sink()
-    while v:
-      edges += g.edges_into(v)
-      g.remove(v)
-      v = g.sink()
-
-    v = g.isolated()
-    while v:
-      g.remove(v)
-      v = g.isolated()
-
-    v = g.source()
-    while v:
-      edges += g.edges_from(v)
-      g.remove(v)
-      v = g.source()
-
-    if len(g.vertices) == 0:
+# A compact, integer indexed version of a Graph's structure, for the algorithms
+# that need to scale to the sheet faces of whole layers. Vertices are 0..n-1,
+# edges 0..m-1 with their endpoints and weights in arrays, and each vertex's out
+# and in edges are ranges of the CSR arrays out_edges and in_edges. The graph is
+# never modified; algorithms keep their own alive flags and degree counters.
+class IndexedGraph:
+  def __init__(self, n, sources, targets, weights):
+    self.n = n
+    self.sources = np.asarray(sources, dtype=np.int64)
+    self.targets = np.asarray(targets, dtype=np.int64)
+    self.weights = np.asarray(weights, dtype=np.float64)
+    self.out_offsets, self.out_edges = self._csr(self.sources)
+    self.in_offsets, self.in_edges = self._csr(self.targets)
+
+  def _csr(self, endpoints):
+    edges = np.argsort(endpoints, kind="stable")
+    offsets = np.zeros(self.n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(endpoints, minlength=self.n), out=offsets[1:])
+    return offsets, edges
+
+  @property
+  def m(self):
+    return len(self.sources)
+
+  # The IndexedGraph of a Graph, vertex i being g.vertices[i].
+  @classmethod
+  def from_graph(cls, g):
+    index = {v: i for i, v in enumerate(g.vertices)}
+    edges = [(index[v], index[w], m) for v in g.vertices for (w, m) in g._from[v]]
+    sources, targets, weights = zip(*edges) if edges else ((), (), ())
+    return cls(len(g.vertices), sources, targets, weights)
+
+
+# Greedy feedback arc set of Eades, Lin and Smyth (https://www.youtube.com/watch?v=Z0RGCWxvCxA),
+# weighted: sinks and sources are removed keeping their edges, and when there
+# are none the vertex with the largest weight out minus weight in goes, keeping
+# its out edges and cutting its in edges. Sinks and sources wait in queues and
+# the weight differences in a max-heap with lazy invalidation (they aren't
+# integers, so no bucket queue), for O((V + E) log V) in all. Returns the
+# boolean array of cut edges.
+def greedy_feedback_arcs(ig: IndexedGraph):
+  n = ig.n
+  sources, targets, weights = ig.sources.tolist(), ig.targets.tolist(), ig.weights.tolist()
+  out_offsets, out_edges = ig.out_offsets.tolist(), ig.out_edges.tolist()
+  in_offsets, in_edges = ig.in_offsets.tolist(), ig.in_edges.tolist()
+  alive = [True]*n
+  out_degree = [out_offsets[v+1] - out_offsets[v] for v in range(n)]
+  in_degree = [in_offsets[v+1] - in_offsets[v] for v in range(n)]
+  delta = [0.0]*n
+  for e in range(ig.m):
+    delta[sources[e]] += weights[e]
+    delta[targets[e]] -= weights[e]
+  version = [0]*n
+  heap = [(-delta[v], v, 0) for v in range(n)]
+  heapq.heapify(heap)
+  sinks = deque(v for v in range(n) if out_degree[v] == 0)
+  sources_queue = deque(v for v in range(n) if in_degree[v] == 0)
+  cut = np.zeros(ig.m, dtype=bool)
+  remaining = n
+
+  def update(u, d):
+    delta[u] += d
+    version[u] += 1
+    heapq.heappush(heap, (-delta[u], u, version[u]))
+
+  def remove(v, cut_in=False):
+    nonlocal remaining
+    alive[v] = False
+    remaining -= 1
+    for i in range(out_offsets[v], out_offsets[v+1]):
+      e = out_edges[i]
+      u = targets[e]
+      if alive[u]:
+        in_degree[u] -= 1
+        update(u, weights[e])
+        if in_degree[u] == 0:
+          sources_queue.append(u)
+    for i in range(in_offsets[v], in_offsets[v+1]):
+      e = in_edges[i]
+      u = sources[e]
+      if alive[u]:
+        out_degree[u] -= 1
+        update(u, -weights[e])
+        if out_degree[u] == 0:
+          sinks.append(u)
+        if cut_in:
+          cut[e] = True
+
+  while remaining > 0:
+    while sinks or sources_queue:
+      while sinks:
+        v = sinks.popleft()
+        if alive[v]:
+          remove(v)
+      while sources_queue:
+        v = sources_queue.popleft()
+        if alive[v]:
+          remove(v)
+    if remaining == 0:
       break
+    while True:
+      _, v, v_version = heapq.heappop(heap)
+      if alive[v] and v_version == version[v]:
+        break
+    remove(v, cut_in=True)
+  return cut
+
 
-    v_max = g.vertices[0]
-    d_max = g.weight_from(v_max) - g.weight_into(v_max)
-    for v in g.vertices:
-      d_v = g.weight_from(v) - g.weight_into(v)
-      if d_v > d_max:
-        d_max = d_v
-        v_max = v
-    edges += g.edges_from(v_max)
-    edges_cut += g.edges_into(v_max)
-    g.remove(v_max)
+# The strongly connected components of ig, as lists of vertices, in reverse
+# topological order. Tarjan's algorithm, with an explicit stack of (vertex,
+# next out edge) instead of recursion, which would overflow on long paths.
+def strongly_connected_components(ig: IndexedGraph):
+  n = ig.n
+  targets = ig.targets.tolist()
+  out_offsets, out_edges = ig.out_offsets.tolist(), ig.out_edges.tolist()
+  index = [-1]*n
+  low = [0]*n
+  on_stack = [False]*n
+  stack = []
+  components = []
+  counter = 0
+  for root in range(n):
+    if index[root] != -1:
+      continue
+    index[root] = low[root] = counter
+    counter += 1
+    stack.append(root)
+    on_stack[root] = True
+    work = [(root, out_offsets[root])]
+    while work:
+      v, i = work[-1]
+      if i < out_offsets[v+1]:
+        work[-1] = (v, i + 1)
+        w = targets[out_edges[i]]
+        if index[w] == -1:
+          index[w] = low[w] = counter
+          counter += 1
+          stack.append(w)
+          on_stack[w] = True
+          work.append((w, out_offsets[w]))
+        elif on_stack[w]:
+          low[v] = min(low[v], index[w])
+        continue
+      work.pop()
+      if work:
+        u = work[-1][0]
+        low[u] = min(low[u], low[v])
+      if low[v] == index[v]:
+        component = []
+        while True:
+          w = stack.pop()
+          on_stack[w] = False
+          component.append(w)
+          if w == v:
+            break
+        components.append(component)
+  return components
 
-  return Graph(vertices, edges, verts_meta=verts_meta,  edges_meta=edges_meta), edges_cut
+
+# Minimum weight feedback arc set of a small graph given by its edge arrays, by
+# dynamic programming over vertex subsets: best[S] is the least weight of the
+# edges pointing backwards in an ordering of S, and appending v to an ordering
+# of S points v's edges into S backwards. O(2^n n) time and memory. Returns the
+# boolean array of cut edges.
+def exact_feedback_arcs(n, sources, targets, weights):
+  w = [[0.0]*n for _ in range(n)]
+  for s, t, m in zip(sources, targets, weights):
+    w[s][t] += m
+  full = (1 << n) - 1
+  # into[v][S]: weight of v's edges into S.
+  into = []
+  for v in range(n):
+    row = [0.0]*(full + 1)
+    for S in range(1, full + 1):
+      low = S & -S
+      row[S] = row[S ^ low] + w[v][low.bit_length() - 1]
+    into.append(row)
+  best = [math.inf]*(full + 1)
+  best[0] = 0.0
+  last = [-1]*(full + 1)
+  for S in range(full):
+    b = best[S]
+    for v in range(n):
+      bit = 1 << v
+      if S & bit:
+        continue
+      c = b + into[v][S]
+      if c < best[S | bit]:
+        best[S | bit] = c
+        last[S | bit] = v
+  position = [0]*n
+  S = full
+  for i in range(n - 1, -1, -1):
+    v = last[S]
+    position[v] = i
+    S ^= 1 << v
+  return np.array([position[s] > position[t] for s, t in zip(sources, targets)], dtype=bool)
+
+
+# Components up to this many vertices are solved exactly.
+EXACT_FEEDBACK_ARCS_MAX_VERTICES = 14
+# Graphs whose components cost less than this to solve (see
+# component_feedback_arcs_cost, about 0.1 us a unit) are solved in process,
+# below the time it takes to start a pool.
+PARALLEL_FEEDBACK_ARCS_MIN_COST = 2*10**7
+
+def component_feedback_arcs_cost(n, m, exact_max=EXACT_FEEDBACK_ARCS_MAX_VERTICES):
+  return n << n if n <= exact_max else (n + m)*n.bit_length()
+
+def component_feedback_arcs(n, sources, targets, weights, exact_max=EXACT_FEEDBACK_ARCS_MAX_VERTICES):
+  if n <= exact_max:
+    return exact_feedback_arcs(n, sources.tolist(), targets.tolist(), weights.tolist())
+  return greedy_feedback_arcs(IndexedGraph(n, sources, targets, weights))
+
+# Runs in the workers of feedback_arcs, on a batch of components.
+def components_feedback_arcs(components, exact_max=EXACT_FEEDBACK_ARCS_MAX_VERTICES):
+  return [component_feedback_arcs(*component, exact_max=exact_max) for component in components]
+
+
+# A feedback arc set of ig, as a boolean array of cut edges. Edges between
+# strongly connected components are never in a cycle, so only the edges inside
+# each non-trivial component are candidates: components of up to exact_max
+# vertices are solved exactly, bigger ones with greedy_feedback_arcs. Self
+# loops are always cut. When there's a lot of work the components are solved
+# in batches by a process pool (see pool.py) of `workers` processes.
+def feedback_arcs(ig: IndexedGraph, workers=None, exact_max=EXACT_FEEDBACK_ARCS_MAX_VERTICES, parallel_min_cost=PARALLEL_FEEDBACK_ARCS_MIN_COST):
+  cut = ig.sources == ig.targets
+  components = [c for c in strongly_connected_components(ig) if len(c) > 1]
+  if not components:
+    return cut
+  label = np.full(ig.n, -1, dtype=np.int64)
+  local = np.zeros(ig.n, dtype=np.int64)
+  for i, component in enumerate(components):
+    label[component] = i
+    local[component] = np.arange(len(component))
+  # The edges inside each component, grouped by component.
+  source_labels = label[ig.sources]
+  internal = np.flatnonzero((source_labels >= 0) & (source_labels == label[ig.targets]) & ~cut)
+  internal = internal[np.argsort(source_labels[internal], kind="stable")]
+  bounds = np.searchsorted(source_labels[internal], np.arange(len(components) + 1))
+  jobs = []
+  for i, component in enumerate(components):
+    edges = internal[bounds[i]:bounds[i+1]]
+    cost = component_feedback_arcs_cost(len(component), len(edges), exact_max)
+    jobs.append((edges, (len(component), local[ig.sources[edges]], local[ig.targets[edges]], ig.weights[edges]), cost))
+
+  total_cost = sum(cost for _, _, cost in jobs)
+  if total_cost < parallel_min_cost or len(jobs) == 1:
+    for edges, component, _ in jobs:
+      cut[edges[component_feedback_arcs(*component, exact_max=exact_max)]] = True
+    return cut
+  # Batches of about equal cost, a few per worker to even them out.
+  batch_cost = total_cost / (4*worker_count(workers))
+  batches = [[]]
+  cost_so_far = 0
+  for job in sorted(jobs, key=lambda job: -job[2]):
+    if cost_so_far >= batch_cost:
+      batches.append([])
+      cost_so_far = 0
+    batches[-1].append(job)
+    cost_so_far += job[2]
+  with process_pool(workers) as pool:
+    futures = [pool.submit(components_feedback_arcs, [component for _, component, _ in batch], exact_max) for batch in batches]
+    for batch, future in zip(batches, futures):
+      for (edges, _, _), component_cut in zip(batch, future.result()):
+        cut[edges[component_cut]] = True
+  return cut
+
+
+# Breaks the cycles of g (see feedback_arcs). Returns the acyclic Graph of the
+# edges kept and the list of edges cut.
+def break_cycles(g: Graph, workers=None):
+  ig = IndexedGraph.from_graph(g)
+  cut = feedback_arcs(ig, workers)
+  edges = []
+  edges_cut = []
+  for e, (v, w, m) in enumerate(zip(ig.sources.tolist(), ig.targets.tolist(), ig.weights.tolist())):
+    (edges_cut if cut[e] else edges).append((g.vertices[v], g.vertices[w], m))
+  return Graph(g.vertices.copy(), edges, verts_meta=g.verts_meta, edges_meta=g.edges_meta), edges_cut
 
 def topo_sorted(g):
   topo = []
   in_degree = {v: len(g._into[v]) for v in g.vertices}
-  queue = [v for v in g.vertices if in_degree[v] == 0]
+  queue = deque(v for v in g.vertices if in_degree[v] == 0)
   while queue:
-    v = queue.pop(0)
+    v = queue.popleft()
     topo.append(v)
     for w, _ in g._from[v]:
       in_degree[w] -= 1
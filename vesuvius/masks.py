@@ -0,0 +1,165 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+# Occupancy masks of a segment, for finding the patches that touch it (see
+# scripts/build_segment_patches.py). Each grid cell the segment goes through
+# gets a NSUBDIVS^3 boolean mask of the sub-voxels with a segment vertex in
+# them. Everything works on (N x 3) arrays of world space points, from
+# foreach_get, with integer arithmetic on sub-voxel indices: the masks are built
+# with one scatter, and testing a patch is one fancy-indexed lookup of all its
+# vertices.
+
+CELL_SIZE = 5
+NSUBDIVS = 20
+
+
+class SegmentMask:
+	def __init__(self, points, nsubdivs=NSUBDIVS, cell_size=CELL_SIZE):
+		self.nsubdivs = nsubdivs
+		self.subdiv_size = cell_size / nsubdivs
+		sub = self.subdiv_indices(points)
+		cells = sub // nsubdivs
+		local = sub - cells*nsubdivs
+		# Number the cells by their index in a dense box around them, so finding
+		# each point's cell is a np.unique of integers, not of rows.
+		self.origin = cells.min(axis=0) if len(cells) else np.zeros(3, dtype=np.int64)
+		shape = tuple(cells.max(axis=0) - self.origin + 1) if len(cells) else (0, 0, 0)
+		keys = np.ravel_multi_index(tuple((cells - self.origin).T), shape)
+		unique_keys, inverse = np.unique(keys, return_inverse=True)
+		self.cells = np.stack(np.unravel_index(unique_keys, shape), axis=1) + self.origin
+		self.masks = np.zeros((len(unique_keys), nsubdivs, nsubdivs, nsubdivs), dtype=bool)
+		self.masks[inverse.ravel(), local[:, 0], local[:, 1], local[:, 2]] = True
+		# Mask index of each cell in the box, -1 where the segment doesn't go.
+		self.lookup = np.full(shape, -1, dtype=np.int32)
+		self.lookup.ravel()[unique_keys] = np.arange(len(unique_keys), dtype=np.int32)
+
+	def subdiv_indices(self, points):
+		return np.floor(np.asarray(points, dtype=np.float64) / self.subdiv_size).astype(np.int64).reshape(-1, 3)
+
+	def __len__(self):
+		return len(self.cells)
+
+	def __contains__(self, cell):
+		c = np.asarray(cell) - self.origin
+		return bool(np.all(c >= 0) and np.all(c < self.lookup.shape) and self.lookup[tuple(c)] >= 0)
+
+	def __getitem__(self, cell):
+		if cell not in self:
+			raise KeyError(cell)
+		return self.masks[self.lookup[tuple(np.asarray(cell) - self.origin)]]
+
+	# The (jx, jy, jz) of the cells the segment goes through.
+	def cell_set(self):
+		return {tuple(int(j) for j in cell) for cell in self.cells}
+
+	# Whether any of the points falls in a sub-voxel of the segment.
+	def touches(self, points):
+		sub = self.subdiv_indices(points)
+		cells = sub // self.nsubdivs - self.origin
+		inside = np.all((cells >= 0) & (cells < self.lookup.shape), axis=1)
+		sub, cells = sub[inside], cells[inside]
+		rows = self.lookup[cells[:, 0], cells[:, 1], cells[:, 2]]
+		hit = rows >= 0
+		local = sub[hit] % self.nsubdivs
+		return bool(self.masks[rows[hit], local[:, 0], local[:, 1], local[:, 2]].any())
+
+	# The masks of the cells, pooled down to subdivs^3 (a divisor of nsubdivs)
+	# and packed like occupancy_bitmap's, one row per cell in self.cells.
+	def packed_coarse_masks(self, subdivs):
+		k = self.nsubdivs // subdivs
+		assert k*subdivs == self.nsubdivs, "subdivs must divide nsubdivs"
+		coarse = self.masks.reshape(-1, subdivs, k, subdivs, k, subdivs, k).any(axis=(2, 4, 6))
+		return np.packbits(coarse.reshape(len(coarse), -1), axis=1)
+
+
+# Layer occupancy: a sidecar file next to each layer file, patches_z13.blend's
+# being patches_z13.occupancy.npz, with the name, cell, world bounding box and
+# a coarse occupancy bitmap of each patch, OCCUPANCY_SUBDIVS^3 bits over its
+# cell. build_segment_patches.py reads it to append only the patches whose
+# occupancy intersects the segment's, instead of every patch in the segment's
+# cells. It is written with the layer file, and ignored if older than it.
+
+OCCUPANCY_SUBDIVS = 10
+
+
+def occupancy_filepath(layer_filepath):
+	layer_filepath = Path(layer_filepath)
+	return layer_filepath.with_name(layer_filepath.stem + ".occupancy.npz")
+
+
+# The packed subdivs^3 bitmap of the sub-voxels of cell with points in them.
+# Points outside the cell count in the sub-voxels at its boundary.
+def occupancy_bitmap(points, cell, subdivs=OCCUPANCY_SUBDIVS, cell_size=CELL_SIZE):
+	local = np.floor((np.asarray(points, dtype=np.float64) - np.multiply(cell, cell_size)) * (subdivs/cell_size)).astype(np.int64)
+	local = np.clip(local.reshape(-1, 3), 0, subdivs - 1)
+	bitmap = np.zeros((subdivs, subdivs, subdivs), dtype=bool)
+	bitmap[local[:, 0], local[:, 1], local[:, 2]] = True
+	return np.packbits(bitmap.ravel())
+
+
+# Writes the occupancy sidecar of a layer file from patches, an iterable of
+# (name, cell, points), cell being None for patches not named after one.
+def write_layer_occupancy(layer_filepath, patches, subdivs=OCCUPANCY_SUBDIVS):
+	names, cells, aabbs, bitmaps = [], [], [], []
+	for name, cell, points in patches:
+		points = np.asarray(points).reshape(-1, 3)
+		names.append(name)
+		cells.append(cell if cell is not None else (-1, -1, -1))
+		aabbs.append((points.min(axis=0), points.max(axis=0)) if len(points) else np.zeros((2, 3)))
+		bitmaps.append(occupancy_bitmap(points, cell, subdivs) if cell is not None else np.packbits(np.ones(subdivs**3, dtype=bool)))
+	filepath = occupancy_filepath(layer_filepath)
+	tmp_filepath = filepath.with_name(filepath.name + ".tmp")
+	with open(tmp_filepath, "wb") as f:
+		np.savez(f,
+			subdivs=subdivs,
+			names=np.array(names, dtype=str),
+			cells=np.array(cells, dtype=np.int64).reshape(-1, 3),
+			aabbs=np.array(aabbs, dtype=np.float32).reshape(-1, 2, 3),
+			bitmaps=np.array(bitmaps, dtype=np.uint8).reshape(len(names), -1),
+		)
+	os.replace(tmp_filepath, filepath)
+	return len(names)
+
+
+class LayerOccupancy:
+	def __init__(self, subdivs, names, cells, aabbs, bitmaps):
+		self.subdivs = subdivs
+		self.names = names
+		self.cells = cells
+		self.aabbs = aabbs
+		self.bitmaps = bitmaps
+
+	# The names of the patches whose occupancy intersects the segment's, and of
+	# those the bitmaps can't tell about (not named after a cell, or sticking
+	# out of it) whose bounding box intersects the segment's cells.
+	def candidates(self, segment_mask):
+		if len(segment_mask) == 0:
+			return []
+		lo = segment_mask.cells.min(axis=0) * CELL_SIZE
+		hi = (segment_mask.cells.max(axis=0) + 1) * CELL_SIZE
+		in_box = np.all((self.aabbs[:, 1] >= lo) & (self.aabbs[:, 0] <= hi), axis=1)
+		rows = np.full(len(self.names), -1, dtype=np.int64)
+		c = self.cells - segment_mask.origin
+		in_lookup = in_box & np.all((c >= 0) & (c < segment_mask.lookup.shape), axis=1) & np.all(self.cells >= 0, axis=1)
+		rows[in_lookup] = segment_mask.lookup[tuple(c[in_lookup].T)]
+		hit = np.zeros(len(self.names), dtype=bool)
+		sel = rows >= 0
+		coarse = segment_mask.packed_coarse_masks(self.subdivs)
+		hit[sel] = (self.bitmaps[sel] & coarse[rows[sel]]).any(axis=1)
+		# The bitmaps don't cover what's outside of the patch's cell.
+		spills = np.any(self.aabbs[:, 0] < self.cells*CELL_SIZE, axis=1) | np.any(self.aabbs[:, 1] >= (self.cells + 1)*CELL_SIZE, axis=1)
+		hit |= in_box & (spills | np.any(self.cells < 0, axis=1))
+		return [self.names[i] for i in np.flatnonzero(hit)]
+
+
+# The LayerOccupancy of a layer file, None if it has no sidecar or it is older
+# than the layer file.
+def load_layer_occupancy(layer_filepath):
+	filepath = occupancy_filepath(layer_filepath)
+	if not filepath.is_file() or filepath.stat().st_mtime < Path(layer_filepath).stat().st_mtime:
+		return None
+	with np.load(filepath) as npz:
+		return LayerOccupancy(int(npz["subdivs"]), npz["names"].tolist(), npz["cells"], npz["aabbs"], npz["bitmaps"])
@@ -0,0 +1,152 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .stl import read_stl
+from .pool import process_pool
+
+
+# A cache of all the STL meshes of a directory (a cell's holes, patches or
+# chunks) in one .npz file next to it, <dir>.npz, so importing them again in
+# another blend file is a single read instead of parsing and welding each file.
+# It holds the welded, scaled vertices and faces of all meshes concatenated,
+# with offset tables to slice each mesh out, their names, and the mtime and
+# size of each source file; it is stale when the directory's STL files differ.
+# Build the caches of a whole scan with:
+#
+#   python -m vesuvius.meshcache /path/to/PHercParis4.volpkg -j 16
+
+MESH_CACHE_VERSION = 1
+
+
+def mesh_cache_filepath(d):
+	d = Path(d)
+	return d.with_name(d.name + ".npz")
+
+
+def stl_sources(d):
+	with os.scandir(d) as it:
+		entries = sorted((e for e in it if e.name.endswith(".stl")), key=lambda e: e.name)
+	names = [e.name.removesuffix(".stl") for e in entries]
+	stats = [e.stat() for e in entries]
+	return names, np.array([s.st_mtime_ns for s in stats], dtype=np.int64), np.array([s.st_size for s in stats], dtype=np.int64)
+
+
+class MeshCache:
+	def __init__(self, names, vertex_offsets, face_offsets, vertices, faces):
+		self.names = names
+		self.vertex_offsets = vertex_offsets
+		self.face_offsets = face_offsets
+		self.vertices = vertices
+		self.faces = faces
+
+	def __len__(self):
+		return len(self.names)
+
+	# (name, vertices, faces) of each mesh, as views into the cache's arrays.
+	def __iter__(self):
+		vo, fo = self.vertex_offsets, self.face_offsets
+		for i, name in enumerate(self.names):
+			yield name, self.vertices[vo[i]:vo[i+1]], self.faces[fo[i]:fo[i+1]]
+
+
+def build_mesh_cache(d, scale=0.01):
+	names, mtimes, sizes = stl_sources(d)
+	meshes = [read_stl(os.path.join(d, f"{name}.stl"), scale) for name in names]
+	vertex_counts = [len(vertices) for vertices, _ in meshes]
+	face_counts = [len(faces) for _, faces in meshes]
+	filepath = mesh_cache_filepath(d)
+	tmp_filepath = filepath.with_name(filepath.name + ".tmp")
+	with open(tmp_filepath, "wb") as f:
+		np.savez(f,
+			version=MESH_CACHE_VERSION,
+			scale=scale,
+			names=np.array(names, dtype=str),
+			source_mtimes=mtimes,
+			source_sizes=sizes,
+			vertex_offsets=np.cumsum([0] + vertex_counts, dtype=np.int64),
+			face_offsets=np.cumsum([0] + face_counts, dtype=np.int64),
+			vertices=np.concatenate([vertices for vertices, _ in meshes]) if meshes else np.empty((0, 3), np.float32),
+			faces=np.concatenate([faces for _, faces in meshes]) if meshes else np.empty((0, 3), np.int32),
+		)
+	os.replace(tmp_filepath, filepath)
+	return filepath
+
+
+def mesh_cache_matches(npz, d, scale):
+	names, mtimes, sizes = stl_sources(d)
+	return (int(npz["version"]) == MESH_CACHE_VERSION and float(npz["scale"]) == scale
+		and npz["names"].tolist() == names
+		and np.array_equal(npz["source_mtimes"], mtimes)
+		and np.array_equal(npz["source_sizes"], sizes))
+
+
+# Whether directory d has an up to date cache. Only reads the cache's names and
+# source stats, not its meshes.
+def mesh_cache_is_fresh(d, scale=0.01):
+	filepath = mesh_cache_filepath(d)
+	if not filepath.is_file():
+		return False
+	with np.load(filepath) as npz:
+		return mesh_cache_matches(npz, d, scale)
+
+
+# The MeshCache of directory d, None if there isn't one or it is stale.
+def load_mesh_cache(d, scale=0.01):
+	filepath = mesh_cache_filepath(d)
+	if not filepath.is_file():
+		return None
+	with np.load(filepath) as npz:
+		if not mesh_cache_matches(npz, d, scale):
+			return None
+		return MeshCache(npz["names"].tolist(), npz["vertex_offsets"], npz["face_offsets"], npz["vertices"], npz["faces"])
+
+
+# The meshes of d from its cache, building it first if needed.
+def mesh_cache(d, scale=0.01):
+	cache = load_mesh_cache(d, scale)
+	if cache is None:
+		build_mesh_cache(d, scale)
+		cache = load_mesh_cache(d, scale)
+	return cache
+
+
+# The mesh directories of the cells of a volpkg.
+def volpkg_mesh_dirs(volpkg_dir, kinds=("holes", "patches", "chunks")):
+	dirs = []
+	for cell_dir in sorted((Path(volpkg_dir) / "segmentation").glob("cell_yxz_*")):
+		dirs += [cell_dir / kind for kind in kinds if (cell_dir / kind).is_dir()]
+	return dirs
+
+
+def main():
+	parser = argparse.ArgumentParser(prog="python -m vesuvius.meshcache", description="Build the mesh caches of a scan's cell holes, patches and chunks.")
+	parser.add_argument("volpkg_dir")
+	parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, all cores by default")
+	parser.add_argument("--kinds", nargs="+", default=["holes", "patches", "chunks"])
+	parser.add_argument("--force", action="store_true", help="rebuild caches that are up to date")
+	args = parser.parse_args()
+	dirs = volpkg_mesh_dirs(args.volpkg_dir, args.kinds)
+	if not args.force:
+		dirs = [d for d in dirs if not mesh_cache_is_fresh(d)]
+	print(f"Building {len(dirs)} mesh caches...")
+	t0 = time.time()
+	# Run as python -m, this module is __main__, which the workers don't import
+	# (see pool.py), so submit the function of the imported module.
+	from .meshcache import build_mesh_cache
+	with process_pool(args.jobs) as pool:
+		futures = {pool.submit(build_mesh_cache, d): d for d in dirs}
+		for i, future in enumerate(futures):
+			d = futures[future]
+			try:
+				future.result()
+				print(f"[{i+1}/{len(dirs)}] {d} ({time.time() - t0:.1f} s.)")
+			except Exception as e:
+				print(f"[{i+1}/{len(dirs)}] {d} failed: {e}")
+
+
+if __name__ == "__main__":
+	main()
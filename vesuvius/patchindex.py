@@ -0,0 +1,173 @@
+import argparse
+import re
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+
+# An sqlite index of the patches in the layer files (patches_z??.blend), with
+# the cell, vertex and face counts, world space bounding box, area and average
+# normal of each patch, so histograms, picking the biggest patches and finding
+# the patches of a cell or a box are queries instead of opening every layer
+# file. build_layer_patches.py indexes a layer when it is done with it, into
+# patches.sqlite next to the layer files; scripts/index_layer_patches.py
+# indexes layer files built before. Query it from the shell with:
+#
+#   python -m vesuvius.patchindex patches.sqlite histogram --layer 13
+#   python -m vesuvius.patchindex patches.sqlite top 300 --skip 200
+#   python -m vesuvius.patchindex patches.sqlite cell 7,7,14
+#   python -m vesuvius.patchindex patches.sqlite box 35,35,70 40,40,75
+#
+# A patch's layer is the number in its layer file's name.
+
+PATCH_INDEX_FILENAME = "patches.sqlite"
+
+PATCH_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patches (
+	name TEXT PRIMARY KEY,
+	layer INTEGER NOT NULL,
+	jx INTEGER,
+	jy INTEGER,
+	jz INTEGER,
+	n_vertices INTEGER NOT NULL,
+	n_faces INTEGER NOT NULL,
+	min_x REAL, min_y REAL, min_z REAL,
+	max_x REAL, max_y REAL, max_z REAL,
+	area REAL,
+	normal_x REAL, normal_y REAL, normal_z REAL
+);
+CREATE INDEX IF NOT EXISTS patches_layer ON patches (layer);
+CREATE INDEX IF NOT EXISTS patches_cell ON patches (jx, jy, jz);
+CREATE INDEX IF NOT EXISTS patches_n_vertices ON patches (n_vertices);
+"""
+
+
+def patch_index_filepath(layers_dir):
+	return Path(layers_dir) / PATCH_INDEX_FILENAME
+
+
+# Layers run in parallel processes, each writing its rows in one transaction,
+# so wait for the others instead of failing on a locked database.
+def open_patch_index(filepath):
+	db = sqlite3.connect(filepath, timeout=600)
+	db.executescript(PATCH_INDEX_SCHEMA)
+	return db
+
+
+# The layer of a layer file, like 13 for patches_z13.blend.
+def layer_file_layer(filepath):
+	m = re.search(r"_z(\d+)\.blend$", str(filepath))
+	assert m, f"not a layer file: {filepath}"
+	return int(m.group(1))
+
+
+# The 0-indexed (jx, jy, jz) of a patch named after its cell, like
+# cell_yxz_008_008_015.03.01, None for other names.
+def patch_cell(name):
+	if not name.startswith("cell_yxz_"):
+		return None
+	jy, jx, jz = (int(x) - 1 for x in name[len("cell_yxz_"):len("cell_yxz_000_000_000")].split("_"))
+	return (jx, jy, jz)
+
+
+# The bounding box, area and average (area weighted) normal of a mesh from its
+# world space vertices (N x 3) and triangles (M x 3).
+def patch_stats(vertices, triangles):
+	if len(vertices) == 0:
+		return (None,)*3, (None,)*3, 0.0, (None,)*3
+	a, b, c = (vertices[triangles[:, i]] for i in range(3))
+	cross = np.cross(b - a, c - a)
+	area = 0.5*np.linalg.norm(cross, axis=1).sum()
+	normal = cross.sum(axis=0)
+	norm = np.linalg.norm(normal)
+	if norm > 0:
+		normal = normal / norm
+	return vertices.min(axis=0).tolist(), vertices.max(axis=0).tolist(), float(area), normal.tolist()
+
+
+# Replaces the rows of a layer with patches, an iterable of (name, vertices,
+# triangles, n_faces), vertices and triangles as for patch_stats.
+def index_patches(db, layer, patches):
+	rows = []
+	for name, vertices, triangles, n_faces in patches:
+		lo, hi, area, normal = patch_stats(vertices, triangles)
+		cell = patch_cell(name) or (None, None, None)
+		rows.append((name, layer, *cell, len(vertices), n_faces, *lo, *hi, area, *normal))
+	with db:
+		db.execute("DELETE FROM patches WHERE layer = ?", (layer,))
+		db.executemany(f"INSERT OR REPLACE INTO patches VALUES ({', '.join('?'*17)})", rows)
+	return len(rows)
+
+
+def layer_filter(layer):
+	return ("WHERE layer = ?", (layer,)) if layer is not None else ("", ())
+
+
+# {bin: count} of the patches' vertex counts in bins of bin_size vertices.
+def vertex_count_histogram(db, bin_size=100, layer=None):
+	where, params = layer_filter(layer)
+	return dict(db.execute(f"SELECT n_vertices / ? AS bin, count(*) FROM patches {where} GROUP BY bin ORDER BY bin", (bin_size, *params)))
+
+# {(jx, jy, jz): {bin: count}} like vertex_count_histogram, for each cell.
+def vertex_count_histograms_per_cell(db, bin_size=100, layer=None):
+	where, params = layer_filter(layer)
+	histograms = {}
+	for jx, jy, jz, b, count in db.execute(f"SELECT jx, jy, jz, n_vertices / ? AS bin, count(*) FROM patches {where} GROUP BY jx, jy, jz, bin", (bin_size, *params)):
+		histograms.setdefault((jx, jy, jz), {})[b] = count
+	return histograms
+
+# The (name, layer, n_vertices) of the n patches with the most vertices, after
+# skipping the biggest `skip`.
+def largest_patches(db, n, skip=0, layer=None):
+	where, params = layer_filter(layer)
+	return db.execute(f"SELECT name, layer, n_vertices FROM patches {where} ORDER BY n_vertices DESC, name LIMIT ? OFFSET ?", (*params, n, skip)).fetchall()
+
+# The (name, layer, n_vertices) of the patches of a cell.
+def cell_patches(db, cell):
+	return db.execute("SELECT name, layer, n_vertices FROM patches WHERE jx = ? AND jy = ? AND jz = ? ORDER BY name", tuple(cell)).fetchall()
+
+# The (name, layer, n_vertices) of the patches whose bounding box intersects the
+# box from lo to hi, in world coordinates.
+def box_patches(db, lo, hi):
+	return db.execute(
+		"SELECT name, layer, n_vertices FROM patches"
+		" WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ? AND max_z >= ? AND min_z <= ?"
+		" ORDER BY name",
+		(lo[0], hi[0], lo[1], hi[1], lo[2], hi[2])).fetchall()
+
+
+def main():
+	parser = argparse.ArgumentParser(prog="python -m vesuvius.patchindex", description="Query the index of the patches of the layer files.")
+	parser.add_argument("index_file")
+	commands = parser.add_subparsers(dest="command", required=True)
+	histogram = commands.add_parser("histogram", help="count the patches by number of vertices")
+	histogram.add_argument("--bin-size", type=int, default=100)
+	histogram.add_argument("--layer", type=int, default=None)
+	top = commands.add_parser("top", help="list the patches with the most vertices")
+	top.add_argument("n", type=int)
+	top.add_argument("--skip", type=int, default=0)
+	top.add_argument("--layer", type=int, default=None)
+	cell = commands.add_parser("cell", help="list the patches of a cell")
+	cell.add_argument("cell", help="jx,jy,jz, 0-indexed")
+	box = commands.add_parser("box", help="list the patches whose bounding box intersects a box")
+	box.add_argument("lo", help="x,y,z in world coordinates")
+	box.add_argument("hi", help="x,y,z in world coordinates")
+	args = parser.parse_args()
+	db = open_patch_index(args.index_file)
+	if args.command == "histogram":
+		for b, count in vertex_count_histogram(db, args.bin_size, args.layer).items():
+			print(f"{b*args.bin_size}\t{count}")
+		return
+	if args.command == "top":
+		rows = largest_patches(db, args.n, args.skip, args.layer)
+	elif args.command == "cell":
+		rows = cell_patches(db, [int(x) for x in args.cell.split(",")])
+	else:
+		rows = box_patches(db, [float(x) for x in args.lo.split(",")], [float(x) for x in args.hi.split(",")])
+	for name, layer, n_vertices in rows:
+		print(f"{name}\t{layer}\t{n_vertices}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,41 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+
+# Process pools that work from inside blender. Workers are spawned, not forked
+# (forking blender is asking for trouble), and a spawned worker normally imports
+# the parent's __main__ first, which in blender is the script given to --python,
+# and would run it again. The main module is hidden from multiprocessing while
+# the workers start. Workers import the vesuvius package without bpy, so the
+# functions they run must be in modules that don't need it.
+
+
+def worker_count(workers=None):
+	return workers or os.cpu_count() or 1
+
+
+@contextmanager
+def hidden_main_module():
+	main = sys.modules["__main__"]
+	spec, file = getattr(main, "__spec__", None), getattr(main, "__file__", None)
+	main.__spec__ = None
+	if file is not None:
+		del main.__file__
+	try:
+		yield
+	finally:
+		main.__spec__ = spec
+		if file is not None:
+			main.__file__ = file
+
+
+# A ProcessPoolExecutor of spawned workers. Its processes start as jobs are
+# submitted, so submit them in the with block.
+@contextmanager
+def process_pool(workers=None):
+	with hidden_main_module():
+		with ProcessPoolExecutor(max_workers=worker_count(workers), mp_context=multiprocessing.get_context("spawn")) as executor:
+			yield executor
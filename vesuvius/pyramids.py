@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+
+from .tiff import *
+from .sampler import TiffVolume
+
+
+# Downsampled copies of the grid cells for the shader's level of detail mode.
+# Level k of a cell is the cell averaged over 2^k x 2^k x 2^k voxel blocks, in a
+# TIFF stack of its own with the same name under volume_grids/<vol_id>_lod<k>,
+# so the shader can pick a level by switching the path format. Levels are built
+# in one pass over the source pages, each level from the one above it, so only
+# a couple of pages per level are in memory at a time.
+
+LOD_LEVELS = 2
+
+
+# Averages 2x2 blocks of a page, repeating the last row/column for odd sizes.
+def downsample_page(page):
+	h, w = page.shape
+	page = np.pad(page, ((0, h % 2), (0, w % 2)), mode="edge")
+	return page.reshape((h + 1)//2, 2, (w + 1)//2, 2).mean(axis=(1, 3))
+
+
+# Halves a stack of pages in every dimension, lazily.
+def downsample_stack(pages):
+	pending = None
+	for page in pages:
+		page = downsample_page(page)
+		if pending is None:
+			pending = page
+		else:
+			yield (pending + page)/2
+			pending = None
+	if pending is not None:
+		yield pending
+
+
+# Builds the downsampled levels of the TIFF stack at src_filepath into
+# dst_filepaths (level 1, 2, ...). Files are written next to their destination
+# and renamed into place when done.
+def build_pyramid(src_filepath, dst_filepaths):
+	volume = TiffVolume(src_filepath)
+	depth, height, width = volume.shape
+	dtype = volume.dtype.newbyteorder("<").str[1:]
+	levels = []
+	for dst_filepath in dst_filepaths:
+		depth, height, width = (depth + 1)//2, (height + 1)//2, (width + 1)//2
+		dst_filepath.parent.mkdir(parents=True, exist_ok=True)
+		tmp_filepath = dst_filepath.with_name(dst_filepath.name + ".tmp")
+		pages = create_tiff(tmp_filepath, [TiffPageLayout(width, height, dtype) for _ in range(depth)])
+		levels.append((dst_filepath, tmp_filepath, pages))
+
+	info = np.iinfo(volume.dtype) if volume.dtype.kind in "ui" else None
+	def written(level, pages):
+		_, tmp_filepath, layouts = levels[level]
+		for z, page in enumerate(pages):
+			out = page_array(tmp_filepath, layouts[z])
+			out[:, :, 0] = np.clip(np.rint(page), info.min, info.max) if info else page
+			out.flush()
+			yield page
+
+	# A chain of generators, one per level, pulling pages through from the source.
+	stack = (volume.page(z).astype(np.float32) for z in range(volume.shape[0]))
+	for level in range(len(levels)):
+		stack = written(level, downsample_stack(stack))
+	for _ in stack:
+		pass
+
+	for dst_filepath, tmp_filepath, _ in levels:
+		os.replace(tmp_filepath, dst_filepath)
+	return [dst_filepath for dst_filepath, _, _ in levels]
+
+
+def build_cell_pyramid(scan, jx, jy, jz, levels=LOD_LEVELS):
+	dst_filepaths = [scan.grid_cell_lod_filepath(jx, jy, jz, level) for level in range(1, levels + 1)]
+	return build_pyramid(scan.grid_cell_filepath(jx, jy, jz), dst_filepaths)
+
+
+def cell_pyramid_built(scan, jx, jy, jz, levels=LOD_LEVELS):
+	src_mtime = scan.grid_cell_filepath(jx, jy, jz).stat().st_mtime
+	for level in range(1, levels + 1):
+		filepath = scan.grid_cell_lod_filepath(jx, jy, jz, level)
+		if not filepath.is_file() or filepath.stat().st_mtime < src_mtime:
+			return False
+	return True
@@ -0,0 +1,168 @@
+import numpy as np
+
+from .tiff import *
+
+
+# Reads scan intensities at arbitrary points from python, the same way the
+# vesuvius_scan shader does (see sample_scan in shaders.py), so that tools can
+# use the scan data directly. The TIFFs are memory-mapped, not loaded: only the
+# pages touched by the sampled points are read from disk, by the OS page cache.
+
+
+# An uncompressed single channel TIFF stack (strips or tiles) as a (z, y, x)
+# volume, memory-mapped. Reduced resolution pages (mip levels) are skipped.
+class TiffVolume:
+	def __init__(self, filepath):
+		tif = read_tiff_file(filepath)
+		pages = [page for page in tif.pages if not page.subfile_type & 1]
+		page = pages[0]
+		for p in pages:
+			if p.compression != COMPRESSION_NONE:
+				raise TiffError(f"{filepath}: compressed TIFFs can't be memory-mapped")
+			if p.samples_per_pixel != 1:
+				raise TiffError(f"{filepath}: expected a single channel volume")
+			if (p.width, p.height, p.dtype, p.tiled) != (page.width, page.height, page.dtype, page.tiled):
+				raise TiffError(f"{filepath}: all pages must have the same layout")
+		self.filepath = filepath
+		self.shape = (len(pages), page.height, page.width)
+		self.dtype = np.dtype(tif.byteorder + page.dtype)
+		self.scale = 1/np.iinfo(self.dtype).max if self.dtype.kind in "ui" else 1
+		self.tiled = page.tiled
+		itemsize = self.dtype.itemsize
+		offsets = np.array([p.offsets for p in pages], dtype=np.int64)
+		if self.tiled:
+			self.tile_shape = (page.tile_length, page.tile_width)
+			self.tiles_across = -(-page.width // page.tile_width)
+			self.tile_offsets = offsets
+		else:
+			# Byte offset of the start of each row of each page.
+			rows = np.arange(page.height)
+			self.row_offsets = offsets[:, rows // page.rows_per_strip] + (rows % page.rows_per_strip) * page.width * itemsize
+		self.data = np.memmap(filepath, dtype=np.uint8, mode="r")
+		self.aligned = bool(np.all(offsets % itemsize == 0))
+		if self.aligned:
+			self.items = self.data[:len(self.data) // itemsize * itemsize].view(self.dtype)
+
+	def byte_offsets(self, z, y, x):
+		itemsize = self.dtype.itemsize
+		if self.tiled:
+			th, tw = self.tile_shape
+			tile = (y // th) * self.tiles_across + x // tw
+			return self.tile_offsets[z, tile] + ((y % th) * tw + x % tw) * itemsize
+		return self.row_offsets[z, y] + x * itemsize
+
+	# Raw voxel values at integer (z, y, x) index arrays.
+	def values(self, z, y, x):
+		offsets = self.byte_offsets(z, y, x)
+		if self.aligned:
+			return self.items[offsets // self.dtype.itemsize]
+		return self.data[offsets[:, None] + np.arange(self.dtype.itemsize)].copy().view(self.dtype)[:, 0]
+
+	# Voxel values at integer (z, y, x) index arrays, as floats in [0, 1].
+	def voxels(self, z, y, x):
+		return self.values(z, y, x).astype(np.float32) * np.float32(self.scale)
+
+	# The whole page z as a (height, width) array, in the file's dtype.
+	def page(self, z):
+		depth, height, width = self.shape
+		y, x = np.divmod(np.arange(height*width), width)
+		return self.values(np.full(len(y), z), y, x).reshape(height, width)
+
+	# Samples at texture coordinates ptex (N x 3, each in [0, 1]) like
+	# texture3d_fixed_up does: bilinear in xy, and either linear between pages
+	# or, with z_interpolation=False, the single page the shader picks. zres is
+	# the number of pages the shader assumes.
+	def sample(self, ptex, zres, z_interpolation=True):
+		depth, height, width = self.shape
+		x = ptex[:, 0] * width - 0.5
+		y = ptex[:, 1] * height - 0.5
+		x0, y0 = np.floor(x), np.floor(y)
+		fx, fy = (x - x0).astype(np.float32), (y - y0).astype(np.float32)
+		x0, y0 = x0.astype(np.int64), y0.astype(np.int64)
+		x1, y1 = np.clip(x0 + 1, 0, width - 1), np.clip(y0 + 1, 0, height - 1)
+		x0, y0 = np.clip(x0, 0, width - 1), np.clip(y0, 0, height - 1)
+		zf = int(zres - 1) * ptex[:, 2]
+		if z_interpolation:
+			z0 = np.floor(zf)
+			fz = (zf - z0).astype(np.float32)
+			z0 = np.clip(z0.astype(np.int64), 0, depth - 1)
+			z1 = np.clip(z0 + 1, 0, depth - 1)
+		else:
+			z0 = np.clip(zf.astype(np.int64), 0, depth - 1)
+
+		def bilinear(z):
+			v00 = self.voxels(z, y0, x0)
+			v01 = self.voxels(z, y0, x1)
+			v10 = self.voxels(z, y1, x0)
+			v11 = self.voxels(z, y1, x1)
+			return (v00*(1 - fx) + v01*fx)*(1 - fy) + (v10*(1 - fx) + v11*fx)*fy
+
+		value = bilinear(z0)
+		if z_interpolation:
+			value = value*(1 - fz) + bilinear(z1)*fz
+		zcorrection = 2*(ptex[:, 2] - 0.5)**2 + 0.5
+		return (zcorrection * value).astype(np.float32)
+
+
+# Samples the focus cells (any set of grid cells, like the shader's resident
+# cells) in full resolution and everything else from the small volume.
+class VolumeSampler:
+	def __init__(self, scan, cells=(), z_interpolation=True):
+		self.scan = scan
+		self.cells = set(map(tuple, cells))
+		self.z_interpolation = z_interpolation
+		self.dims = np.array([scan.width, scan.height, scan.slices], dtype=np.float64) / 100
+		self.volumes = {}
+
+	def volume(self, filepath):
+		if filepath not in self.volumes:
+			self.volumes[filepath] = TiffVolume(filepath) if filepath.is_file() else None
+		return self.volumes[filepath]
+
+	# Scan values at world space points (N x 3). Points in focus cells that are
+	# on disk are sampled from their grid cell, the rest from the small volume.
+	def sample(self, points):
+		p = np.asarray(points, dtype=np.float64).reshape(-1, 3) - 0.02
+		values = np.zeros(len(p), dtype=np.float32)
+		j = p / 5
+		hires = np.zeros(len(p), dtype=bool)
+		if self.cells:
+			c = np.array(sorted(self.cells), dtype=np.float64)
+			hires = np.all((j > c.min(axis=0)) & (j <= c.max(axis=0) + 1), axis=1)
+		fallback = ~hires
+
+		if np.any(hires):
+			ih = np.flatnonzero(hires)
+			cells = np.ceil(j[ih]).astype(np.int64) - 1
+			# Group points by cell: sort by a packed cell key and split into runs.
+			c = cells + (1 << 19)
+			keys = (c[:, 2] << 40) | (c[:, 1] << 20) | c[:, 0]
+			order = np.argsort(keys, kind="stable")
+			ih, cells, keys = ih[order], cells[order], keys[order]
+			starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+			ends = np.r_[starts[1:], len(keys)]
+			for start, end in zip(starts, ends):
+				jx, jy, jz = cells[start]
+				idx = ih[start:end]
+				volume = None
+				if (jx, jy, jz) in self.cells:
+					volume = self.volume(self.scan.grid_cell_filepath(jx, jy, jz))
+				if volume is None:
+					fallback[idx] = True
+					continue
+				ptex = p[idx] / 5 - cells[start]
+				values[idx] = volume.sample(ptex, 500, self.z_interpolation)
+
+		if np.any(fallback):
+			volume = self.volume(self.scan.small_volume_filepath)
+			idx = np.flatnonzero(fallback)
+			ptex = p[idx] / self.dims
+			inside = np.all((ptex >= 0) & (ptex <= 1), axis=1)
+			idx, ptex = idx[inside], ptex[inside]
+			if volume is not None and len(idx):
+				values[idx] = volume.sample(ptex, 10*self.dims[2], self.z_interpolation)
+		return values
+
+	# Like measure_scan.
+	def measure(self, points):
+		return np.maximum(0, (self.sample(points) - 0.15)/1.15)
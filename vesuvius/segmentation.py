@@ -161,9 +161,10 @@ def raycast_sort(ctx):
 
 	print("edges_cut", edges_cut)
 
+	sheet_faces_by_name = {sf.name: sf for sf in sheet_faces}
 	for i, sf_name in enumerate(topo_sorted_by_distance(ga, sheet_face_0.name)):
 		print(i, sf_name)
-		sf = next(sf for sf in sheet_faces if sf.name == sf_name)
+		sf = sheet_faces_by_name[sf_name]
 		if sf_name.startswith("s"):
 			sf_name = sf_name[4:]
 		sf.name = f"s{i:02}_{sf_name}"
@@ -1,11 +1,15 @@
+
+from .convert import converted
+
+
 SHADER_TEMPLATE = """
 struct Scan {
 	string small_path;
-	string grid_pathfmt;
 	float res;
 	vector dims;
 	vector minj;
 	vector maxj;
+	int level;
 };
 
 float texture3d_fixed_up(string path, point ptex, float zres) {
@@ -14,22 +18,14 @@ float texture3d_fixed_up(string path, point ptex, float zres) {
 	return zcorrection*texture3d(path, ptex, "subimage", zindex);
 }
 
+RESIDENT_CELLS
 float sample_scan(Scan scan, point p) {
 	float celldim = 5;
 	p -= 0.02; // Not sure exactly why this is needed, but it is.
-	vector j = p / celldim;
-	if (j.x > scan.minj.x && j.x <= scan.maxj.x &&
-	    j.y > scan.minj.y && j.y <= scan.maxj.y &&
-	    j.z > scan.minj.z && j.z <= scan.maxj.z) {
-		// grid cell
-		int jx = ceil(j.x); int jy = ceil(j.y); int jz = ceil(j.z);
-		point ptex = p / celldim - vector(jx-1, jy-1, jz-1);
-		return texture3d_fixed_up(format(scan.grid_pathfmt, jy, jx, jz), ptex, 500);
-	} else {
-		// small
-		point ptex = p / scan.dims;
-		return texture3d_fixed_up(scan.small_path, ptex, 10*scan.dims.z);
-	}
+HIRES_BRANCH
+	// small
+	point ptex = p / scan.dims;
+	return texture3d_fixed_up(scan.small_path, ptex, 10*scan.dims.z);
 }
 
 float measure_scan(Scan scan, point p) {
@@ -44,6 +40,8 @@ shader vesuvius_scan(
 	int disable_hires = 0,
 	vector MinJ = vector(0, 0, 0),
 	vector MaxJ = vector(0, 0, 0),
+	int lod_levels = 0,
+	float lod_bias = 1,
 	output color Value = color(1, 0, 1),
 	) {
 	vector min_j = vector(1,0,0);
@@ -53,27 +51,22 @@ shader vesuvius_scan(
 		max_j = MaxJ;
 	}
 
+	// Level of detail: how many full resolution voxels (0.01 units) the pixel
+	// covers across, as a power of 2, up to the number of pyramid levels built.
+	int level = 0;
+	if (lod_levels > 0) {
+		float footprint = max(length(Dx(P)), length(Dy(P)));
+		float voxels = max(lod_bias * footprint / 0.01, 1.0);
+		level = int(min(floor(log2(voxels)), float(lod_levels)));
+	}
+
 	Scan scan = SCAN_LITERAL;
 	float offset = offset_um / scan.res;
 	float nmerge_step = nmerge_step_um / scan.res;
 	if (backfacing()>0) offset = -offset;
 
 
-	float value = 0;
-	value += measure_scan(scan, P - (offset)*N);
-	Value.r = value;
-	value += measure_scan(scan, P - (offset + nmerge_step)*N);
-	Value.g = value/2;
-	value += measure_scan(scan, P - (offset + 2*nmerge_step)*N);
-	Value.b = value/3;
-
-	/*
-	float value = 0;
-	for (int i = 0; i < nmerge_samples; i++) {
-		value += measure_scan(scan, P - (offset + i*nmerge_step)*N);
-	}
-	Value = value/nmerge_samples;
-	*/
+NMERGE_SAMPLES
 }
 """
 
@@ -81,13 +74,123 @@ shader vesuvius_scan(
 def osl_str(s):
 	return '"' + repr(str(s))[1:-1] + '"'
 
-def generate_shader(scan):
-	print("generate_shader")
+HIRES_BRANCH = """
+	vector j = p / celldim;
+	if (j.x > scan.minj.x && j.x <= scan.maxj.x &&
+	    j.y > scan.minj.y && j.y <= scan.maxj.y &&
+	    j.z > scan.minj.z && j.z <= scan.maxj.z) {
+		// grid cell
+		int jx = ceil(j.x); int jy = ceil(j.y); int jz = ceil(j.z);
+		int i = resident_cell(jx-1, jy-1, jz-1);
+		if (i >= 0) {
+			point ptex = p / celldim - vector(jx-1, jy-1, jz-1);
+			float zres = 500;
+			string path = resident_cell_path(i, scan.level, zres);
+			return texture3d_fixed_up(path, ptex, zres);
+		}
+	}"""
+
+def cell_key(jx, jy, jz):
+	return (jz*1000 + jy)*1000 + jx
+
+# The grid cells the shader reads are compiled in: resident_cell finds a cell
+# by binary search over the sorted keys of the cells on disk, and
+# resident_cell_path gives the path of each of its levels, so there is no path
+# formatting per sample and cells that aren't on disk read the small volume.
+# Levels that aren't built use the finest one below them that is.
+def generate_resident_cells(cells):
+	keys = [cell_key(*cell) for cell, _ in cells]
+	n = len(cells)
+	def paths(level):
+		return ", ".join(osl_str(levels[min(level, len(levels) - 1)]) for _, levels in cells)
+	n_levels = ", ".join(str(len(levels) - 1) for _, levels in cells)
+	return f"""
+int resident_cell(int jx, int jy, int jz) {{
+	int keys[{n}] = {{{", ".join(str(key) for key in keys)}}};
+	int key = (jz*1000 + jy)*1000 + jx;
+	int lo = 0;
+	int hi = {n};
+	while (lo < hi) {{
+		int mid = (lo + hi) / 2;
+		if (keys[mid] < key) lo = mid + 1;
+		else hi = mid;
+	}}
+	if (lo < {n} && keys[lo] == key) return lo;
+	return -1;
+}}
+
+string resident_cell_path(int i, int level, output float zres) {{
+	int levels[{n}] = {{{n_levels}}};
+	string paths0[{n}] = {{{paths(0)}}};
+	string paths1[{n}] = {{{paths(1)}}};
+	string paths2[{n}] = {{{paths(2)}}};
+	int l = level;
+	if (l > levels[i]) l = levels[i];
+	zres = 500 >> l;
+	if (l == 1) return paths1[i];
+	if (l == 2) return paths2[i];
+	return paths0[i];
+}}
+"""
+
+# The cells of focus_cells on disk, sorted by key, with the paths of their
+# levels: the tiled conversion of the cell if up to date, or the original, and
+# the built pyramid levels.
+def resident_cells(scan, focus_cells, prefer_tiled=True):
+	cells = []
+	for cell in sorted(set(map(tuple, focus_cells)), key=lambda cell: cell_key(*cell)):
+		filepath = scan.grid_cell_filepath(*cell)
+		if not filepath.is_file():
+			continue
+		tiled_filepath = scan.grid_tiled_dir / filepath.name
+		levels = [tiled_filepath if prefer_tiled and converted(filepath, tiled_filepath) else filepath]
+		for level in (1, 2):
+			lod_filepath = scan.grid_cell_lod_filepath(*cell, level)
+			if not lod_filepath.is_file():
+				break
+			levels.append(lod_filepath)
+		cells.append((cell, levels))
+	return cells
+
+# The samples along the normal, unrolled. Up to 3 samples, the r, g and b
+# channels are the running averages after the first, second and third sample
+# (the last one repeats if there are fewer). With more, Value is the average.
+def generate_nmerge_samples(nmerge_samples):
+	lines = ["\tfloat value = 0;"]
+	for i in range(nmerge_samples):
+		step = f" + {i}*nmerge_step" if i > 0 else ""
+		lines.append(f"\tvalue += measure_scan(scan, P - (offset{step})*N);")
+		if nmerge_samples <= 3:
+			lines.append(f"\tValue.{'rgb'[i]} = value/{i+1};")
+	if nmerge_samples < 3:
+		for c in "rgb"[nmerge_samples:]:
+			lines.append(f"\tValue.{c} = value/{nmerge_samples};")
+	if nmerge_samples > 3:
+		lines.append(f"\tValue = value/{nmerge_samples};")
+	return "\n".join(lines)
+
+# Shader variants are specialised at generation time: nmerge_samples is baked in
+# as a constant with the sampling loop unrolled, and with disable_hires the grid
+# cell branch is left out altogether. The shader keeps the same parameters so
+# the script node's sockets don't change between variants.
+#
+# focus_cells are the grid cells to show in full resolution, any set of them.
+# The ones on disk are compiled in (see generate_resident_cells); MinJ and MaxJ
+# must contain them. The tiled conversions of the files (see convert.py) are used
+# instead of the originals when they are up to date, unless prefer_tiled is
+# False.
+def generate_shader(scan, nmerge_samples=3, disable_hires=False, focus_cells=(), prefer_tiled=True):
 	small_path = scan.small_volume_filepath
-	grid_pathfmt = scan.volpkg_dir / "volume_grids" / scan.vol_id / "cell_yxz_%03d_%03d_%03d.tif"
+	if prefer_tiled and small_path.is_file() and converted(small_path, scan.small_volume_tiled_filepath):
+		small_path = scan.small_volume_tiled_filepath
+	cells = [] if disable_hires else resident_cells(scan, focus_cells, prefer_tiled)
 	res = scan.resolution_um * 100
 	dimsx, dimsy, dimsz = scan.width / 100, scan.height / 100, scan.slices / 100
 	dims = f"vector({dimsx}, {dimsy}, {dimsz})"
-	scan = f"Scan({osl_str(small_path)}, {osl_str(grid_pathfmt)}, {res}, {dims}, min_j, max_j)"
-	return SHADER_TEMPLATE.replace("SCAN_LITERAL", scan)
+	scan = f"Scan({osl_str(small_path)}, {res}, {dims}, min_j, max_j, level)"
+	return (SHADER_TEMPLATE
+		.replace("SCAN_LITERAL", scan)
+		.replace("RESIDENT_CELLS", generate_resident_cells(cells) if cells else "")
+		.replace("HIRES_BRANCH", HIRES_BRANCH if cells else "")
+		.replace("NMERGE_SAMPLES", generate_nmerge_samples(max(1, int(nmerge_samples)))))
 
@@ -0,0 +1,92 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# STL parsing with numpy, for importing the many small meshes of the cell holes,
+# patches and chunks without going through bpy.ops.wm.stl_import per file.
+# Triangle soups are welded on exact vertex equality, like blender's importer
+# does, keeping vertices in order of first appearance.
+
+STL_DTYPE = np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attr", "<u2")])
+
+
+class StlError(Exception):
+	pass
+
+
+# The triangles (T x 3 x 3) of the STL file in data, binary or ASCII.
+def parse_stl(data):
+	if len(data) >= 84:
+		n = int.from_bytes(data[80:84], "little")
+		if len(data) == 84 + n*STL_DTYPE.itemsize:
+			return np.frombuffer(data, dtype=STL_DTYPE, count=n, offset=84)["vertices"]
+	if data.lstrip()[:5].lower() == b"solid":
+		lines = data.split(b"\n")
+		coords = [line.split()[1:4] for line in lines if line.lstrip()[:6] == b"vertex"]
+		if len(coords) % 3 == 0:
+			return np.array(coords, dtype=np.float32).reshape(-1, 3, 3)
+	raise StlError("not an STL file")
+
+
+# Welds the triangles' vertices, dropping triangles left degenerate. Returns the
+# vertices (N x 3) and faces (M x 3).
+def weld_triangles(triangles):
+	v = np.ascontiguousarray(triangles, dtype=np.float32).reshape(-1, 3) + np.float32(0) # -0 to 0
+	keys = v.view(np.dtype((np.void, 12))).ravel()
+	_, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+	# Renumber the unique vertices in order of first appearance.
+	order = np.argsort(first)
+	rank = np.empty_like(order)
+	rank[order] = np.arange(len(order))
+	faces = rank[inverse.ravel()].reshape(-1, 3).astype(np.int32)
+	faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+	return v[first[order]], faces
+
+
+def read_stl(filepath, scale=1):
+	with open(filepath, "rb") as f:
+		data = f.read()
+	try:
+		vertices, faces = weld_triangles(parse_stl(data))
+	except StlError as e:
+		raise StlError(f"{filepath}: {e}") from None
+	return vertices * np.float32(scale), faces
+
+
+# Reads a batch of STL files in a worker process (see pool.py) into one shared
+# memory block, so the meshes don't go through a pipe as pickles. Returns the
+# block's name and the (filepath, n_vertices, n_faces) of each mesh in it; the
+# caller unlinks the block, see take_shared_meshes.
+def read_stls_shared(filepaths, scale=1):
+	meshes = [read_stl(filepath, scale) for filepath in filepaths]
+	size = sum(vertices.nbytes + faces.nbytes for vertices, faces in meshes)
+	shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+	index = []
+	offset = 0
+	for filepath, (vertices, faces) in zip(filepaths, meshes):
+		for a in (vertices, faces):
+			np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=offset)[:] = a
+			offset += a.nbytes
+		index.append((filepath, len(vertices), len(faces)))
+	shm.close()
+	return shm.name, index
+
+
+# The (filepath, vertices, faces) of the meshes in a block from read_stls_shared,
+# copied out. The block is unlinked.
+def take_shared_meshes(name, index):
+	shm = shared_memory.SharedMemory(name=name)
+	try:
+		meshes = []
+		offset = 0
+		for filepath, n_vertices, n_faces in index:
+			vertices = np.ndarray((n_vertices, 3), dtype=np.float32, buffer=shm.buf, offset=offset).copy()
+			offset += vertices.nbytes
+			faces = np.ndarray((n_faces, 3), dtype=np.int32, buffer=shm.buf, offset=offset).copy()
+			offset += faces.nbytes
+			meshes.append((filepath, vertices, faces))
+		return meshes
+	finally:
+		shm.close()
+		shm.unlink()
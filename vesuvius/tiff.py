@@ -0,0 +1,296 @@
+import struct
+
+import numpy as np
+
+
+# Minimal TIFF structure parsing: just enough to find where the pixel data of
+# each page (IFD) of the scan volumes lives, without decoding anything. Works on
+# any read(offset, size) -> bytes function, so it can run over a local file or
+# over HTTP Range requests. Both classic TIFF and BigTIFF are supported.
+
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PLANAR_CONFIGURATION = 284
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_SAMPLE_FORMAT = 339
+
+TAGS = {
+	TAG_NEW_SUBFILE_TYPE, TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_BITS_PER_SAMPLE,
+	TAG_COMPRESSION, TAG_STRIP_OFFSETS, TAG_SAMPLES_PER_PIXEL, TAG_ROWS_PER_STRIP,
+	TAG_STRIP_BYTE_COUNTS, TAG_PLANAR_CONFIGURATION, TAG_TILE_WIDTH, TAG_TILE_LENGTH,
+	TAG_TILE_OFFSETS, TAG_TILE_BYTE_COUNTS, TAG_SAMPLE_FORMAT,
+}
+
+# type: (struct format, size)
+TYPES = {
+	1: ("B", 1), 2: ("B", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8),
+	6: ("b", 1), 7: ("B", 1), 8: ("h", 2), 9: ("i", 4), 10: ("ii", 8),
+	11: ("f", 4), 12: ("d", 8), 13: ("I", 4), 16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8),
+}
+
+COMPRESSION_NONE = 1
+SAMPLE_FORMAT_UINT = 1
+SAMPLE_FORMAT_INT = 2
+SAMPLE_FORMAT_FLOAT = 3
+
+
+class TiffError(Exception):
+	pass
+
+
+class TiffPage:
+	def __init__(self, tags):
+		self.width = tags[TAG_IMAGE_WIDTH][0]
+		self.height = tags[TAG_IMAGE_LENGTH][0]
+		self.bits_per_sample = tags.get(TAG_BITS_PER_SAMPLE, (1,))[0]
+		self.samples_per_pixel = tags.get(TAG_SAMPLES_PER_PIXEL, (1,))[0]
+		self.sample_format = tags.get(TAG_SAMPLE_FORMAT, (SAMPLE_FORMAT_UINT,))[0]
+		self.compression = tags.get(TAG_COMPRESSION, (COMPRESSION_NONE,))[0]
+		self.subfile_type = tags.get(TAG_NEW_SUBFILE_TYPE, (0,))[0]
+		self.tiled = TAG_TILE_OFFSETS in tags
+		if self.tiled:
+			self.tile_width = tags[TAG_TILE_WIDTH][0]
+			self.tile_length = tags[TAG_TILE_LENGTH][0]
+			self.offsets = list(tags[TAG_TILE_OFFSETS])
+			self.bytecounts = list(tags[TAG_TILE_BYTE_COUNTS])
+		else:
+			self.rows_per_strip = min(tags.get(TAG_ROWS_PER_STRIP, (self.height,))[0], self.height)
+			self.offsets = list(tags[TAG_STRIP_OFFSETS])
+			self.bytecounts = list(tags[TAG_STRIP_BYTE_COUNTS])
+
+	@property
+	def dtype(self):
+		kind = {SAMPLE_FORMAT_UINT: "u", SAMPLE_FORMAT_INT: "i", SAMPLE_FORMAT_FLOAT: "f"}[self.sample_format]
+		return f"{kind}{self.bits_per_sample // 8}"
+
+	# (offset, size) of each strip/tile of pixel data.
+	@property
+	def data_ranges(self):
+		return list(zip(self.offsets, self.bytecounts))
+
+
+class TiffFile:
+	def __init__(self, byteorder, bigtiff, pages):
+		self.byteorder = byteorder
+		self.bigtiff = bigtiff
+		self.pages = pages
+
+
+def read_tiff(read):
+	header = read(0, 16)
+	if header[:2] == b"II":
+		byteorder = "<"
+	elif header[:2] == b"MM":
+		byteorder = ">"
+	else:
+		raise TiffError("not a TIFF file")
+	version, = struct.unpack(byteorder + "H", header[2:4])
+	if version == 42:
+		bigtiff = False
+		ifd_offset, = struct.unpack(byteorder + "I", header[4:8])
+	elif version == 43:
+		bigtiff = True
+		ifd_offset, = struct.unpack(byteorder + "Q", header[8:16])
+	else:
+		raise TiffError(f"unknown TIFF version {version}")
+
+	pages = []
+	seen = set()
+	while ifd_offset and ifd_offset not in seen:
+		seen.add(ifd_offset)
+		tags, ifd_offset = read_ifd(read, byteorder, bigtiff, ifd_offset)
+		pages.append(TiffPage(tags))
+	return TiffFile(byteorder, bigtiff, pages)
+
+
+def read_ifd(read, byteorder, bigtiff, ifd_offset):
+	if bigtiff:
+		count_fmt, entry_fmt, entry_size, offset_fmt, inline_size = "Q", "HHQ8s", 20, "Q", 8
+	else:
+		count_fmt, entry_fmt, entry_size, offset_fmt, inline_size = "H", "HHI4s", 12, "I", 4
+	count_size = struct.calcsize(count_fmt)
+	offset_size = struct.calcsize(offset_fmt)
+	n_entries, = struct.unpack(byteorder + count_fmt, read(ifd_offset, count_size))
+	ifd = read(ifd_offset + count_size, n_entries*entry_size + offset_size)
+	tags = {}
+	for i in range(n_entries):
+		tag, typ, count, value = struct.unpack(byteorder + entry_fmt, ifd[i*entry_size:(i+1)*entry_size])
+		if tag not in TAGS or typ not in TYPES:
+			continue
+		fmt, size = TYPES[typ]
+		if count*size <= inline_size:
+			data = value[:count*size]
+		else:
+			value_offset, = struct.unpack(byteorder + offset_fmt, value[:offset_size])
+			data = read(value_offset, count*size)
+		tags[tag] = struct.unpack(f"{byteorder}{count*len(fmt)}{fmt[0]}", data)
+	next_offset, = struct.unpack(byteorder + offset_fmt, ifd[n_entries*entry_size:])
+	return tags, next_offset
+
+
+def read_tiff_file(filepath):
+	with open(filepath, "rb") as f:
+		def read(offset, size):
+			f.seek(offset)
+			return f.read(size)
+		return read_tiff(read)
+
+
+# Writing. create_tiff lays out a little endian, uncompressed TIFF for the given
+# pages: header, then all the IFDs, then the pixel data of each page. Only the
+# structure is written; the pixels are filled in afterwards through page_array,
+# a writable memory map, so callers can produce images larger than memory one
+# piece at a time.
+
+TAG_PHOTOMETRIC = 262
+
+PHOTOMETRIC_MINISBLACK = 1
+PHOTOMETRIC_RGB = 2
+
+SUBFILE_REDUCED_IMAGE = 1
+
+
+class TiffPageLayout:
+	def __init__(self, width, height, dtype="u1", samples_per_pixel=1, tile=None, subfile_type=0):
+		self.width = width
+		self.height = height
+		self.dtype = dtype
+		self.samples_per_pixel = samples_per_pixel
+		self.tile = tile
+		self.subfile_type = subfile_type
+		self.offset = None
+
+	@property
+	def itemsize(self):
+		return int(self.dtype[1:])
+
+	@property
+	def chunks_shape(self):
+		if self.tile:
+			th, tw = self.tile
+			return (-(-self.height // th), -(-self.width // tw))
+		return (1, 1)
+
+	@property
+	def chunk_size(self):
+		th, tw = self.tile or (self.height, self.width)
+		return th * tw * self.samples_per_pixel * self.itemsize
+
+	@property
+	def data_size(self):
+		rows, cols = self.chunks_shape
+		return rows * cols * self.chunk_size
+
+	def tags(self, offset_type):
+		sample_format = {"u": SAMPLE_FORMAT_UINT, "i": SAMPLE_FORMAT_INT, "f": SAMPLE_FORMAT_FLOAT}[self.dtype[0]]
+		spp = self.samples_per_pixel
+		rows, cols = self.chunks_shape
+		offsets = [self.offset + i*self.chunk_size for i in range(rows*cols)]
+		bytecounts = [self.chunk_size] * (rows*cols)
+		tags = [
+			(TAG_NEW_SUBFILE_TYPE, 4, [self.subfile_type]),
+			(TAG_IMAGE_WIDTH, 4, [self.width]),
+			(TAG_IMAGE_LENGTH, 4, [self.height]),
+			(TAG_BITS_PER_SAMPLE, 3, [8*self.itemsize] * spp),
+			(TAG_COMPRESSION, 3, [COMPRESSION_NONE]),
+			(TAG_PHOTOMETRIC, 3, [PHOTOMETRIC_RGB if spp >= 3 else PHOTOMETRIC_MINISBLACK]),
+			(TAG_SAMPLES_PER_PIXEL, 3, [spp]),
+			(TAG_PLANAR_CONFIGURATION, 3, [1]),
+			(TAG_SAMPLE_FORMAT, 3, [sample_format] * spp),
+		]
+		if self.tile:
+			th, tw = self.tile
+			tags += [
+				(TAG_TILE_WIDTH, 4, [tw]),
+				(TAG_TILE_LENGTH, 4, [th]),
+				(TAG_TILE_OFFSETS, offset_type, offsets),
+				(TAG_TILE_BYTE_COUNTS, offset_type, bytecounts),
+			]
+		else:
+			tags += [
+				(TAG_STRIP_OFFSETS, offset_type, offsets),
+				(TAG_ROWS_PER_STRIP, 4, [self.height]),
+				(TAG_STRIP_BYTE_COUNTS, offset_type, bytecounts),
+			]
+		return sorted(tags)
+
+
+def create_tiff(filepath, pages, bigtiff=None):
+	if bigtiff is None:
+		bigtiff = sum(page.data_size for page in pages) > 0xf0000000
+	if bigtiff:
+		header_size, count_fmt, entry_fmt, offset_fmt, inline_size, offset_type = 16, "Q", "HHQ", "Q", 8, 16
+	else:
+		header_size, count_fmt, entry_fmt, offset_fmt, inline_size, offset_type = 8, "H", "HHI", "I", 4, 4
+	entry_size = struct.calcsize("<" + entry_fmt) + inline_size
+	count_size = struct.calcsize("<" + count_fmt)
+	offset_size = struct.calcsize("<" + offset_fmt)
+
+	def value_size(typ, values):
+		return TYPES[typ][1] * len(values)
+
+	# The sizes of the IFDs don't depend on the data offsets, so lay them out
+	# with placeholder offsets first.
+	ifd_offsets = []
+	position = header_size
+	for page in pages:
+		page.offset = 0
+		tags = page.tags(offset_type)
+		ifd_offsets.append(position)
+		position += count_size + len(tags)*entry_size + offset_size
+		position += sum(value_size(typ, values) for _, typ, values in tags if value_size(typ, values) > inline_size)
+		position += position % 2
+	for page in pages:
+		position += -position % 16
+		page.offset = position
+		position += page.data_size
+
+	with open(filepath, "wb") as f:
+		if bigtiff:
+			f.write(struct.pack("<2sHHHQ", b"II", 43, 8, 0, ifd_offsets[0]))
+		else:
+			f.write(struct.pack("<2sHI", b"II", 42, ifd_offsets[0]))
+		for i, page in enumerate(pages):
+			tags = page.tags(offset_type)
+			ifd_offset = ifd_offsets[i]
+			next_ifd = ifd_offsets[i+1] if i+1 < len(pages) else 0
+			values_offset = ifd_offset + count_size + len(tags)*entry_size + offset_size
+			entries = b""
+			values_data = b""
+			for tag, typ, values in tags:
+				fmt = TYPES[typ][0]
+				data = struct.pack(f"<{len(values)}{fmt}", *values)
+				if len(data) <= inline_size:
+					inline = data.ljust(inline_size, b"\0")
+				else:
+					inline = struct.pack("<" + offset_fmt, values_offset + len(values_data))
+					values_data += data
+				entries += struct.pack("<" + entry_fmt, tag, typ, len(values)) + inline
+			f.seek(ifd_offset)
+			f.write(struct.pack("<" + count_fmt, len(tags)) + entries + struct.pack("<" + offset_fmt, next_ifd))
+			f.write(values_data)
+		f.truncate(position)
+	return pages
+
+
+# A writable memory map of a page's pixels in create_tiff's layout: (height,
+# width, samples) for strip pages, and (tile rows, tile columns, tile height,
+# tile width, samples) for tiled ones.
+def page_array(filepath, page):
+	rows, cols = page.chunks_shape
+	spp = page.samples_per_pixel
+	if page.tile:
+		shape = (rows, cols, page.tile[0], page.tile[1], spp)
+	else:
+		shape = (page.height, page.width, spp)
+	return np.memmap(filepath, dtype="<" + page.dtype, mode="r+", offset=page.offset, shape=shape)
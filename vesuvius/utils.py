@@ -1,8 +1,14 @@
+import os
 import bpy
 import bpy_types
 import bmesh
+import numpy as np
 from mathutils import Vector, Matrix
 
+from .stl import read_stl
+from .patchindex import index_patches, open_patch_index, patch_index_filepath, layer_file_layer, patch_cell
+from .masks import write_layer_occupancy
+
 
 def import_stl(filepath):
 	bpy.ops.wm.stl_import(
@@ -12,6 +18,93 @@ def import_stl(filepath):
 		up_axis='Z'
 	)
 
+# Creates a mesh object from vertices (N x 3) and triangles (M x 3) arrays,
+# linked into collection.
+def create_mesh_object(name, vertices, faces, collection):
+	mesh = bpy.data.meshes.new(name)
+	mesh.vertices.add(len(vertices))
+	mesh.vertices.foreach_set("co", vertices.ravel())
+	mesh.loops.add(faces.size)
+	mesh.loops.foreach_set("vertex_index", faces.ravel())
+	mesh.polygons.add(len(faces))
+	mesh.polygons.foreach_set("loop_start", np.arange(0, faces.size, 3, dtype=np.int32))
+	if bpy.app.version < (4, 0, 0):
+		mesh.polygons.foreach_set("loop_total", np.full(len(faces), 3, dtype=np.int32))
+	mesh.update(calc_edges=True)
+	obj = bpy.data.objects.new(name, mesh)
+	collection.objects.link(obj)
+	return obj
+
+# Like import_stl, but parsing the file with numpy and building the mesh
+# directly, without the operator's overhead (undo push, view layer update,
+# selection). The object goes into collection, the active one by default.
+def load_stl(filepath, collection=None):
+	vertices, faces = read_stl(filepath, scale=0.01)
+	name = os.path.splitext(os.path.basename(filepath))[0]
+	return create_mesh_object(name, vertices, faces, collection or bpy.context.collection)
+
+# Rough size in bytes of a mesh's geometry in memory.
+def mesh_memory(mesh):
+	return 16*len(mesh.vertices) + 8*len(mesh.edges) + 8*len(mesh.loops) + 12*len(mesh.polygons)
+
+# Deletes objects and their meshes, freeing them without leaving orphan data
+# behind.
+def remove_objects(objects):
+	for obj in list(objects):
+		mesh = obj.data if obj.type == "MESH" else None
+		bpy.data.objects.remove(obj)
+		if mesh and mesh.users == 0:
+			bpy.data.meshes.remove(mesh)
+
+# Deletes a collection and its child collections with their objects, like
+# remove_objects.
+def remove_collection(col):
+	for child in list(col.children):
+		remove_collection(child)
+	remove_objects(col.objects)
+	bpy.data.collections.remove(col)
+
+# World space vertices (N x 3) of a mesh object, transformed in one matmul.
+def mesh_world_vertices(obj):
+	mesh = obj.data
+	co = np.empty(3*len(mesh.vertices), dtype=np.float32)
+	mesh.vertices.foreach_get("co", co)
+	m = np.array(obj.matrix_world, dtype=np.float32)
+	return co.reshape(-1, 3) @ m[:3, :3].T + m[:3, 3]
+
+# World space vertices (N x 3) and triangles (M x 3) of a mesh object.
+def mesh_world_arrays(obj):
+	mesh = obj.data
+	vertices = mesh_world_vertices(obj)
+	mesh.calc_loop_triangles()
+	triangles = np.empty(3*len(mesh.loop_triangles), dtype=np.int32)
+	mesh.loop_triangles.foreach_get("vertices", triangles)
+	return vertices, triangles.reshape(-1, 3)
+
+# Writes the rows of the mesh objects of a layer to the patch index (see
+# patchindex.py).
+def index_patch_objects(db, layer, objects):
+	patches = ((obj.name, *mesh_world_arrays(obj), len(obj.data.polygons)) for obj in objects if obj.type == "MESH")
+	return index_patches(db, layer, patches)
+
+# Indexes the patches in the cell collections of the open layer file, into the
+# patch index next to it.
+def index_open_layer_file():
+	filepath = bpy.data.filepath
+	db = open_patch_index(patch_index_filepath(os.path.dirname(filepath)))
+	try:
+		objects = [obj for col in get_cell_collections() for obj in col.objects]
+		return index_patch_objects(db, layer_file_layer(filepath), objects)
+	finally:
+		db.close()
+
+# Writes the occupancy sidecar (see masks.py) of the patches in the cell
+# collections of the open layer file.
+def write_open_layer_occupancy():
+	objects = [obj for col in get_cell_collections() for obj in col.objects if obj.type == "MESH"]
+	patches = ((obj.name, patch_cell(obj.name), mesh_world_vertices(obj)) for obj in objects)
+	return write_layer_occupancy(bpy.data.filepath, patches)
+
 def get_cell_collections():
 	cell_collections = []
 	for col in bpy.data.collections:
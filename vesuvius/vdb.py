@@ -0,0 +1,95 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .sampler import TiffVolume
+
+try:
+	import openvdb
+except ImportError:
+	try:
+		import pyopenvdb as openvdb
+	except ImportError:
+		openvdb = None
+
+
+# Export of grid cells to OpenVDB, for rendering the scan as native Cycles
+# volumes instead of through OSL's texture3d, which only runs on the CPU. Each
+# cell becomes a float grid named "density" in its own .vdb file under
+# volume_grids/<vol_id>_vdb, holding the values texture3d_fixed_up would read
+# (z correction included), in [0, 1], with voxel centers where the shader
+# samples them. Levels > 0 export the downsampled cells of pyramids.py, for
+# smaller volumes. Runs in blender, which bundles openvdb, or outside of it if
+# the openvdb python module is installed:
+#
+#   python -m vesuvius.vdb /path/to/PHercParis4.volpkg 20230205180739 7,7,14 7,8,14
+#
+# Pages are copied into the grid one at a time, so a cell is never all in
+# memory as floats.
+
+VDB_GRID_NAME = "density"
+VDB_SUFFIX = "_vdb"
+
+
+def vdb_dir(volpkg_dir, vol_id):
+	return Path(volpkg_dir) / "volume_grids" / f"{vol_id}{VDB_SUFFIX}"
+
+def vdb_filename(cell_filename, level=0):
+	stem = cell_filename.removesuffix(".tif")
+	return f"{stem}.vdb" if level == 0 else f"{stem}_lod{level}.vdb"
+
+
+def require_openvdb():
+	if openvdb is None:
+		raise ImportError("The openvdb python module is required to export grid cells to OpenVDB.")
+
+
+# Writes the TIFF stack at src_filepath, the grid cell `cell`, to dst_filepath.
+# tolerance drops voxels below it from the grid (they read as 0).
+def export_cell_vdb(src_filepath, dst_filepath, cell, tolerance=0):
+	require_openvdb()
+	volume = TiffVolume(src_filepath)
+	depth, height, width = volume.shape
+	voxel_size = 5 / width
+	grid = openvdb.FloatGrid(0.0)
+	grid.name = VDB_GRID_NAME
+	# VDB index (i, j, k) is (x, y, z) in the TIFF stack. Voxel centers are at
+	# integer indices, and the shader samples at p - 0.02.
+	ox, oy, oz = (5*j + voxel_size/2 + 0.02 for j in cell)
+	s = voxel_size
+	grid.transform = openvdb.createLinearTransform([[s, 0, 0, 0], [0, s, 0, 0], [0, 0, s, 0], [ox, oy, oz, 1]])
+	for z in range(depth):
+		pz = (z + 0.5) / depth
+		zcorrection = 2*(pz - 0.5)**2 + 0.5
+		page = volume.page(z).astype(np.float32) * np.float32(volume.scale * zcorrection)
+		grid.copyFromArray(page.T[:, :, None].copy(), ijk=(0, 0, z), tolerance=tolerance)
+	dst_filepath.parent.mkdir(parents=True, exist_ok=True)
+	tmp_filepath = dst_filepath.with_name(dst_filepath.name + ".tmp")
+	openvdb.write(str(tmp_filepath), grids=[grid])
+	os.replace(tmp_filepath, dst_filepath)
+	return dst_filepath
+
+
+def main():
+	parser = argparse.ArgumentParser(prog="python -m vesuvius.vdb", description="Export grid cells to OpenVDB.")
+	parser.add_argument("volpkg_dir")
+	parser.add_argument("vol_id")
+	parser.add_argument("cells", nargs="+", help="jx,jy,jz of the cells to export, 0-indexed")
+	parser.add_argument("--level", type=int, default=0, help="export the downsampled cells of this pyramid level")
+	parser.add_argument("--tolerance", type=float, default=0)
+	args = parser.parse_args()
+	grid_dir = Path(args.volpkg_dir) / "volume_grids" / (args.vol_id if args.level == 0 else f"{args.vol_id}_lod{args.level}")
+	t0 = time.time()
+	for c in args.cells:
+		jx, jy, jz = (int(x) for x in c.split(","))
+		filename = f"cell_yxz_{jy+1:03}_{jx+1:03}_{jz+1:03}.tif"
+		dst_filepath = vdb_dir(args.volpkg_dir, args.vol_id) / vdb_filename(filename, args.level)
+		export_cell_vdb(grid_dir / filename, dst_filepath, (jx, jy, jz), args.tolerance)
+		print(f"{dst_filepath} ({time.time() - t0:.1f} s.)")
+
+
+if __name__ == "__main__":
+	main()
@@ -1,7 +1,17 @@
 import bpy, bmesh
 import json
+import math
+from collections import deque
 
 from .data import *
+from .cache import *
+from .sampler import *
+from .bake import *
+from .pyramids import *
+from .vdb import *
+from .stl import *
+from .pool import *
+from .meshcache import *
 from .shaders import *
 from .utils import *
 from .segmentation import *
@@ -11,6 +21,7 @@ from .weld_turns import *
 # from . import render_engine
 
 ADDON_ID = "vesuvius"
+SMALL_VOLUME_SLICES_RADIUS = 2.5
 
 _current_scan = None
 def get_current_scan():
@@ -40,15 +51,78 @@ def setup_scene(scene, preview_samples=1):
 	scene.cycles.preview_samples = preview_samples
 
 
+# Setting a text's contents makes Cycles recompile the OSL script and reset its
+# shading state, so the text is only rewritten when the generated source
+# differs from it. Returns whether it did.
+def update_shader_text(text, source):
+	if text.as_string() == source:
+		return False
+	text.from_string(source)
+	return True
+
+
+FOCUS_CELLS_PROP = "vesuvius_focus_cells"
+
+# The grid cells shown in full resolution, stored on the material as a flat
+# list of jx, jy, jz. Materials from before focus cells were stored use every
+# cell in their MinJ/MaxJ box.
+def get_focus_cells(material):
+	if FOCUS_CELLS_PROP in material:
+		c = list(material[FOCUS_CELLS_PROP])
+		return [tuple(c[i:i+3]) for i in range(0, len(c), 3)]
+	s = material.node_tree.nodes["Script"]
+	min_j = [int(math.floor(x)) for x in s.inputs["MinJ"].default_value]
+	max_j = [int(math.ceil(x)) for x in s.inputs["MaxJ"].default_value]
+	return [(jx, jy, jz)
+		for jz in range(min_j[2], max_j[2])
+		for jy in range(min_j[1], max_j[1])
+		for jx in range(min_j[0], max_j[0])]
+
+
+# Sets the focus cells of the scan's material, with MinJ/MaxJ to their bounding
+# box, and compiles them into the shader.
+def set_focus_cells(scan, cells):
+	material = bpy.data.materials.get(f"vesuvius_volpkg_{scan.vol_id}")
+	cells = sorted(set(cells))
+	material[FOCUS_CELLS_PROP] = [j for cell in cells for j in cell]
+	s = material.node_tree.nodes["Script"]
+	if cells:
+		s.inputs["MinJ"].default_value = tuple(min(c[i] for c in cells) for i in range(3))
+		s.inputs["MaxJ"].default_value = tuple(max(c[i] for c in cells) + 1 for i in range(3))
+	else:
+		s.inputs["MinJ"].default_value = (0, 0, 0)
+		s.inputs["MaxJ"].default_value = (0, 0, 0)
+	reload_shader(scan)
+
+
+# The shader variant parameters (see generate_shader) as set on the material's
+# script node.
+def shader_variant(material):
+	script = material.node_tree.nodes.get("Script") if material and material.node_tree else None
+	if script is None or script.type != "SCRIPT":
+		return {}
+	return {
+		"nmerge_samples": round(script.inputs["nmerge_samples"].default_value),
+		"disable_hires": bool(script.inputs["disable_hires"].default_value),
+		"focus_cells": get_focus_cells(material),
+	}
+
+
 def setup_material(scan):
 	material = get_or_create(bpy.data.materials, f"vesuvius_volpkg_{scan.vol_id}")
 	material.use_nodes = True
 	node_tree = material.node_tree
-	node_tree.nodes.clear()
 
 	script_text = get_or_create(bpy.data.texts, f"vesuvius_shader_{scan.vol_id}")
-	script_text.from_string(generate_shader(scan))
+	update_shader_text(script_text, generate_shader(scan, **shader_variant(material)))
+
+	# Keep the nodes of a material that is already set up, rebuilding them would
+	# trigger a recompile too.
+	script = node_tree.nodes.get("Script")
+	if script and script.type == "SCRIPT" and script.script == script_text:
+		return material
 
+	node_tree.nodes.clear()
 	output = node_tree.nodes.new(type="ShaderNodeOutputMaterial")
 	output.location = (400, 0)
 	emission = node_tree.nodes.new(type="ShaderNodeEmission")
@@ -62,12 +136,15 @@ def setup_material(scan):
 	return material
 
 
+# Regenerates the shader for the variant currently set on the material's script
+# node. Does nothing if the source doesn't change.
 def reload_shader(scan):
-	print("reload shader")
-	# material = get_or_create(bpy.data.materials, f"vesuvius_volpkg_{scan.vol_id}")
-	# node_tree = material.node_tree
+	material = bpy.data.materials.get(f"vesuvius_volpkg_{scan.vol_id}")
 	script_text = get_or_create(bpy.data.texts, f"vesuvius_shader_{scan.vol_id}")
-	script_text.from_string(generate_shader(scan))
+	if update_shader_text(script_text, generate_shader(scan, **shader_variant(material))):
+		print("reload shader")
+		return True
+	return False
 
 
 def create_axis_planes(px, py, pz, dx, dy, dz, material, name="Plane"):
@@ -100,9 +177,9 @@ def cell_name(cell):
 def cell_from_name(objname):
 	return tuple(int(x) for x in objname[-12:-4].split("_"))
 
-def create_cell_quads(cell, material):
-	name = cell_name(cell)
-	create_axis_quads(5*cell[0], 5*cell[1], 5*cell[2], 5, 5, 5, material, name=name)
+def create_cell_quads(cell, material, name=None):
+	name = name or cell_name(cell)
+	return create_axis_quads(5*cell[0], 5*cell[1], 5*cell[2], 5, 5, 5, material, name=name)
 
 def create_cell_planes(cell, material):
 	name = cell_name(cell)
@@ -136,6 +213,17 @@ class VesuviusAddScan(bpy.types.Operator):
 		default="scroll_1a_791_54",
 	)
 
+	small_volume: bpy.props.EnumProperty(
+		items=[
+			("FULL", "Full", "Download the whole small volume"),
+			("CURSOR_FIRST", "Cursor slices first", "Download the slices around the 3d cursor first, then the rest"),
+			("CURSOR", "Cursor slices", "Download only the slices around the 3d cursor"),
+		],
+		name="Small volume",
+		description="How to download the small volume",
+		default="FULL",
+	)
+
 	def execute(self, context):
 		if not get_data_dir():
 			self.report({"ERROR"}, "Vesuvius data directory not found.")
@@ -145,8 +233,14 @@ class VesuviusAddScan(bpy.types.Operator):
 			self.report({"ERROR"}, f"Scan {repr(self.scan_name)} not found.")
 			return {"CANCELLED"}
 		set_current_scan(scan)
-		self.report({"INFO"}, f"Requested {scan.small_volume_path}.")
-		download_file_start(scan, scan.small_volume_path, context)
+		if self.small_volume == "FULL":
+			future = downloads.submit(scan, scan.small_volume_path)
+		else:
+			z = context.scene.cursor.location.z
+			z_range = (z - SMALL_VOLUME_SLICES_RADIUS, z + SMALL_VOLUME_SLICES_RADIUS)
+			future = downloads.submit_pages(scan, scan.small_volume_path, z_range, fill=self.small_volume == "CURSOR_FIRST")
+		if future:
+			self.report({"INFO"}, f"Downloading {scan.small_volume_path}.")
 		setup_scene(context.scene)
 		material = setup_material(scan)
 		create_scan_quads(scan, material)
@@ -197,14 +291,52 @@ class VesuviusFocusGridCell(bpy.types.Operator, VesuviusCellOperator):
 
 	def execute_with_cell(self, context, scan, cell):
 		self.report({"INFO"}, cell_name(cell))
-		material = bpy.data.materials.get(f"vesuvius_volpkg_{scan.vol_id}")
-		s = material.node_tree.nodes["Script"]
-		# s.inputs["MinJ"].default_value = cell
-		# s.inputs["MaxJ"].default_value = (cell[0]+1, cell[1]+1, cell[2]+1)
-		s.inputs["MinJ"].default_value = (cell[0]-1, cell[1]-1, cell[2]-1)
-		s.inputs["MaxJ"].default_value = (cell[0]+2, cell[1]+2, cell[2]+2)
+		window = focus_window_cells(scan, cell, context.scene.cursor.location)
+		set_focus_cells(scan, window)
+		if get_preferences().prefetch_focus_cells:
+			prefetch_focus_window(scan, cell, context.scene.cursor.location)
+		get_cell_cache(scan).touch(scan.grid_cell_filename(*c) for c in window if scan.grid_cell_filepath(*c).is_file())
+		enforce_cache_budget(scan)
 		return {"FINISHED"}
 
+# The focus cells of the scan's material, None if hi-res is disabled.
+def get_scan_focus_cells(scan):
+	material = bpy.data.materials.get(f"vesuvius_volpkg_{scan.vol_id}")
+	if not (material and material.node_tree and "Script" in material.node_tree.nodes):
+		return None
+	if material.node_tree.nodes["Script"].inputs["disable_hires"].default_value:
+		return None
+	return get_focus_cells(material)
+
+# A VolumeSampler that samples the scan like its material currently does.
+def get_volume_sampler(scan):
+	return VolumeSampler(scan, cells=get_scan_focus_cells(scan) or ())
+
+class VesuviusFocusSelectedGridCells(bpy.types.Operator):
+	"""Show the grid cells of the selected cell objects in full resolution"""
+	bl_idname = "object.vesuvius_focus_selected_grid_cells"
+	bl_label = "Focus selected grid cells"
+
+	def execute(self, context):
+		scan = get_current_scan()
+		if not scan:
+			self.report({"ERROR"}, "No current scan, add a Vesuvius Scan first.")
+			return {"CANCELLED"}
+		cells = {cell_from_name(obj.name) for obj in context.selected_objects if obj.name.startswith("Cell_yxz_")}
+		set_focus_cells(scan, cells)
+		self.report({"INFO"}, f"Focused {len(cells)} grid cells.")
+		return {"FINISHED"}
+
+_last_focus_cell = None
+def prefetch_focus_window(scan, cell, cursor_p):
+	global _last_focus_cell
+	dz = 0
+	if _last_focus_cell and _last_focus_cell[2] != cell[2]:
+		dz = 1 if cell[2] > _last_focus_cell[2] else -1
+	_last_focus_cell = cell
+	cells = focus_window_cells(scan, cell, cursor_p, dz=dz)
+	downloads.prefetch(scan, [scan.grid_cell_path(*c) for c in cells])
+
 
 class VesuviusDownloadGridCells(bpy.types.Operator, VesuviusCellOperator):
 	bl_idname = "object.vesuvius_download_grid_cells"
@@ -212,37 +344,228 @@ class VesuviusDownloadGridCells(bpy.types.Operator, VesuviusCellOperator):
 
 	def execute_with_cell(self, context, scan, cell):
 		cell_path = scan.grid_cell_path(*cell)
-		download_file_start(scan, cell_path, context)
-		self.report({"INFO"}, f"Cell: {cell}.")
+		if downloads.submit(scan, cell_path):
+			self.report({"INFO"}, f"Downloading {scan.grid_cell_name(*cell)}.")
+		else:
+			self.report({"INFO"}, f"Already downloaded {scan.grid_cell_name(*cell)}.")
+		return {"FINISHED"}
+
+# Cells that must stay on disk: the ones in the material's hi-res window and the
+# ones with an imported holes/patches/chunks collection.
+def pinned_cells(scan):
+	pinned = set()
+	for cell in get_scan_focus_cells(scan) or ():
+		pinned.add(scan.grid_cell_filename(*cell))
+	for col in get_cell_collections():
+		pinned.add(f"{col.name}.tif")
+	return pinned
+
+def enforce_cache_budget(scan):
+	budget = int(get_preferences().cache_budget_gb * 1e9)
+	if budget <= 0:
+		return
+	evicted = get_cell_cache(scan).evict(budget, pinned_cells(scan))
+	for filename in evicted:
+		print(f"Evicted {filename} from the cell cache.")
+
+def on_download_finished(dl, error):
+	scan = dl.scan
+	if error or not dl.path.startswith(f"volume_grids/{scan.vol_id}/"):
+		return
+	filename = dl.path.rsplit("/", 1)[1]
+	get_cell_cache(scan).touch([filename])
+	enforce_cache_budget(scan)
+	# A focus cell came in, compile it into the shader.
+	if any(scan.grid_cell_filename(*cell) == filename for cell in get_scan_focus_cells(scan) or ()):
+		reload_shader(scan)
+
+class VesuviusDownloadSmallVolumeSlices(bpy.types.Operator, VesuviusCellOperator):
+	bl_idname = "object.vesuvius_download_small_volume_slices"
+	bl_label = "Download small volume slices"
+
+	z_radius: bpy.props.FloatProperty(
+		name="Z radius",
+		description="Download the slices within this distance of the 3d cursor in z",
+		default=SMALL_VOLUME_SLICES_RADIUS,
+		min=0,
+	)
+
+	def execute_with_cell(self, context, scan, cell):
+		z = context.scene.cursor.location.z
+		z_range = (z - self.z_radius, z + self.z_radius)
+		if downloads.submit_pages(scan, scan.small_volume_path, z_range):
+			self.report({"INFO"}, f"Downloading {scan.small_volume_path} slices at z {z_range[0]:.2f}-{z_range[1]:.2f}.")
+		else:
+			self.report({"INFO"}, f"Already downloaded {scan.small_volume_path}.")
+		return {"FINISHED"}
+
+class VesuviusBuildCellPyramids(bpy.types.Operator, VesuviusCellOperator):
+	"""Build the downsampled levels of the grid cells around the 3d cursor and enable the shader's level of detail mode"""
+	bl_idname = "object.vesuvius_build_cell_pyramids"
+	bl_label = "Build grid cell pyramids"
+
+	def execute_with_cell(self, context, scan, cell):
+		window = focus_window_cells(scan, cell, context.scene.cursor.location)
+		cells = [c for c in window if scan.grid_cell_filepath(*c).is_file()]
+		n_built = 0
+		for c in cells:
+			if not cell_pyramid_built(scan, *c):
+				print(f"Building pyramid for {scan.grid_cell_name(*c)}...")
+				build_cell_pyramid(scan, *c)
+				n_built += 1
+		material = bpy.data.materials.get(f"vesuvius_volpkg_{scan.vol_id}")
+		if material and "Script" in material.node_tree.nodes:
+			material.node_tree.nodes["Script"].inputs["lod_levels"].default_value = LOD_LEVELS
+		self.report({"INFO"}, f"Built pyramids for {n_built} cells, {len(cells) - n_built} were up to date.")
 		return {"FINISHED"}
 
+# A volume material for grid cells imported as OpenVDB volumes. Cycles samples
+# the density grid natively, on any device, and the material maps it like
+# measure_scan to an emission that is only on in thin slabs around three axis
+# planes through the slice point, like the quads of the OSL material. The slice
+# point and thickness are the values of the "Slice X/Y/Z" and "Slice thickness"
+# nodes. There is no surface normal in a volume, so r, g and b all show a
+# single sample.
+def setup_volume_material(scan, slice_point):
+	material = get_or_create(bpy.data.materials, f"vesuvius_volume_{scan.vol_id}")
+	material.use_nodes = True
+	node_tree = material.node_tree
+	nodes, links = node_tree.nodes, node_tree.links
+	nodes.clear()
+
+	def math_node(operation, a, b, location):
+		node = nodes.new(type="ShaderNodeMath")
+		node.operation = operation
+		node.location = location
+		for i, x in enumerate((a, b)):
+			if isinstance(x, bpy.types.NodeSocket):
+				links.new(x, node.inputs[i])
+			else:
+				node.inputs[i].default_value = x
+		return node.outputs[0]
+
+	density = nodes.new(type="ShaderNodeAttribute")
+	density.attribute_name = VDB_GRID_NAME
+	density.location = (-800, 200)
+	value = math_node("SUBTRACT", density.outputs["Fac"], 0.15, (-600, 200))
+	value = math_node("DIVIDE", value, 1.15, (-400, 200))
+	value = math_node("MAXIMUM", value, 0, (-200, 200))
+
+	position = nodes.new(type="ShaderNodeNewGeometry")
+	position.location = (-1000, -200)
+	xyz = nodes.new(type="ShaderNodeSeparateXYZ")
+	xyz.location = (-800, -200)
+	links.new(position.outputs["Position"], xyz.inputs[0])
+	thickness = nodes.new(type="ShaderNodeValue")
+	thickness.name = thickness.label = "Slice thickness"
+	thickness.outputs[0].default_value = 0.02
+	thickness.location = (-800, -600)
+	half_thickness = math_node("MULTIPLY", thickness.outputs[0], 0.5, (-600, -600))
+	mask = None
+	for i, axis in enumerate("XYZ"):
+		plane = nodes.new(type="ShaderNodeValue")
+		plane.name = plane.label = f"Slice {axis}"
+		plane.outputs[0].default_value = slice_point[i]
+		plane.location = (-800, -300 - 100*i)
+		d = math_node("SUBTRACT", xyz.outputs[i], plane.outputs[0], (-600, -200 - 100*i))
+		d = math_node("ABSOLUTE", d, 0, (-400, -200 - 100*i))
+		m = math_node("LESS_THAN", d, half_thickness, (-200, -200 - 100*i))
+		mask = m if mask is None else math_node("MAXIMUM", mask, m, (0, -200 - 100*i))
+	# A slab seen face on integrates the emission over its thickness.
+	strength = math_node("DIVIDE", mask, thickness.outputs[0], (200, -200))
+
+	emission = nodes.new(type="ShaderNodeEmission")
+	emission.location = (400, 0)
+	links.new(value, emission.inputs["Color"])
+	links.new(strength, emission.inputs["Strength"])
+	output = nodes.new(type="ShaderNodeOutputMaterial")
+	output.location = (600, 0)
+	links.new(emission.outputs["Emission"], output.inputs["Volume"])
+	return material
+
+
+def import_cell_volume(scan, cell, material, level=0):
+	filepath = scan.grid_cell_vdb_filepath(*cell, level)
+	src_filepath = scan.grid_cell_lod_filepath(*cell, level)
+	if not filepath.is_file() or filepath.stat().st_mtime < src_filepath.stat().st_mtime:
+		print(f"Exporting {scan.grid_cell_name(*cell)} to {filepath}...")
+		export_cell_vdb(src_filepath, filepath, cell)
+	name = f"{cell_name(cell)}__VDB"
+	volume = bpy.data.volumes.get(name) or bpy.data.volumes.new(name)
+	volume.filepath = str(filepath)
+	volume.materials.clear()
+	volume.materials.append(material)
+	obj = bpy.data.objects.get(name) or bpy.data.objects.new(name, volume)
+	if obj.name not in bpy.context.collection.objects:
+		bpy.context.collection.objects.link(obj)
+	return obj
+
+
+class VesuviusImportCellVolumes(bpy.types.Operator, VesuviusCellOperator):
+	"""Import the grid cells around the 3d cursor as OpenVDB volumes, sliced through the cursor"""
+	bl_idname = "object.vesuvius_import_cell_volumes"
+	bl_label = "Import grid cell volumes"
+
+	radius: bpy.props.IntProperty(name="Radius", description="Cells around the cursor's cell to import", default=0, min=0)
+	level: bpy.props.IntProperty(name="Level", description="Pyramid level to import, 0 is full resolution", default=0, min=0, max=LOD_LEVELS)
+
+	def execute_with_cell(self, context, scan, cell):
+		if openvdb is None:
+			self.report({"ERROR"}, "This blender has no openvdb python module.")
+			return {"CANCELLED"}
+		cursor_p = context.scene.cursor.location
+		cells = [c for c in focus_window_cells(scan, cell, cursor_p, radius=self.radius)
+			if scan.grid_cell_lod_filepath(*c, self.level).is_file()]
+		if not cells:
+			self.report({"ERROR"}, "None of the cells are on disk.")
+			return {"CANCELLED"}
+		material = setup_volume_material(scan, tuple(cursor_p))
+		activate_collection("Volumes")
+		for c in cells:
+			import_cell_volume(scan, c, material, self.level)
+		self.report({"INFO"}, f"Imported {len(cells)} cell volumes.")
+		return {"FINISHED"}
+
+def draw_download_status(self, context):
+	status = downloads.status()
+	if not status:
+		return
+	n_files, progress, stats = status
+	self.layout.label(
+		text=f"Downloading {n_files} file{'s' if n_files != 1 else ''}: {100*progress:.0f}%"
+		f" ({stats['bytes_per_s']/1e6:.1f} MB/s, {stats['active_connections']} connections)",
+		icon="IMPORT",
+	)
+
 # TODO: Dedupe all these copy-pasted import_cell* import_layer* stuff.
 
+# Creates the meshes of the STL files in directory d in collection col, from its
+# mesh cache (see meshcache.py), which is built first if it is missing or stale.
+# If it can't be written, the files are read one by one. Returns the objects.
+def load_dir_meshes(d, col):
+	try:
+		meshes = mesh_cache(d)
+	except OSError as e:
+		print(f"Can't cache the meshes of {d}: {e}")
+		meshes = [(os.path.splitext(f)[0], *read_stl(f"{d}/{f}", 0.01)) for f in os.listdir(d) if f.endswith(".stl")]
+	return [create_mesh_object(name, vertices, faces, col) for name, vertices, faces in meshes]
+
 def import_cell_holes(ctx, scan, cell, parent_collection=None):
 	col = activate_collection(scan.grid_cell_name(*cell), parent_collection=parent_collection)
 	holes_dir = scan.grid_cell_holes_dir(*cell)
-	for filename in os.listdir(holes_dir):
-		if not filename.endswith(".stl"):
-			continue
-		import_stl(f"{holes_dir}/{filename}")
+	load_dir_meshes(holes_dir, col)
 	return col
 
 def import_cell_patches(ctx, scan, cell, parent_collection=None):
 	col = activate_collection(scan.grid_cell_name(*cell), parent_collection=parent_collection)
 	patches_dir = scan.grid_cell_patches_dir(*cell)
-	for filename in os.listdir(patches_dir):
-		if not filename.endswith(".stl"):
-			continue
-		import_stl(f"{patches_dir}/{filename}")
+	load_dir_meshes(patches_dir, col)
 	return col
 
 def import_cell_chunks(ctx, scan, cell, parent_collection=None):
 	col = activate_collection(scan.grid_cell_name(*cell), parent_collection=parent_collection)
 	chunks_dir = scan.grid_cell_chunks_dir(*cell)
-	for filename in os.listdir(chunks_dir):
-		if not filename.endswith(".stl"):
-			continue
-		import_stl(f"{chunks_dir}/{filename}")
+	load_dir_meshes(chunks_dir, col)
 	return col
 
 class VesuviusImportCellHoles(bpy.types.Operator, VesuviusCellOperator):
@@ -259,11 +582,69 @@ def layer_cells(ctx, jz):
 			cells.append(cell_from_name(obj.name))
 	return cells
 
-def import_layer_holes(ctx, scan, jz):
+STL_BATCH_SIZE = 64
+
+# Imports the STL files in cell_dir(cell) of every cell in the layer, each cell
+# into a collection of its own under parent_collection. The files are parsed by
+# a pool of worker processes, in batches, into shared memory (see
+# read_stls_shared), and the main thread only creates the meshes, cell by cell
+# in order as their batches come in. Only about 2 batches per worker are in
+# flight at a time, the next one submitted as each is consumed, so the parsed
+# meshes waiting in shared memory don't pile up to the whole layer. Cells with
+# an up to date mesh cache (see meshcache.py) are read from it instead, one at a
+# time as their turn comes.
+def import_layer_stls(ctx, scan, jz, parent_collection, cell_dir, workers=None):
+	cells = layer_cells(ctx, jz)
+	workers = workers or get_preferences().import_workers or None
+	max_in_flight = 2*worker_count(workers)
+	wm = ctx.window_manager
+	wm.progress_begin(0, len(cells))
+	t0 = time.time()
+	cached = [mesh_cache_is_fresh(cell_dir(*cell)) for cell in cells]
+	# (cell index, filepaths) of each batch, in the order the cells are imported.
+	def stl_batches():
+		for i, cell in enumerate(cells):
+			if cached[i]:
+				continue
+			d = cell_dir(*cell)
+			filepaths = [f"{d}/{filename}" for filename in os.listdir(d) if filename.endswith(".stl")]
+			for k in range(0, len(filepaths), STL_BATCH_SIZE):
+				yield i, filepaths[k:k+STL_BATCH_SIZE]
+	jobs = stl_batches()
+	in_flight = deque()
+	with process_pool(workers) as pool:
+		def submit_jobs():
+			while len(in_flight) < max_in_flight:
+				job = next(jobs, None)
+				if job is None:
+					return
+				i, filepaths = job
+				in_flight.append((i, pool.submit(read_stls_shared, filepaths, 0.01)))
+		try:
+			submit_jobs()
+			for i, cell in enumerate(cells):
+				col = activate_collection(scan.grid_cell_name(*cell), parent_collection=parent_collection)
+				n_objects = len(load_dir_meshes(cell_dir(*cell), col)) if cached[i] else 0
+				while in_flight and in_flight[0][0] == i:
+					_, future = in_flight.popleft()
+					meshes = take_shared_meshes(*future.result())
+					submit_jobs()
+					for filepath, vertices, faces in meshes:
+						name = os.path.splitext(os.path.basename(filepath))[0]
+						create_mesh_object(name, vertices, faces, col)
+						n_objects += 1
+				wm.progress_update(i + 1)
+				print(f"[{i+1}/{len(cells)}] Imported {n_objects} objects for cell {cell} ({time.time() - t0:.1f} s.)")
+		finally:
+			# Free the shared memory of batches left behind by an error.
+			for _, future in in_flight:
+				if not future.cancel() and future.exception() is None:
+					take_shared_meshes(*future.result())
+			wm.progress_end()
+
+def import_layer_holes(ctx, scan, jz, workers=None):
 	holes_col = activate_collection(f"Holes_z{jz+1:02d}")
-	for cell in layer_cells(ctx, jz):
-		print(f"Importing holes for cell {cell}...")
-		import_cell_holes(ctx, scan, cell, parent_collection=holes_col)
+	import_layer_stls(ctx, scan, jz, holes_col, scan.grid_cell_holes_dir, workers)
 
 class VesuviusImportLayerHoles(bpy.types.Operator, VesuviusCellOperator):
 	bl_idname = "object.vesuvius_import_layer_holes"
@@ -272,11 +653,9 @@ class VesuviusImportLayerHoles(bpy.types.Operator, VesuviusCellOperator):
 		_, _, jz = cell
 		return import_layer_holes(context, scan, jz) or {"FINISHED"}
 
-def import_layer_patches(ctx, scan, jz):
+def import_layer_patches(ctx, scan, jz, workers=None):
 	patches_col = activate_collection(f"Patches_z{jz+1:02d}")
-	for cell in layer_cells(ctx, jz):
-		print(f"Importing patches for cell {cell}...")
-		import_cell_patches(ctx, scan, cell, parent_collection=patches_col)
+	import_layer_stls(ctx, scan, jz, patches_col, scan.grid_cell_patches_dir, workers)
 
 class VesuviusImportLayerPatches(bpy.types.Operator, VesuviusCellOperator):
 	bl_idname = "object.vesuvius_import_layer_patches"
@@ -286,11 +665,9 @@ class VesuviusImportLayerPatches(bpy.types.Operator, VesuviusCellOperator):
 		import_layer_patches(context, scan, jz)
 		return {"FINISHED"}
 
-def import_layer_chunks(ctx, scan, jz):
+def import_layer_chunks(ctx, scan, jz, workers=None):
 	chunks_col = activate_collection(f"Chunks_z{jz+1:02d}")
-	for cell in layer_cells(ctx, jz):
-		print(f"Importing chunks for cell {cell}...")
-		import_cell_chunks(ctx, scan, cell, parent_collection=chunks_col)
+	import_layer_stls(ctx, scan, jz, chunks_col, scan.grid_cell_chunks_dir, workers)
 
 class VesuviusImportLayerChunks(bpy.types.Operator, VesuviusCellOperator):
 	bl_idname = "object.vesuvius_import_layer_chunks"
@@ -301,6 +678,151 @@ class VesuviusImportLayerChunks(bpy.types.Operator, VesuviusCellOperator):
 		return {"FINISHED"}
 
 
+# Streaming cells: instead of importing whole layers, every cell with holes,
+# patches or chunks on disk gets a wireframe proxy of its bounds (the cell
+# quads), and a timer loads the meshes of the cells within `radius` cells of the
+# 3d cursor or of the center of a 3d view, closest first, a few per tick. Cells
+# that fall out of range stay loaded until the loaded meshes take more than the
+# stream_budget_mb preference, and are then unloaded farthest first. Loaded
+# cells go into cell collections under Stream_<kind>, like import_layer_stls's.
+
+STREAM_POLL_INTERVAL = 0.5
+STREAM_CELLS_PER_POLL = 1
+
+class CellStream:
+	def __init__(self, scan, kind, radius):
+		self.scan = scan
+		self.kind = kind
+		self.radius = radius
+		self.cell_dir = getattr(scan, f"grid_cell_{kind}_dir")
+		self.cells = scan.segmentation_cells(kind)
+		self.collection_name = f"Stream_{kind.capitalize()}"
+		self.loaded = {} # cell -> bytes
+
+	def loaded_bytes(self):
+		return sum(self.loaded.values())
+
+_cell_stream = None
+
+# The points cells are streamed around: the 3d cursor and the view centers.
+def stream_focus_points(context):
+	points = [context.scene.cursor.location.copy()]
+	for window in context.window_manager.windows:
+		for area in window.screen.areas:
+			if area.type == "VIEW_3D":
+				points.append(area.spaces.active.region_3d.view_location.copy())
+	return points
+
+# Distance of a cell to the closest point, in cells, then in world units.
+def stream_cell_distance(cell, points):
+	return min(
+		(max(abs(a - b) for a, b in zip(cell, world_to_grid(p))),
+		 sum((5*cell[i] + 2.5 - p[i])**2 for i in range(3))**0.5)
+		for p in points)
+
+def create_stream_proxies(stream):
+	col = activate_collection(stream.collection_name)
+	activate_collection(f"{stream.collection_name}_proxies", parent_collection=col)
+	for cell in stream.cells:
+		for obj in create_cell_quads(cell, None, name=f"Stream_{cell_name(cell)}"):
+			obj.display_type = "WIRE"
+			obj.hide_render = True
+			obj.select_set(False)
+	activate_collection(col)
+
+def load_stream_cell(stream, cell):
+	col = bpy.data.collections.new(stream.scan.grid_cell_name(*cell))
+	bpy.data.collections[stream.collection_name].children.link(col)
+	objs = load_dir_meshes(stream.cell_dir(*cell), col)
+	stream.loaded[cell] = sum(mesh_memory(obj.data) for obj in objs)
+
+def unload_stream_cell(stream, cell):
+	col = bpy.data.collections.get(stream.scan.grid_cell_name(*cell))
+	if col:
+		remove_collection(col)
+	del stream.loaded[cell]
+
+def poll_cell_stream():
+	stream = _cell_stream
+	if stream is None or stream.collection_name not in bpy.data.collections:
+		return None
+	points = stream_focus_points(bpy.context)
+	distance = {cell: stream_cell_distance(cell, points) for cell in stream.cells}
+	budget = int(get_preferences().stream_budget_mb * 1e6)
+	for cell in sorted(stream.loaded, key=distance.get, reverse=True):
+		if stream.loaded_bytes() <= budget or distance[cell][0] <= stream.radius:
+			break
+		unload_stream_cell(stream, cell)
+		print(f"Unloaded {stream.kind} of cell {cell}.")
+	in_range = sorted((c for c in stream.cells if distance[c][0] <= stream.radius), key=distance.get)
+	# Cells imported some other way already have a collection, leave them be.
+	to_load = [c for c in in_range if c not in stream.loaded and stream.scan.grid_cell_name(*c) not in bpy.data.collections]
+	for cell in to_load[:STREAM_CELLS_PER_POLL]:
+		t0 = time.time()
+		load_stream_cell(stream, cell)
+		print(f"Loaded {stream.kind} of cell {cell}: {stream.loaded[cell]/1e6:.1f} MB ({time.time() - t0:.1f} s.)")
+	return STREAM_POLL_INTERVAL
+
+def stop_cell_stream():
+	global _cell_stream
+	if bpy.app.timers.is_registered(poll_cell_stream):
+		bpy.app.timers.unregister(poll_cell_stream)
+	stream, _cell_stream = _cell_stream, None
+	if stream and stream.collection_name in bpy.data.collections:
+		remove_collection(bpy.data.collections[stream.collection_name])
+
+class VesuviusStreamCells(bpy.types.Operator):
+	"""Load the holes, patches or chunks of the cells around the 3d cursor and the views as they move, unloading the ones left behind"""
+	bl_idname = "object.vesuvius_stream_cells"
+	bl_label = "Stream cells"
+
+	kind: bpy.props.EnumProperty(
+		items=[
+			("holes", "Holes", "Stream the cells' holes"),
+			("patches", "Patches", "Stream the cells' patches"),
+			("chunks", "Chunks", "Stream the cells' chunks"),
+		],
+		name="Kind",
+		default="patches",
+	)
+
+	radius: bpy.props.IntProperty(
+		name="Radius",
+		description="Load the cells up to this many cells away",
+		default=1,
+		min=0,
+	)
+
+	def execute(self, context):
+		global _cell_stream
+		if not get_data_dir():
+			self.report({"ERROR"}, "Vesuvius data directory not found.")
+			return {"CANCELLED"}
+		scan = get_current_scan()
+		if not scan:
+			self.report({"ERROR"}, "No current scan, add a Vesuvius Scan first.")
+			return {"CANCELLED"}
+		stop_cell_stream()
+		_cell_stream = CellStream(scan, self.kind, self.radius)
+		if not _cell_stream.cells:
+			self.report({"ERROR"}, f"No cells with {self.kind} on disk.")
+			_cell_stream = None
+			return {"CANCELLED"}
+		create_stream_proxies(_cell_stream)
+		bpy.app.timers.register(poll_cell_stream)
+		self.report({"INFO"}, f"Streaming the {self.kind} of {len(_cell_stream.cells)} cells.")
+		return {"FINISHED"}
+
+class VesuviusStopStreamingCells(bpy.types.Operator):
+	"""Stop streaming cells and unload them"""
+	bl_idname = "object.vesuvius_stop_streaming_cells"
+	bl_label = "Stop streaming cells"
+
+	def execute(self, context):
+		stop_cell_stream()
+		return {"FINISHED"}
+
+
 class VesuviusReloadShader(bpy.types.Operator):
 	bl_idname = "object.vesuvius_reload_shader"
 	bl_label = "Reload vesuvius shader"
@@ -310,7 +832,70 @@ class VesuviusReloadShader(bpy.types.Operator):
 		if not scan:
 			self.report({"ERROR"}, "No current scan, add a Vesuvius Scan first.")
 			return {"CANCELLED"}
-		reload_shader(scan)
+		if not reload_shader(scan):
+			self.report({"INFO"}, "Shader is up to date.")
+		return {"FINISHED"}
+
+
+def setup_baked_material(obj, filepath):
+	image = bpy.data.images.load(str(filepath), check_existing=True)
+	image.reload()
+	image.colorspace_settings.name = "Non-Color"
+	material = get_or_create(bpy.data.materials, f"vesuvius_baked_{obj.name}")
+	material.use_nodes = True
+	node_tree = material.node_tree
+	node_tree.nodes.clear()
+	output = node_tree.nodes.new(type="ShaderNodeOutputMaterial")
+	output.location = (400, 0)
+	emission = node_tree.nodes.new(type="ShaderNodeEmission")
+	emission.location = (200, 0)
+	texture = node_tree.nodes.new(type="ShaderNodeTexImage")
+	texture.location = (-100, 0)
+	texture.image = image
+	node_tree.links.new(texture.outputs["Color"], emission.inputs["Color"])
+	node_tree.links.new(emission.outputs["Emission"], output.inputs["Surface"])
+	if obj.data.materials:
+		obj.data.materials[0] = material
+	else:
+		obj.data.materials.append(material)
+	return material
+
+class VesuviusBakeSegment(bpy.types.Operator):
+	bl_idname = "object.vesuvius_bake_segment"
+	bl_label = "Bake scan to texture"
+
+	resolution: bpy.props.IntProperty(
+		name="Resolution",
+		description="Width and height of the baked texture",
+		default=4096,
+		min=64,
+	)
+
+	def execute(self, context):
+		scan = get_current_scan()
+		if not scan:
+			self.report({"ERROR"}, "No current scan, add a Vesuvius Scan first.")
+			return {"CANCELLED"}
+		if not bpy.data.filepath:
+			self.report({"ERROR"}, "Save the blend file first, bakes are saved next to it.")
+			return {"CANCELLED"}
+		objs = [o for o in context.selected_objects if o.type == "MESH" and o.data.uv_layers.active]
+		if not objs:
+			self.report({"ERROR"}, "No selected mesh with a UV map.")
+			return {"CANCELLED"}
+		material = bpy.data.materials.get(f"vesuvius_volpkg_{scan.vol_id}")
+		s = material.node_tree.nodes["Script"]
+		res = scan.resolution_um * 100
+		offset = s.inputs["offset_um"].default_value / res
+		nmerge_step = s.inputs["nmerge_step_um"].default_value / res
+		nmerge_samples = round(s.inputs["nmerge_samples"].default_value)
+		sampler = get_volume_sampler(scan)
+		bakes_dir = Path(bpy.path.abspath("//vesuvius_bakes"))
+		bakes_dir.mkdir(exist_ok=True)
+		for obj in objs:
+			filepath = bake_segment(obj, sampler, bakes_dir / f"{obj.name}.tif", self.resolution, offset, nmerge_step, nmerge_samples)
+			setup_baked_material(obj, filepath)
+		self.report({"INFO"}, f"Baked {len(objs)} object{'s' if len(objs) != 1 else ''}.")
 		return {"FINISHED"}
 
 
@@ -491,22 +1076,73 @@ class VesuviusPreferences(bpy.types.AddonPreferences):
 		subtype="DIR_PATH",
 	)
 
+	prefetch_focus_cells: bpy.props.BoolProperty(
+		name="Prefetch focused grid cells",
+		description="Download the cells around a focused grid cell in the background, closest first",
+		default=True,
+	)
+
+	max_connections: bpy.props.IntProperty(
+		name="Connections to the data server",
+		description="Maximum number of simultaneous downloads and connections to the data server",
+		default=DATA_MAX_CONNECTIONS,
+		min=1,
+		max=32,
+		update=lambda self, context: configure_downloads(self.max_connections),
+	)
+
+	cache_budget_gb: bpy.props.FloatProperty(
+		name="Grid cell cache size (GB)",
+		description="Delete the least recently used grid cells when they take more than this. 0 disables the limit",
+		default=0,
+		min=0,
+	)
+
+	import_workers: bpy.props.IntProperty(
+		name="Import worker processes",
+		description="Processes that read the STL files of layer imports. 0 uses all cores",
+		default=0,
+		min=0,
+	)
+
+	stream_budget_mb: bpy.props.FloatProperty(
+		name="Streamed cells memory (MB)",
+		description="Keep streamed cells that are out of range loaded until the loaded meshes take more than this",
+		default=2000,
+		min=0,
+	)
+
 	def draw(self, context):
 		self.layout.prop(self, "data_dir")
+		self.layout.prop(self, "prefetch_focus_cells")
+		self.layout.prop(self, "max_connections")
+		self.layout.prop(self, "cache_budget_gb")
+		self.layout.prop(self, "import_workers")
+		self.layout.prop(self, "stream_budget_mb")
 
 
 def register():
 	bpy.utils.register_class(VesuviusPreferences)
+	addon = bpy.context.preferences.addons.get(ADDON_ID)
+	if addon:
+		configure_downloads(addon.preferences.max_connections)
 	bpy.utils.register_class(VesuviusAddScan)
 	bpy.types.VIEW3D_MT_add.append(vesuvius_add_menu_func)
 	bpy.utils.register_class(VesuviusAddGridCell)
 	bpy.utils.register_class(VesuviusFocusGridCell)
+	bpy.utils.register_class(VesuviusFocusSelectedGridCells)
 	bpy.utils.register_class(VesuviusDownloadGridCells)
+	bpy.utils.register_class(VesuviusDownloadSmallVolumeSlices)
+	bpy.utils.register_class(VesuviusBuildCellPyramids)
+	bpy.utils.register_class(VesuviusImportCellVolumes)
 	bpy.utils.register_class(VesuviusImportCellHoles)
 	bpy.utils.register_class(VesuviusImportLayerHoles)
 	bpy.utils.register_class(VesuviusImportLayerPatches)
 	bpy.utils.register_class(VesuviusImportLayerChunks)
+	bpy.utils.register_class(VesuviusStreamCells)
+	bpy.utils.register_class(VesuviusStopStreamingCells)
 	bpy.utils.register_class(VesuviusReloadShader)
+	bpy.utils.register_class(VesuviusBakeSegment)
 	bpy.utils.register_class(VesuviusRaycastSort)
 	bpy.utils.register_class(VesuviusSelectClosestByRaycast)
 	bpy.utils.register_class(VesuviusHideNotDirectlySeenFrom)
@@ -526,17 +1162,27 @@ def register():
 	bpy.utils.register_class(SelectIntersectActive)
 	bpy.types.VIEW3D_MT_select_object.append(select_intersect_menu_func)
 
+	bpy.types.STATUSBAR_HT_header.append(draw_download_status)
+	downloads.finished_callbacks.append(on_download_finished)
+
 def unregister():
 	bpy.utils.unregister_class(VesuviusPreferences)
 	bpy.utils.unregister_class(VesuviusAddScan)
 	bpy.types.VIEW3D_MT_add.remove(vesuvius_add_menu_func)
 	bpy.utils.unregister_class(VesuviusAddGridCell)
 	bpy.utils.unregister_class(VesuviusFocusGridCell)
+	bpy.utils.unregister_class(VesuviusFocusSelectedGridCells)
 	bpy.utils.unregister_class(VesuviusImportCellHoles)
 	bpy.utils.unregister_class(VesuviusImportLayerHoles)
 	bpy.utils.unregister_class(VesuviusImportLayerPatches)
+	bpy.utils.unregister_class(VesuviusStreamCells)
+	bpy.utils.unregister_class(VesuviusStopStreamingCells)
 	bpy.utils.unregister_class(VesuviusDownloadGridCells)
+	bpy.utils.unregister_class(VesuviusDownloadSmallVolumeSlices)
+	bpy.utils.unregister_class(VesuviusBuildCellPyramids)
+	bpy.utils.unregister_class(VesuviusImportCellVolumes)
 	bpy.utils.unregister_class(VesuviusReloadShader)
+	bpy.utils.unregister_class(VesuviusBakeSegment)
 	bpy.utils.unregister_class(VesuviusRaycastSort)
 	bpy.utils.unregister_class(VesuviusSelectClosestByRaycast)
 	bpy.utils.unregister_class(VesuviusHideNotDirectlySeenFrom)
@@ -555,3 +1201,11 @@ def unregister():
 
 	bpy.utils.unregister_class(SelectIntersectActive)
 	bpy.types.VIEW3D_MT_select_object.remove(select_intersect_menu_func)
+
+	bpy.types.STATUSBAR_HT_header.remove(draw_download_status)
+	downloads.finished_callbacks.remove(on_download_finished)
+	if bpy.app.timers.is_registered(poll_downloads):
+		bpy.app.timers.unregister(poll_downloads)
+	if bpy.app.timers.is_registered(poll_cell_stream):
+		bpy.app.timers.unregister(poll_cell_stream)
+	downloads.shutdown()